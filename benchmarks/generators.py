@@ -0,0 +1,265 @@
+"""
+Synthetic log generator module.
+This module produces seeded, realistic input for the three shipped sources:
+gzip ALB access log files, gzip Network Firewall JSON line files and
+Kinesis-wrapped Sysmon events, plus the SQS and Kinesis records that carry them.
+"""
+import base64
+import gzip
+import json
+import random
+from datetime import datetime, timedelta, timezone
+
+# Start of the generated time range
+BASE_TIME = datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+# Seconds covered by the generated timestamps, spanning two eventDay partitions
+TIME_RANGE_SECONDS = 36 * 3600
+
+HTTP_METHODS = ['GET', 'GET', 'GET', 'POST', 'POST', 'PUT', 'DELETE', 'PATCH', 'HEAD', 'OPTIONS']
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_3) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.3 Safari/605.1.15',
+    'curl/8.4.0',
+    'python-requests/2.31.0',
+    'ELB-HealthChecker/2.0'
+]
+STATUS_CODES = ['200', '200', '200', '200', '201', '204', '301', '304', '400', '403', '404', '500', '502']
+ALB_TYPES = ['http', 'https', 'https', 'h2']
+
+NFW_EVENT_TYPES = ['netflow', 'netflow', 'netflow', 'alert', 'tls']
+NFW_PROTOCOLS = ['TCP', 'TCP', 'UDP', 'ICMP']
+NFW_APP_PROTOCOLS = ['http', 'tls', 'dns', 'unknown']
+
+SYSMON_EVENT_IDS = ['1', '1', '3', '5', '11', '11', '23']
+SYSMON_IMAGES = [
+    'C:\\Windows\\System32\\svchost.exe',
+    'C:\\Windows\\System32\\cmd.exe',
+    'C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe',
+    'C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe',
+    'C:\\Windows\\explorer.exe'
+]
+SYSMON_USERS = ['NT AUTHORITY\\SYSTEM', 'NT AUTHORITY\\LOCAL SERVICE', 'CORP\\alice', 'CORP\\bob']
+
+def _timestamp(rng):
+    """
+    Return a random datetime within the generated time range
+    """
+    return BASE_TIME + timedelta(seconds=rng.random() * TIME_RANGE_SECONDS)
+
+def _ip(rng, prefix='10'):
+    """
+    Return a random IPv4 address in a /8
+    """
+    return f'{prefix}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}'
+
+def alb_log_line(rng, index):
+    """
+    Return one ALB access log entry in the documented field order
+    """
+    time = _timestamp(rng)
+    method = rng.choice(HTTP_METHODS)
+    status = rng.choice(STATUS_CODES)
+    has_target = rng.random() > 0.05
+    target = f'{_ip(rng, "172")}:{rng.choice([80, 8080, 443])}' if has_target else '-'
+    request = f'{method} https://app.example.com:443/api/v1/items/{rng.randint(1, 100000)}?page={rng.randint(1, 50)} HTTP/1.1'
+    return ' '.join([
+        rng.choice(ALB_TYPES),
+        time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'app/my-loadbalancer/50dc6c495c0c9188',
+        f'{_ip(rng)}:{rng.randint(1024, 65535)}',
+        target,
+        f'{rng.random() / 100:.3f}',
+        f'{rng.random():.3f}' if has_target else '-1',
+        f'{rng.random() / 1000:.3f}',
+        status,
+        status if has_target else '-',
+        str(rng.randint(100, 5000)),
+        str(rng.randint(100, 500000)),
+        f'"{request}"',
+        f'"{rng.choice(USER_AGENTS)}"',
+        'ECDHE-RSA-AES128-GCM-SHA256',
+        'TLSv1.2',
+        'arn:aws:elasticloadbalancing:us-east-2:123456789012:targetgroup/my-targets/73e2d6bc24d8a067',
+        f'"Root=1-{int(time.timestamp()):08x}-{index:024x}"',
+        '"app.example.com"',
+        '"arn:aws:acm:us-east-2:123456789012:certificate/12345678-1234-1234-1234-123456789012"',
+        str(rng.randint(0, 10)),
+        (time - timedelta(milliseconds=rng.randint(1, 500))).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        '"forward"',
+        '"-"',
+        '"-"',
+        f'"{target}"',
+        f'"{status}"' if has_target else '"-"',
+        '"-"',
+        '"-"',
+        f'TID_{index:016x}'
+    ])
+
+def nfw_log_line(rng, index):
+    """
+    Return one Network Firewall log entry as a JSON line
+    """
+    event_type = rng.choice(NFW_EVENT_TYPES)
+    time = _timestamp(rng)
+    event = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S.%f+0000'),
+        'flow_id': rng.randint(10 ** 14, 10 ** 16),
+        'event_type': event_type,
+        'src_ip': _ip(rng),
+        'src_port': rng.randint(1024, 65535),
+        'dest_ip': _ip(rng, str(rng.choice([8, 52, 142]))),
+        'dest_port': rng.choice([53, 80, 443, 8443]),
+        'proto': rng.choice(NFW_PROTOCOLS),
+        'app_proto': rng.choice(NFW_APP_PROTOCOLS)
+    }
+    if event_type == 'netflow':
+        start = time - timedelta(seconds=rng.randint(1, 120))
+        event['netflow'] = {
+            'pkts': rng.randint(1, 5000),
+            'bytes': rng.randint(40, 5000000),
+            'start': start.strftime('%Y-%m-%dT%H:%M:%S.%f+0000'),
+            'end': time.strftime('%Y-%m-%dT%H:%M:%S.%f+0000'),
+            'age': int((time - start).total_seconds()),
+            'min_ttl': 64,
+            'max_ttl': 64
+        }
+        if event['proto'] == 'TCP':
+            event['tcp'] = {'tcp_flags': f'{rng.randint(0, 255):02x}', 'syn': True, 'fin': rng.random() > 0.5, 'ack': True, 'psh': rng.random() > 0.5}
+    elif event_type == 'alert':
+        event['alert'] = {
+            'action': rng.choice(['blocked', 'allowed']),
+            'signature_id': rng.randint(1, 3000000),
+            'rev': rng.randint(1, 5),
+            'signature': f'ET POLICY Suspicious outbound connection {rng.randint(1, 500)}',
+            'category': 'Potentially Bad Traffic',
+            'severity': rng.randint(1, 3)
+        }
+    else:
+        event['tls'] = {'sni': f'host{rng.randint(1, 200)}.example.com', 'version': 'TLS 1.3', 'subject': 'CN=example.com'}
+    return json.dumps({
+        'firewall_name': 'inspection-firewall',
+        'availability_zone': rng.choice(['us-east-1a', 'us-east-1b', 'us-east-1c']),
+        'event_timestamp': str(int(time.timestamp())),
+        'event': event
+    })
+
+def _gzip_lines(lines):
+    """
+    Compress lines into a gzip object body
+    """
+    return gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+def alb_log_file(lines, seed=0):
+    """
+    Build a gzip ALB access log file
+
+    Args:
+        lines (int): Number of log entries
+        seed (int): Random seed, the same seed gives the same file
+
+    Returns:
+        bytes: gzip object body
+    """
+    rng = random.Random(seed)
+    return _gzip_lines([alb_log_line(rng, index) for index in range(lines)])
+
+def nfw_log_file(lines, seed=0):
+    """
+    Build a gzip Network Firewall JSON lines file
+
+    Args:
+        lines (int): Number of log entries
+        seed (int): Random seed, the same seed gives the same file
+
+    Returns:
+        bytes: gzip object body
+    """
+    rng = random.Random(seed)
+    return _gzip_lines([nfw_log_line(rng, index) for index in range(lines)])
+
+def sysmon_description(rng, event_id):
+    """
+    Return the rendered Description text of a Sysmon event
+    """
+    utc_time = _timestamp(rng).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    guid = f'{{{rng.randint(0, 2 ** 32):08x}-1c2d-65e4-{rng.randint(0, 2 ** 16):04x}-000000002000}}'
+    image = rng.choice(SYSMON_IMAGES)
+    user = rng.choice(SYSMON_USERS)
+    pid = rng.randint(100, 20000)
+    if event_id == '1':
+        lines = ['Process Create:', 'RuleName: -', f'UtcTime: {utc_time}', f'ProcessGuid: {guid}', f'ProcessId: {pid}',
+                 f'Image: {image}', 'FileVersion: 10.0.19041.1', f'CommandLine: "{image}" -k netsvcs -p',
+                 'CurrentDirectory: C:\\Windows\\system32\\', f'User: {user}', 'IntegrityLevel: System',
+                 'Hashes: SHA256=' + '%064x' % rng.getrandbits(256), f'ParentProcessId: {rng.randint(100, 2000)}']
+    elif event_id == '3':
+        lines = ['Network connection detected:', 'RuleName: -', f'UtcTime: {utc_time}', f'ProcessGuid: {guid}',
+                 f'ProcessId: {pid}', f'Image: {image}', f'User: {user}', 'Protocol: tcp', f'SourceIp: {_ip(rng)}',
+                 f'DestinationIp: {_ip(rng, "52")}', 'DestinationPort: 443']
+    elif event_id == '5':
+        lines = ['Process terminated:', 'RuleName: -', f'UtcTime: {utc_time}', f'ProcessGuid: {guid}',
+                 f'ProcessId: {pid}', f'Image: {image}', f'User: {user}']
+    else:
+        action = 'File created:' if event_id == '11' else 'File Delete archived:'
+        lines = [action, 'RuleName: technique_id=T1574,technique_name=DLL Side-Loading', f'UtcTime: {utc_time}',
+                 f'ProcessGuid: {guid}', f'ProcessId: {pid}', f'Image: {image}',
+                 f'TargetFilename: C:\\Users\\alice\\AppData\\Local\\Temp\\{rng.randint(0, 10 ** 6)}.tmp',
+                 f'CreationUtcTime: {utc_time}', f'User: {user}']
+    return '\r\n'.join(lines)
+
+def kinesis_record(payload, sequence_number):
+    """
+    Wrap a payload into a Kinesis event source record
+    """
+    return {
+        'eventSource': 'aws:kinesis',
+        'eventID': f'shardId-000000000000:{sequence_number}',
+        'kinesis': {
+            'sequenceNumber': str(sequence_number),
+            'data': base64.b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+        }
+    }
+
+def sysmon_kinesis_records(count, seed=0, source_name='windows-sysmon', metadata_field='source'):
+    """
+    Build Kinesis records carrying Sysmon events the way the Kinesis agent sends them
+
+    Args:
+        count (int): Number of records
+        seed (int): Random seed, the same seed gives the same records
+        source_name (str): Value of the source metadata field
+        metadata_field (str): Payload field the source is detected from
+
+    Returns:
+        list: Kinesis event source records
+    """
+    rng = random.Random(seed)
+    records = []
+    for index in range(count):
+        event_id = rng.choice(SYSMON_EVENT_IDS)
+        payload = {
+            metadata_field: source_name,
+            'message': {
+                'EventId': event_id,
+                'source_instance_id': f'i-{rng.getrandbits(56):014x}',
+                'Description': sysmon_description(rng, event_id)
+            }
+        }
+        records.append(kinesis_record(payload, 49590338271490256608559692538361571095921575989136588802 + index))
+    return records
+
+def sqs_s3_record(bucket, key, message_id):
+    """
+    Build an SQS record carrying an S3 object created notification
+    """
+    return {
+        'eventSource': 'aws:sqs',
+        'messageId': message_id,
+        'body': json.dumps({
+            'Records': [{
+                'eventSource': 'aws:s3',
+                'eventName': 'ObjectCreated:Put',
+                's3': {'bucket': {'name': bucket}, 'object': {'key': key}}
+            }]
+        })
+    }
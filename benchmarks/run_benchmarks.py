@@ -0,0 +1,365 @@
+"""
+Transformation function benchmark module.
+This module drives process_s3_event, process_kinesis_event and lambda_handler
+end to end against an in-process S3 stand-in (moto) with seeded synthetic
+input, and reports records/sec, peak RSS and per-stage times for several
+object sizes and batch shapes. Every scenario runs in a fresh process so peak
+RSS and cold-start cost are measured per scenario.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import generators
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FUNCTION_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'transformation_function')
+
+# Bucket standing in for the Security Lake bucket
+LAKE_BUCKET = 'benchmark-security-lake'
+
+# ARN the handler derives the account and region partition values from
+FUNCTION_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:ocsf-transformation-benchmark'
+
+# Source and generator of each S3 scenario
+S3_SCENARIOS = {
+    'alb-s3': ('aws-alb', generators.alb_log_file),
+    'nfw-s3': ('aws-nfw', generators.nfw_log_file)
+}
+
+KINESIS_SCENARIOS = {
+    'sysmon-kinesis': 'windows-sysmon'
+}
+
+class BenchmarkContext:
+    """
+    Lambda context stand-in with a fixed amount of remaining time
+    """
+    invoked_function_arn = FUNCTION_ARN
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+class StageTimer:
+    """
+    Accumulate wall-clock time per named stage
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def measure(self, stage, function, *args):
+        """
+        Call function(*args), adding its duration to stage, and return its result
+        """
+        start = time.perf_counter()
+        result = function(*args)
+        self.stages[stage] = self.stages.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+def _peak_rss_mb():
+    """
+    Return the peak resident set size of this process in MiB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _s3_input_location(sources_config, source_name):
+    """
+    Return the (bucket, key prefix) an S3 source is routed from
+    """
+    for source in sources_config['sources']:
+        if source['name'] == source_name:
+            source_bucket = source['input_paths']['s3']['source_buckets'][0]
+            return source_bucket['bucket_name'], source_bucket['prefix'].rstrip('*')
+    raise ValueError(f"Source {source_name} has no S3 input path in sources_config.json")
+
+def _kinesis_metadata_field(sources_config, source_name):
+    """
+    Return the payload field a Kinesis source is detected from
+    """
+    for source in sources_config['sources']:
+        if source['name'] == source_name:
+            return source['input_paths']['kinesis'].get('metadata_field', 'source')
+    raise ValueError(f"Source {source_name} has no Kinesis input path in sources_config.json")
+
+def _import_app(function_dir, timer):
+    """
+    Import the transformation function the way Lambda does on a cold start
+    """
+    sys.path.insert(0, function_dir)
+    # Log records are still created at the function's level, but not printed
+    logging.getLogger().addHandler(logging.NullHandler())
+    return timer.measure('import', __import__, 'app')
+
+def _write_groups(app, mapped_events):
+    """
+    Group mapped events like lambda_handler and write each group
+    """
+    groups = {}
+    for mapped_event in mapped_events:
+        groups.setdefault(app.output_group_key(mapped_event), []).append(mapped_event)
+    region, account_id = FUNCTION_ARN.split(':')[3], FUNCTION_ARN.split(':')[4]
+    for (source, eventday, target_schema), group in groups.items():
+        app.write_group(source, eventday, group, region, account_id, target_schema)
+    return len(groups)
+
+def _s3_stages(app, s3_client, source_name, bucket, key, timer):
+    """
+    Run the stages of process_s3_event one at a time for one object
+    """
+    from stream_reader import iter_decompressed, iter_lines
+
+    body = timer.measure('fetch', lambda: s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    lines = timer.measure('decompress', lambda: list(iter_lines(iter_decompressed([body]))))
+    processed = timer.measure('preprocess', lambda: list(app.preprocess_lines(lines, source_name)))
+
+    def transform():
+        events = [processed_json for _, processed_json, error in processed if error is None]
+        eventdays = app.batch_eventdays(events, source_name)
+        mapped = []
+        for processed_json, eventday in zip(events, eventdays):
+            try:
+                mapped_event, _ = app.process_event(processed_json, source_name, eventday)
+            except Exception:
+                continue
+            if mapped_event:
+                mapped.append(mapped_event)
+        return mapped
+    mapped = timer.measure('transform', transform)
+    timer.measure('write', _write_groups, app, mapped)
+    return len(lines), len(mapped)
+
+def run_s3_scenario(spec):
+    """
+    Benchmark one S3 scenario in the current process
+
+    Args:
+        spec (dict): name, lines per object, objects per SQS batch, seed,
+            function_dir and env
+
+    Returns:
+        dict: Benchmark result
+    """
+    from moto import mock_aws
+
+    os.environ.update(spec['env'])
+    source_name, generate = S3_SCENARIOS[spec['name']]
+    with open(os.path.join(spec['function_dir'], 'sources_config.json')) as f:
+        sources_config = json.load(f)
+    input_bucket, prefix = _s3_input_location(sources_config, source_name)
+
+    with mock_aws():
+        import boto3
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=input_bucket)
+        s3_client.create_bucket(Bucket=LAKE_BUCKET)
+
+        records = []
+        input_bytes = 0
+        for index in range(spec['objects']):
+            key = f'{prefix}benchmark/{spec["lines"]}-{index}.log.gz'
+            body = generate(spec['lines'], seed=spec['seed'] + index)
+            input_bytes += len(body)
+            s3_client.put_object(Bucket=input_bucket, Key=key, Body=body)
+            records.append(generators.sqs_s3_record(input_bucket, key, f'benchmark-{index}'))
+
+        timer = StageTimer()
+        app = _import_app(spec['function_dir'], timer)
+        rss_after_import = _peak_rss_mb()
+
+        mapped_count = 0
+        for record in records:
+            key = json.loads(record['body'])['Records'][0]['s3']['object']['key']
+            _, mapped = _s3_stages(app, s3_client, source_name, input_bucket, key, timer)
+            mapped_count += mapped
+
+        for record in records:
+            timer.measure('process_s3_event', app.process_s3_event, record)
+        response = timer.measure('lambda_handler', app.lambda_handler, {'Records': records}, BenchmarkContext())
+
+    total_lines = spec['lines'] * spec['objects']
+    return {
+        'scenario': spec['name'],
+        'shape': f'{spec["objects"]} x {spec["lines"]} lines',
+        'records': total_lines,
+        'mapped': mapped_count,
+        'input_bytes': input_bytes,
+        'failed_items': len(response['batchItemFailures']) if response else 0,
+        'records_per_sec': total_lines / timer.stages['lambda_handler'],
+        'rss_after_import_mb': rss_after_import,
+        'peak_rss_mb': _peak_rss_mb(),
+        'stages': timer.stages
+    }
+
+def run_kinesis_scenario(spec):
+    """
+    Benchmark one Kinesis scenario in the current process
+
+    Args:
+        spec (dict): name, total records, batch_size, seed, function_dir and env
+
+    Returns:
+        dict: Benchmark result
+    """
+    from moto import mock_aws
+
+    os.environ.update(spec['env'])
+    source_name = KINESIS_SCENARIOS[spec['name']]
+    with open(os.path.join(spec['function_dir'], 'sources_config.json')) as f:
+        sources_config = json.load(f)
+    records = generators.sysmon_kinesis_records(
+        spec['records'], seed=spec['seed'], source_name=source_name,
+        metadata_field=_kinesis_metadata_field(sources_config, source_name)
+    )
+    batches = [records[start:start + spec['batch_size']] for start in range(0, len(records), spec['batch_size'])]
+
+    with mock_aws():
+        import boto3
+        boto3.client('s3').create_bucket(Bucket=LAKE_BUCKET)
+
+        timer = StageTimer()
+        app = _import_app(spec['function_dir'], timer)
+        rss_after_import = _peak_rss_mb()
+
+        mapped = []
+        for record in records:
+            mapped.extend(timer.measure('process_kinesis_event', app.process_kinesis_event, record)[0])
+        timer.measure('write', _write_groups, app, mapped)
+
+        failed_items = 0
+        for batch in batches:
+            response = timer.measure('lambda_handler', app.lambda_handler, {'Records': batch}, BenchmarkContext())
+            failed_items += len(response['batchItemFailures']) if response else 0
+
+    return {
+        'scenario': spec['name'],
+        'shape': f'{len(batches)} x {spec["batch_size"]} records',
+        'records': len(records),
+        'mapped': len(mapped),
+        'input_bytes': sum(len(record['kinesis']['data']) for record in records),
+        'failed_items': failed_items,
+        'records_per_sec': len(records) / timer.stages['lambda_handler'],
+        'rss_after_import_mb': rss_after_import,
+        'peak_rss_mb': _peak_rss_mb(),
+        'stages': timer.stages
+    }
+
+def run_scenario(spec):
+    """
+    Benchmark one scenario, dispatching on its name
+    """
+    if spec['name'] in S3_SCENARIOS:
+        return run_s3_scenario(spec)
+    return run_kinesis_scenario(spec)
+
+def run_isolated(spec):
+    """
+    Run a scenario in a freshly spawned process
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_scenario, spec).result()
+
+def build_specs(args):
+    """
+    Expand the command line options into scenario specs
+    """
+    env = dict(item.split('=', 1) for item in args.env)
+    env.setdefault('SEC_LAKE_BUCKET', LAKE_BUCKET)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+    specs = []
+    for name in args.scenarios:
+        common = {'name': name, 'seed': args.seed, 'function_dir': args.function_dir, 'env': env}
+        if name in S3_SCENARIOS:
+            for lines in args.lines:
+                for objects in args.objects:
+                    specs.append({**common, 'lines': lines, 'objects': objects})
+        else:
+            for batch_size in args.kinesis_batch_sizes:
+                specs.append({**common, 'records': args.kinesis_records, 'batch_size': batch_size})
+    return specs
+
+def format_result(result):
+    """
+    Format a benchmark result as one report line
+    """
+    stages = ' '.join(f'{stage}={seconds * 1000:.0f}ms' for stage, seconds in result['stages'].items())
+    return (f"{result['scenario']:<15} {result['shape']:<24} {result['records_per_sec']:>12,.0f} rec/s "
+            f"{result['peak_rss_mb']:>8.1f} MiB peak  {stages}")
+
+def compare_results(results, baseline_path, tolerance):
+    """
+    Return the results whose records/sec dropped more than tolerance below the baseline
+    """
+    with open(baseline_path) as f:
+        baseline = {(result['scenario'], result['shape']): result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['scenario'], result['shape']))
+        if previous and result['records_per_sec'] < previous['records_per_sec'] * (1 - tolerance):
+            regressions.append((result, previous))
+    return regressions
+
+def _int_list(value):
+    """
+    Parse a comma-separated list of integers
+    """
+    return [int(item) for item in value.split(',') if item]
+
+def main():
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the OCSF transformation function with synthetic input')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=list(S3_SCENARIOS) + list(KINESIS_SCENARIOS),
+                        help='Scenario to run, can be repeated (default all)')
+    parser.add_argument('--lines', type=_int_list, default=[1000, 10000, 100000],
+                        help='Comma-separated lines per S3 object (default 1000,10000,100000)')
+    parser.add_argument('--objects', type=_int_list, default=[1, 10],
+                        help='Comma-separated S3 objects per SQS batch (default 1,10)')
+    parser.add_argument('--kinesis-records', type=int, default=10000,
+                        help='Kinesis records per scenario (default 10000)')
+    parser.add_argument('--kinesis-batch-sizes', type=_int_list, default=[100, 1000],
+                        help='Comma-separated Kinesis batch sizes (default 100,1000)')
+    parser.add_argument('--seed', type=int, default=0, help='Generator seed (default 0)')
+    parser.add_argument('--env', action='append', default=[],
+                        help='Function environment variable as KEY=VALUE, e.g. TRANSFORM_MODE=columnar')
+    parser.add_argument('--function-dir', default=DEFAULT_FUNCTION_DIR, help='Transformation function directory')
+    parser.add_argument('--json', dest='json_path', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Baseline JSON file from an earlier --json run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed records/sec drop against the baseline (default 0.2)')
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(S3_SCENARIOS) + list(KINESIS_SCENARIOS)
+    args.function_dir = os.path.abspath(args.function_dir)
+
+    results = []
+    for spec in build_specs(args):
+        result = run_isolated(spec)
+        print(format_result(result), flush=True)
+        results.append(result)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        regressions = compare_results(results, args.compare, args.tolerance)
+        for result, previous in regressions:
+            print(f"Regression in {result['scenario']} {result['shape']}: "
+                  f"{result['records_per_sec']:,.0f} rec/s against {previous['records_per_sec']:,.0f} rec/s")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 import os
 import aws_cdk as cdk
 from ocsf_transformation.ocsf_transformation_stack import OcsfTransformationStack
+from ocsf_transformation.sizing import ThroughputProfile
 
 app = cdk.App()
 
@@ -10,6 +11,7 @@ log_event_source = app.node.try_get_context("log_event_source") or os.environ.ge
 asl_bucket_location = app.node.try_get_context("asl_bucket_location") or os.environ.get("ASL_BUCKET_LOCATION")
 raw_log_s3_bucket_name = app.node.try_get_context("raw_log_s3_bucket_name") or os.environ.get("RAW_LOG_S3_BUCKET_NAME", "")
 add_s3_event_notification = app.node.try_get_context("add_s3_event_notification") or os.environ.get("ADD_S3_EVENT_NOTIFICATION", False)
+enable_compaction = str(app.node.try_get_context("enable_compaction") or os.environ.get("ENABLE_COMPACTION", "false")).lower() == "true"
 
 # Parse list parameters (comma-separated strings)
 kinesis_user_arns_str = app.node.try_get_context("kinesis_user_arns") or os.environ.get("KINESIS_USER_ARNS", "")
@@ -18,6 +20,17 @@ kinesis_user_arns = [arn.strip() for arn in kinesis_user_arns_str.split(",")] if
 kinesis_encryption_key_admin_arns_str = app.node.try_get_context("kinesis_encryption_key_admin_arns") or os.environ.get("KINESIS_ENCRYPTION_KEY_ADMIN_ARNS", "")
 kinesis_encryption_key_admin_arns = [arn.strip() for arn in kinesis_encryption_key_admin_arns_str.split(",")] if kinesis_encryption_key_admin_arns_str else []
 
+# Optional throughput profile, the stack keeps its lab-scale sizing without one
+events_per_second = app.node.try_get_context("throughput_events_per_second") or os.environ.get("THROUGHPUT_EVENTS_PER_SECOND")
+throughput_profile = None
+if events_per_second:
+    throughput_profile = ThroughputProfile(
+        events_per_second,
+        average_object_size_mb=app.node.try_get_context("throughput_object_size_mb") or os.environ.get("THROUGHPUT_OBJECT_SIZE_MB", 5),
+        latency_target_seconds=app.node.try_get_context("throughput_latency_seconds") or os.environ.get("THROUGHPUT_LATENCY_SECONDS", 60),
+        average_event_bytes=app.node.try_get_context("throughput_event_bytes") or os.environ.get("THROUGHPUT_EVENT_BYTES", 500)
+    )
+
 # Get the stack name from context or use default
 # This allows updating an existing stack by providing its name
 stack_name = (
@@ -37,6 +50,8 @@ OcsfTransformationStack(
     kinesis_user_arns=kinesis_user_arns,
     kinesis_encryption_key_admin_arns=kinesis_encryption_key_admin_arns,
     add_s3_event_notification=add_s3_event_notification,
+    enable_compaction=enable_compaction,
+    throughput_profile=throughput_profile,
     env=cdk.Environment(
         account=os.environ.get("CDK_DEFAULT_ACCOUNT"), 
         region=os.environ.get("CDK_DEFAULT_REGION")
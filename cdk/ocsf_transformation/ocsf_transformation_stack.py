@@ -1,3 +1,9 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import jsii
 from aws_cdk import (
     Stack,
     aws_s3 as s3,
@@ -8,13 +14,78 @@ from aws_cdk import (
     aws_kms as kms,
     aws_s3_notifications as s3n,
     aws_lambda_event_sources as lambda_event_sources,
+    aws_events as events,
+    aws_events_targets as events_targets,
     Duration,
+    Size,
     RemovalPolicy,
     CfnOutput,
     CfnResource,
+    AssetHashType,
+    BundlingOptions,
+    ILocalBundling,
 )
 from constructs import Construct
 from aws_cdk import CfnDeletionPolicy
+from ocsf_transformation.sizing import size_for_throughput
+
+# Deliveries of an S3 notification before it is moved to the dead-letter queue
+SQS_MAX_RECEIVE_COUNT = 5
+
+# Retries of a failing Kinesis batch before its records are sent to the failure queue
+KINESIS_RETRY_ATTEMPTS = 5
+
+# How long undeliverable notifications and Kinesis failure records are kept
+FAILURE_RETENTION = Duration.days(14)
+
+# Function code, bundled with the packages in its requirements.txt that the AWSSDKPandas layer lacks
+FUNCTION_DIR = "../transformation_function/"
+
+# Platform of the wheels installed into the function code, matching the runtime and architecture
+FUNCTION_PLATFORM = ["--platform", "manylinux2014_x86_64", "--only-binary=:all:",
+                     "--python-version", "3.10", "--implementation", "cp"]
+
+@jsii.implements(ILocalBundling)
+class _LocalPipBundling:
+    """
+    Bundle the function code with the local pip, falling back to Docker if that fails
+    """
+    def try_bundle(self, output_dir, *, image, **kwargs):
+        try:
+            shutil.copytree(FUNCTION_DIR, output_dir, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+            subprocess.run(
+                [sys.executable, "-m", "pip", "install", "--quiet", "-r", os.path.join(FUNCTION_DIR, "requirements.txt"),
+                 "--target", output_dir, *FUNCTION_PLATFORM],
+                check=True
+            )
+            return True
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Local bundling of the function code failed, bundling in Docker: {e}", file=sys.stderr)
+            return False
+
+
+def _function_code():
+    """
+    Return the function code asset with its requirements installed
+    """
+    return lambda_.Code.from_asset(
+        FUNCTION_DIR,
+        # Hash the sources so unchanged code isn't redeployed when a wheel is rebuilt
+        asset_hash_type=AssetHashType.SOURCE,
+        bundling=BundlingOptions(
+            image=lambda_.Runtime.PYTHON_3_10.bundling_image,
+            command=["bash", "-c", "pip install -r requirements.txt -t /asset-output && cp -au . /asset-output"],
+            local=_LocalPipBundling()
+        )
+    )
+
+
+def _seconds(seconds):
+    """
+    Return a Duration for an optional number of seconds
+    """
+    return Duration.seconds(seconds) if seconds else None
 
 
 class OcsfTransformationStack(Stack):
@@ -26,6 +97,8 @@ class OcsfTransformationStack(Stack):
         kinesis_user_arns = kwargs.pop("kinesis_user_arns", [])
         kinesis_encryption_key_admin_arns = kwargs.pop("kinesis_encryption_key_admin_arns", [])
         add_s3_event_notification = kwargs.pop("add_s3_event_notification", False)
+        enable_compaction = kwargs.pop("enable_compaction", False)
+        throughput_profile = kwargs.pop("throughput_profile", None)
 
         super().__init__(scope, construct_id, **kwargs)
 
@@ -35,6 +108,9 @@ class OcsfTransformationStack(Stack):
         create_kinesis_agent_role = is_kinesis_backed and len(kinesis_user_arns) > 0
         create_staging_s3_bucket = is_s3_backed and not raw_log_s3_bucket_name
 
+        # Derive memory, timeout, concurrency, batching and shard count from the expected load
+        sizing = size_for_throughput(throughput_profile, is_s3_backed, is_kinesis_backed)
+
         # Create a single transformation Lambda execution role with all permissions
         # Always use the unified role ID regardless of deployment type
         transformation_lambda_role = iam.Role(
@@ -123,10 +199,21 @@ class OcsfTransformationStack(Stack):
 
         # S3-specific resources
         if is_s3_backed:
+            # Notifications that keep failing are moved aside instead of being retried forever
+            sqs_dead_letter_queue = sqs.Queue(
+                self, "SqsDeadLetterQueue",
+                retention_period=FAILURE_RETENTION
+            )
+            (sqs_dead_letter_queue.node.default_child).override_logical_id("SqsDeadLetterQueue")
+
             # Create SQS queue
             sqs_queue = sqs.Queue(
                 self, "SqsQueue",
-                visibility_timeout=Duration.seconds(1200)
+                visibility_timeout=Duration.seconds(sizing.sqs_visibility_timeout_seconds),
+                dead_letter_queue=sqs.DeadLetterQueue(
+                    max_receive_count=SQS_MAX_RECEIVE_COUNT,
+                    queue=sqs_dead_letter_queue
+                )
             )
             
             # Ensure SQS queue has the same logical ID as in the SAM template
@@ -256,7 +343,7 @@ class OcsfTransformationStack(Stack):
                 # Create Kinesis stream with AWS managed key
                 log_collection_stream = kinesis.Stream(
                     self, "LogCollectionStream",
-                    shard_count=1,
+                    shard_count=sizing.shard_count,
                     encryption=kinesis.StreamEncryption.MANAGED
                 )
                 # Use the same logical ID as in the SAM template
@@ -312,7 +399,7 @@ class OcsfTransformationStack(Stack):
                 # Create encrypted Kinesis stream with custom key
                 log_collection_stream = kinesis.Stream(
                     self, "CMKEncryptedLogCollectionStream",
-                    shard_count=1,
+                    shard_count=sizing.shard_count,
                     encryption=kinesis.StreamEncryption.KMS,
                     encryption_key=kinesis_stream_key
                 )
@@ -325,11 +412,12 @@ class OcsfTransformationStack(Stack):
             self, "TransformationLambdaFunction",
             runtime=lambda_.Runtime.PYTHON_3_10,
             handler="app.lambda_handler",
-            code=lambda_.Code.from_asset("../transformation_function/"),
+            code=_function_code(),
             role=transformation_lambda_role,
             tracing=lambda_.Tracing.ACTIVE,
-            reserved_concurrent_executions=10,
-            timeout=Duration.seconds(10),
+            reserved_concurrent_executions=sizing.reserved_concurrency,
+            memory_size=sizing.memory_size,
+            timeout=Duration.seconds(sizing.timeout_seconds),
             environment={
                 "SEC_LAKE_BUCKET": asl_bucket_location,
                 "DEBUG": "false"
@@ -349,18 +437,111 @@ class OcsfTransformationStack(Stack):
         if is_s3_backed:
             lambda_event_source = lambda_event_sources.SqsEventSource(
                 sqs_queue,
-                batch_size=10
+                batch_size=sizing.sqs_batch_size,
+                max_batching_window=_seconds(sizing.sqs_max_batching_window),
+                max_concurrency=sizing.sqs_max_concurrency,
+                report_batch_item_failures=True
             )
             lambda_function.add_event_source(lambda_event_source)
 
         if is_kinesis_backed:
-            lambda_event_source = lambda_event_sources.KinesisEventSource(
-                log_collection_stream,
-                batch_size=100,
-                starting_position=lambda_.StartingPosition.LATEST
+            # Records of a batch that still fails after its retries are described here, so the shard moves on
+            kinesis_failure_queue = sqs.Queue(
+                self, "KinesisFailureQueue",
+                retention_period=FAILURE_RETENTION
             )
+            (kinesis_failure_queue.node.default_child).override_logical_id("KinesisFailureQueue")
+
+            if sizing.enhanced_fan_out:
+                # A dedicated consumer pushes records as they arrive instead of once a second
+                stream_consumer = kinesis.StreamConsumer(
+                    self, "LogCollectionStreamConsumer",
+                    stream=log_collection_stream,
+                    stream_consumer_name=f"{self.stack_name.lower()}-transformation"
+                )
+                lambda_event_source = lambda_event_sources.KinesisConsumerEventSource(
+                    stream_consumer,
+                    batch_size=sizing.kinesis_batch_size,
+                    parallelization_factor=sizing.parallelization_factor,
+                    starting_position=lambda_.StartingPosition.LATEST,
+                    report_batch_item_failures=True,
+                    bisect_batch_on_error=True,
+                    retry_attempts=KINESIS_RETRY_ATTEMPTS,
+                    on_failure=lambda_event_sources.SqsDlq(kinesis_failure_queue)
+                )
+            else:
+                lambda_event_source = lambda_event_sources.KinesisEventSource(
+                    log_collection_stream,
+                    batch_size=sizing.kinesis_batch_size,
+                    max_batching_window=_seconds(sizing.kinesis_max_batching_window),
+                    parallelization_factor=sizing.parallelization_factor,
+                    starting_position=lambda_.StartingPosition.LATEST,
+                    report_batch_item_failures=True,
+                    bisect_batch_on_error=True,
+                    retry_attempts=KINESIS_RETRY_ATTEMPTS,
+                    on_failure=lambda_event_sources.SqsDlq(kinesis_failure_queue)
+                )
             lambda_function.add_event_source(lambda_event_source)
 
+        # Optional daily compaction of the small files written to the ext/ partitions
+        if enable_compaction:
+            compaction_lambda_role = iam.Role(
+                self, "CompactionLambdaExecutionRole",
+                assumed_by=iam.ServicePrincipal("lambda.amazonaws.com"),
+                managed_policies=[
+                    iam.ManagedPolicy.from_aws_managed_policy_name("service-role/AWSLambdaBasicExecutionRole")
+                ]
+            )
+
+            compaction_lambda_role.add_to_policy(
+                iam.PolicyStatement(
+                    sid="S3ListPartitions",
+                    effect=iam.Effect.ALLOW,
+                    actions=["s3:ListBucket"],
+                    resources=[f"arn:aws:s3:::{asl_bucket_location}"],
+                    conditions={"StringLike": {"s3:prefix": ["ext/*"]}}
+                )
+            )
+
+            compaction_lambda_role.add_to_policy(
+                iam.PolicyStatement(
+                    sid="S3CompactPartitions",
+                    effect=iam.Effect.ALLOW,
+                    actions=["s3:GetObject", "s3:PutObject", "s3:DeleteObject"],
+                    resources=[f"arn:aws:s3:::{asl_bucket_location}/ext/*"]
+                )
+            )
+
+            compaction_function = lambda_.Function(
+                self, "CompactionLambdaFunction",
+                runtime=lambda_.Runtime.PYTHON_3_10,
+                handler="compaction.compaction_handler",
+                code=_function_code(),
+                role=compaction_lambda_role,
+                memory_size=1024,
+                # Each bin is downloaded whole to /tmp along with its output,
+                # about twice COMPACTION_TARGET_FILE_BYTES
+                ephemeral_storage_size=Size.mebibytes(2048),
+                timeout=Duration.minutes(15),
+                environment={
+                    "SEC_LAKE_BUCKET": asl_bucket_location,
+                    "DEBUG": "false"
+                },
+                layers=[
+                    lambda_.LayerVersion.from_layer_version_arn(
+                        self, "CompactionAWSSDKPandasLayer",
+                        f"arn:aws:lambda:{self.region}:336392948345:layer:AWSSDKPandas-Python310:5"
+                    )
+                ]
+            )
+
+            # Compact the previous day once no more files are written to it
+            events.Rule(
+                self, "CompactionSchedule",
+                schedule=events.Schedule.cron(minute="30", hour="1"),
+                targets=[events_targets.LambdaFunction(compaction_function)]
+            )
+
         # Define outputs - use a unified output name for the Lambda function
         CfnOutput(
             self, "TransformationLambdaFunctionARN",
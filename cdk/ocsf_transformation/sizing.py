@@ -0,0 +1,284 @@
+"""
+Throughput sizing module.
+This module derives the transformation Lambda function and event source
+settings of the stack from a throughput profile: the expected events per
+second, the average size of the raw log objects and the latency target.
+Without a profile the stack keeps its lab-scale defaults.
+
+The estimates are deliberately conservative and are based on the numbers
+reported by benchmarks/run_benchmarks.py; measure the deployed function and
+adjust the profile if it runs hot or idle.
+"""
+import math
+
+# Lambda allocates one full vCPU at this memory size
+FULL_VCPU_MEMORY_MB = 1769
+
+# Lambda memory limits and the step used when rounding memory up
+MIN_MEMORY_MB = 512
+MAX_MEMORY_MB = 10240
+MEMORY_STEP_MB = 64
+
+# Lambda timeout limits
+MIN_TIMEOUT_SECONDS = 10
+MAX_TIMEOUT_SECONDS = 900
+
+# Largest synchronous invocation payload, which bounds a Kinesis batch
+MAX_PAYLOAD_BYTES = 6 * 1024 * 1024
+
+# Largest batching window and batch size of an event source mapping
+MAX_BATCHING_WINDOW_SECONDS = 300
+MAX_BATCH_SIZE = 10000
+
+# Largest SQS batch without a batching window
+MAX_SQS_BATCH_WITHOUT_WINDOW = 10
+
+# Largest number of concurrent batches per Kinesis shard
+MAX_PARALLELIZATION_FACTOR = 10
+
+# Kinesis shard write limits, and the share of them the stream is sized to use
+SHARD_WRITE_BYTES_PER_SECOND = 1024 * 1024
+SHARD_WRITE_RECORDS_PER_SECOND = 1000
+SHARD_TARGET_UTILIZATION = 0.8
+
+# Events one vCPU decodes, maps and writes per second, below the benchmark results
+EVENTS_PER_VCPU_SECOND = 5000
+
+# Memory of the runtime with pyarrow loaded, and peak memory per MB of raw log data held
+BASE_MEMORY_MB = 256
+MEMORY_MB_PER_RAW_MB = 20
+
+# Raw size of a MB of gzip-compressed log objects
+GZIP_RATIO = 8
+
+# Share of the latency target spent waiting for a batch to fill
+BATCHING_LATENCY_SHARE = 0.25
+
+# Lambda polls each shard about once a second without enhanced fan-out
+SHARD_POLL_INTERVAL_SECONDS = 1
+
+# Concurrency headroom over the estimated steady state
+CONCURRENCY_HEADROOM = 1.5
+
+# Limits of the maximum concurrency of an SQS event source
+MIN_SQS_CONCURRENCY = 2
+MAX_SQS_CONCURRENCY = 1000
+
+class ThroughputProfile:
+    """
+    Expected load of the transformation function
+
+    Args:
+        events_per_second (float): Expected events per second at peak
+        average_object_size_mb (float): Average size of the gzip-compressed raw log objects
+        latency_target_seconds (float): Longest acceptable delay from ingestion to write
+        average_event_bytes (int): Average size of a raw event
+    """
+    __slots__ = ('events_per_second', 'average_object_size_mb', 'latency_target_seconds', 'average_event_bytes')
+
+    def __init__(self, events_per_second, average_object_size_mb=5, latency_target_seconds=60, average_event_bytes=500):
+        self.events_per_second = float(events_per_second)
+        self.average_object_size_mb = float(average_object_size_mb)
+        self.latency_target_seconds = float(latency_target_seconds)
+        self.average_event_bytes = int(average_event_bytes)
+        for name in self.__slots__:
+            if getattr(self, name) <= 0:
+                raise ValueError(f"Throughput profile setting {name} must be positive")
+
+class ThroughputSizing:
+    """
+    Settings of the transformation function, its event sources and the Kinesis stream
+
+    Batching windows are in seconds, with None for no window. memory_size is
+    None for the Lambda default.
+    """
+    __slots__ = ('memory_size', 'timeout_seconds', 'reserved_concurrency', 'sqs_batch_size',
+                 'sqs_max_batching_window', 'sqs_max_concurrency', 'sqs_visibility_timeout_seconds',
+                 'kinesis_batch_size', 'kinesis_max_batching_window', 'parallelization_factor',
+                 'shard_count', 'enhanced_fan_out')
+
+    def __init__(self, memory_size=None, timeout_seconds=10, reserved_concurrency=10, sqs_batch_size=10,
+                 sqs_max_batching_window=None, sqs_max_concurrency=None, sqs_visibility_timeout_seconds=1200,
+                 kinesis_batch_size=100, kinesis_max_batching_window=None, parallelization_factor=None,
+                 shard_count=1, enhanced_fan_out=False):
+        self.memory_size = memory_size
+        self.timeout_seconds = timeout_seconds
+        self.reserved_concurrency = reserved_concurrency
+        self.sqs_batch_size = sqs_batch_size
+        self.sqs_max_batching_window = sqs_max_batching_window
+        self.sqs_max_concurrency = sqs_max_concurrency
+        self.sqs_visibility_timeout_seconds = sqs_visibility_timeout_seconds
+        self.kinesis_batch_size = kinesis_batch_size
+        self.kinesis_max_batching_window = kinesis_max_batching_window
+        self.parallelization_factor = parallelization_factor
+        self.shard_count = shard_count
+        self.enhanced_fan_out = enhanced_fan_out
+
+    def as_dict(self):
+        """
+        Return the settings as a dict, for logging and stack outputs
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+def _round_memory(memory_mb):
+    """
+    Round a memory estimate up to the memory step, within the Lambda limits
+    """
+    return _clamp(int(math.ceil(memory_mb / MEMORY_STEP_MB)) * MEMORY_STEP_MB, MIN_MEMORY_MB, MAX_MEMORY_MB)
+
+def _events_per_second(memory_mb):
+    """
+    Events one invocation processes per second at a memory size
+
+    With the default TRANSFORM_WORKERS of 1 the events of an invocation are
+    mapped by one Python process, whose fetch threads share one vCPU, so
+    memory beyond a full vCPU only adds headroom. Sharding large objects over
+    more worker processes is opt-in and not assumed here.
+    """
+    return EVENTS_PER_VCPU_SECOND * min(1.0, memory_mb / FULL_VCPU_MEMORY_MB)
+
+def _timeout(processing_seconds):
+    """
+    Timeout covering three times the expected processing time plus fetch and write overhead
+    """
+    return int(_clamp(math.ceil(3 * processing_seconds + 10), MIN_TIMEOUT_SECONDS, MAX_TIMEOUT_SECONDS))
+
+def _batching_window(profile):
+    """
+    Batching window that fits in the latency target, None if there is no room for one
+    """
+    window = int(min(MAX_BATCHING_WINDOW_SECONDS, profile.latency_target_seconds * BATCHING_LATENCY_SHARE))
+    return window if window >= 1 else None
+
+def size_sqs_path(profile):
+    """
+    Size the S3 notification path, where each SQS message names one raw log object
+
+    Returns:
+        dict: memory_size, timeout_seconds, concurrency, batch_size,
+        max_batching_window and visibility_timeout_seconds
+    """
+    object_raw_mb = profile.average_object_size_mb * GZIP_RATIO
+    events_per_object = object_raw_mb * 1024 * 1024 / profile.average_event_bytes
+    objects_per_second = profile.events_per_second / events_per_object
+    window = _batching_window(profile)
+
+    # Objects of a batch are held together until their events are written
+    memory_cap = max(1, int((MAX_MEMORY_MB - BASE_MEMORY_MB) / (object_raw_mb * MEMORY_MB_PER_RAW_MB)))
+    # A batch has to be processed within half the latency target on a full vCPU
+    time_cap = max(1, int(EVENTS_PER_VCPU_SECOND * profile.latency_target_seconds / 2 / events_per_object))
+    if window is None:
+        wanted = MAX_SQS_BATCH_WITHOUT_WINDOW
+    else:
+        wanted = max(MAX_SQS_BATCH_WITHOUT_WINDOW, int(objects_per_second * window))
+    batch_size = int(_clamp(min(wanted, memory_cap, time_cap), 1, MAX_BATCH_SIZE))
+    if batch_size == 1:
+        # There is nothing to wait for when each object is processed on its own
+        window = None
+
+    memory_size = _round_memory(BASE_MEMORY_MB + batch_size * object_raw_mb * MEMORY_MB_PER_RAW_MB)
+    processing_seconds = batch_size * events_per_object / _events_per_second(memory_size)
+    timeout_seconds = _timeout(processing_seconds)
+    concurrency = int(_clamp(math.ceil(objects_per_second / batch_size * processing_seconds * CONCURRENCY_HEADROOM),
+                             MIN_SQS_CONCURRENCY, MAX_SQS_CONCURRENCY))
+    return {
+        'memory_size': memory_size,
+        'timeout_seconds': timeout_seconds,
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'max_batching_window': window,
+        # Visibility timeout of six times the function timeout, as recommended for SQS event sources
+        'visibility_timeout_seconds': max(1200, 6 * timeout_seconds)
+    }
+
+def size_kinesis_path(profile):
+    """
+    Size the Kinesis path, where each record holds one event
+
+    Returns:
+        dict: memory_size, timeout_seconds, concurrency, batch_size,
+        max_batching_window, parallelization_factor, shard_count and enhanced_fan_out
+    """
+    event_bytes = profile.average_event_bytes
+    shard_count = max(1, int(math.ceil(max(
+        profile.events_per_second * event_bytes / SHARD_WRITE_BYTES_PER_SECOND,
+        profile.events_per_second / SHARD_WRITE_RECORDS_PER_SECOND) / SHARD_TARGET_UTILIZATION)))
+    # A latency target below the polling interval needs a dedicated push connection per shard
+    enhanced_fan_out = profile.latency_target_seconds <= SHARD_POLL_INTERVAL_SECONDS
+    window = None if enhanced_fan_out else _batching_window(profile)
+
+    # Records arrive base64 encoded in the invocation payload
+    payload_cap = int(MAX_PAYLOAD_BYTES / (event_bytes * 4 / 3))
+    events_per_shard = profile.events_per_second / shard_count
+    wanted = events_per_shard * (window or SHARD_POLL_INTERVAL_SECONDS)
+    batch_size = int(_clamp(min(wanted, payload_cap), 1, MAX_BATCH_SIZE))
+    batch_size = max(batch_size, min(100, payload_cap))
+
+    memory_size = _round_memory(BASE_MEMORY_MB + batch_size * event_bytes / (1024 * 1024) * MEMORY_MB_PER_RAW_MB)
+    # Below a full vCPU a busy shard gets more memory before it gets more concurrent batches
+    if events_per_shard > _events_per_second(memory_size):
+        memory_size = _round_memory(max(memory_size, FULL_VCPU_MEMORY_MB))
+    invocation_rate = _events_per_second(memory_size)
+
+    parallelization_factor = int(math.ceil(events_per_shard * CONCURRENCY_HEADROOM / invocation_rate))
+    if parallelization_factor > MAX_PARALLELIZATION_FACTOR:
+        # Shards are added once each one runs the most concurrent batches Lambda allows
+        shard_count = int(math.ceil(profile.events_per_second * CONCURRENCY_HEADROOM
+                                    / (MAX_PARALLELIZATION_FACTOR * invocation_rate)))
+        parallelization_factor = MAX_PARALLELIZATION_FACTOR
+    parallelization_factor = max(1, parallelization_factor)
+
+    return {
+        'memory_size': memory_size,
+        'timeout_seconds': _timeout(batch_size / invocation_rate),
+        'concurrency': shard_count * parallelization_factor,
+        'batch_size': batch_size,
+        'max_batching_window': window,
+        'parallelization_factor': parallelization_factor,
+        'shard_count': shard_count,
+        'enhanced_fan_out': enhanced_fan_out
+    }
+
+def size_for_throughput(profile, s3_backed=True, kinesis_backed=True):
+    """
+    Derive the stack settings for a throughput profile
+
+    Both paths share one function, so it gets the larger memory and timeout
+    of the two and enough reserved concurrency for both.
+
+    Args:
+        profile (ThroughputProfile): Expected load, None for the lab-scale defaults
+        s3_backed (bool): The S3 notification path is deployed
+        kinesis_backed (bool): The Kinesis path is deployed
+
+    Returns:
+        ThroughputSizing: Derived settings
+    """
+    sizing = ThroughputSizing()
+    if profile is None:
+        return sizing
+
+    paths = []
+    if s3_backed:
+        sqs_path = size_sqs_path(profile)
+        paths.append(sqs_path)
+        sizing.sqs_batch_size = sqs_path['batch_size']
+        sizing.sqs_max_batching_window = sqs_path['max_batching_window']
+        sizing.sqs_max_concurrency = sqs_path['concurrency']
+        sizing.sqs_visibility_timeout_seconds = sqs_path['visibility_timeout_seconds']
+    if kinesis_backed:
+        kinesis_path = size_kinesis_path(profile)
+        paths.append(kinesis_path)
+        sizing.kinesis_batch_size = kinesis_path['batch_size']
+        sizing.kinesis_max_batching_window = kinesis_path['max_batching_window']
+        sizing.parallelization_factor = kinesis_path['parallelization_factor']
+        sizing.shard_count = kinesis_path['shard_count']
+        sizing.enhanced_fan_out = kinesis_path['enhanced_fan_out']
+    if paths:
+        sizing.memory_size = max(path['memory_size'] for path in paths)
+        sizing.timeout_seconds = max(path['timeout_seconds'] for path in paths)
+        sizing.reserved_concurrency = sum(path['concurrency'] for path in paths)
+    return sizing
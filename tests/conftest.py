@@ -0,0 +1,74 @@
+"""
+Shared fixtures for the transformation function tests.
+The handler runs end to end against moto's in-memory S3, with the
+benchmark generators providing the input records.
+"""
+import io
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('transformation_function', 'benchmarks'):
+    sys.path.insert(0, os.path.join(ROOT_DIR, directory))
+# Appended, so the CDK's app.py doesn't shadow the handler's
+sys.path.append(os.path.join(ROOT_DIR, 'cdk'))
+
+# The handler reads its settings on import
+os.environ.setdefault('SEC_LAKE_BUCKET', 'test-security-lake')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+# Bucket the shipped sources_config.json routes S3 notifications from
+STAGING_BUCKET = 'ocsf-transform-infrastructure-s3-staging-log-bucket'
+
+class LambdaContext:
+    """
+    Minimal Lambda context with plenty of time left
+    """
+    invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:ocsf-transformation'
+
+    def get_remaining_time_in_millis(self):
+        return 600000
+
+@pytest.fixture
+def s3():
+    """
+    Yield a moto S3 client with the staging and Security Lake buckets created
+    """
+    from moto import mock_aws
+    import boto3
+    import app
+
+    with mock_aws():
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=STAGING_BUCKET)
+        client.create_bucket(Bucket=app.SEC_LAKE_BUCKET)
+        # The handler caches its client, which has to be created inside the mock
+        app.s3_client = None
+        yield client
+        app.s3_client = None
+
+@pytest.fixture
+def context():
+    return LambdaContext()
+
+@pytest.fixture
+def lake_rows(s3):
+    """
+    Return a function counting the rows written to ext/, per eventDay
+    """
+    import app
+    import pyarrow.parquet as pq
+
+    def count():
+        rows = {}
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=app.SEC_LAKE_BUCKET):
+            for obj in page.get('Contents', []):
+                body = s3.get_object(Bucket=app.SEC_LAKE_BUCKET, Key=obj['Key'])['Body'].read()
+                eventday = obj['Key'].split('eventDay=')[1].split('/')[0]
+                rows[eventday] = rows.get(eventday, 0) + pq.read_metadata(io.BytesIO(body)).num_rows
+        return rows
+    return count
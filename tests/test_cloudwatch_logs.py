@@ -0,0 +1,112 @@
+"""
+Tests of CloudWatch Logs subscription payloads arriving through lambda_handler
+"""
+import base64
+import copy
+import gzip
+import json
+import random
+
+import generators
+import pytest
+
+import app
+from routing import SourceRouter
+
+LOG_GROUP = '/aws/network-firewall/flow'
+
+@pytest.fixture(autouse=True)
+def log_group_routing(monkeypatch):
+    """
+    Route the Network Firewall log groups to aws-nfw, as a subscription filter deployment would
+    """
+    sources_config = copy.deepcopy(app.sources_config)
+    for source in sources_config['sources']:
+        if source['name'] == 'aws-nfw':
+            source['input_paths']['kinesis'] = {'enabled': True, 'log_groups': ['/aws/network-firewall/*']}
+    monkeypatch.setattr(app, 'source_router', SourceRouter(sources_config))
+
+@pytest.fixture
+def processed(monkeypatch):
+    """
+    Collect the (mapped, unmapped) events of every Kinesis record the handler processes
+    """
+    results = []
+    process_kinesis_event = app.process_kinesis_event
+
+    def recording(record):
+        result = process_kinesis_event(record)
+        results.append(result)
+        return result
+
+    monkeypatch.setattr(app, 'process_kinesis_event', recording)
+    return results
+
+def subscription_record(messages, log_group=LOG_GROUP, message_type='DATA_MESSAGE', sequence_number=1):
+    """
+    Build a Kinesis record carrying a gzip subscription envelope
+    """
+    envelope = {
+        'messageType': message_type,
+        'owner': '123456789012',
+        'logGroup': log_group,
+        'logStream': 'stream',
+        'subscriptionFilters': ['ocsf'],
+        'logEvents': [{'id': str(index), 'timestamp': 0, 'message': message} for index, message in enumerate(messages)]
+    }
+    record = generators.kinesis_record({}, sequence_number)
+    record['kinesis']['data'] = base64.b64encode(gzip.compress(json.dumps(envelope).encode('utf-8'))).decode('ascii')
+    return record
+
+def nfw_messages(count):
+    rng = random.Random(0)
+    return [generators.nfw_log_line(rng, index) for index in range(count)]
+
+def test_data_message_is_routed_by_log_group(s3, context, lake_rows, processed):
+    response = app.lambda_handler({'Records': [subscription_record(nfw_messages(30))]}, context)
+
+    assert response == {'batchItemFailures': []}
+    # Event types the Network Firewall mapping doesn't cover are dropped as unmapped
+    [(mapped, unmapped)] = processed
+    assert len(mapped) + len(unmapped) == 30
+    assert {event['source'] for event in mapped} == {'aws-nfw'}
+    assert sum(lake_rows().values()) == len(mapped) > 0
+
+def test_control_message_is_dropped(s3, context, lake_rows, processed):
+    record = subscription_record(['CWL CONTROL MESSAGE: Checking health of destination Kinesis stream.'],
+                                 message_type='CONTROL_MESSAGE')
+
+    response = app.lambda_handler({'Records': [record]}, context)
+
+    assert response == {'batchItemFailures': []}
+    assert processed == [([], [])]
+    assert lake_rows() == {}
+
+def test_unroutable_log_group_is_unmapped(s3, context, lake_rows, processed):
+    messages = nfw_messages(3)
+
+    response = app.lambda_handler({'Records': [subscription_record(messages, log_group='/aws/lambda/other')]}, context)
+
+    assert response == {'batchItemFailures': []}
+    [(mapped, unmapped)] = processed
+    assert mapped == []
+    assert unmapped == [{'raw': message, 'error': 'Source could not be determined'} for message in messages]
+    assert lake_rows() == {}
+
+def test_non_json_message_is_kept_as_raw_data(s3, context, monkeypatch):
+    batches = []
+    process_kinesis_batch = app.process_kinesis_batch
+
+    def recording(source_name, log_events, *args):
+        batches.append((source_name, list(log_events)))
+        return process_kinesis_batch(source_name, log_events, *args)
+
+    monkeypatch.setattr(app, 'process_kinesis_batch', recording)
+    [message] = nfw_messages(1)
+
+    app.lambda_handler({'Records': [subscription_record([message, 'not json'])]}, context)
+
+    [(source_name, log_events)] = batches
+    assert source_name == 'aws-nfw'
+    assert log_events[0] == app.source_assets.get('aws-nfw').decoder(message)
+    assert log_events[1] == {'rawData': 'not json'}
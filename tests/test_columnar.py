@@ -0,0 +1,23 @@
+"""
+Tests of the columnar batch transform
+"""
+import columnar
+
+def enum_table(enum, events):
+    plan = columnar.compile_column_plan({'severity': {'enum': enum}})
+    return columnar.build_columns(plan, events)
+
+def test_enum_lookup_is_vectorized():
+    enum = {'evaluate': '$.level', 'values': {'low': 1, 'high': 4}, 'other': 99}
+    table = enum_table(enum, [{'level': 'high'}, {'level': 'low'}, {'level': 'none'}])
+    assert table.column('severity').to_pylist() == [4, 1, 99]
+
+def test_mixed_type_enum_falls_back_to_per_value():
+    enum = {'evaluate': '$.level', 'values': {'A': 1, 'B': 'two'}, 'other': 99}
+    table = enum_table(enum, [{'level': 'A'}, {'level': 'B'}, {'level': 'C'}, {}])
+    assert table.column('severity').to_pylist() == ['1', 'two', '99', '99']
+
+def test_mixed_type_enum_without_other_is_null():
+    enum = {'evaluate': '$.level', 'values': {'A': 1, 'B': 'two'}}
+    table = enum_table(enum, [{'level': 'B'}, {'level': 'C'}])
+    assert table.column('severity').to_pylist() == ['two', None]
@@ -0,0 +1,91 @@
+"""
+Tests of partition compaction over files written by the handler
+"""
+import io
+import json
+from datetime import datetime, timedelta, timezone
+
+import generators
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import app
+import compaction
+from conftest import STAGING_BUCKET
+
+PARTITION = 'ext/aws-alb/region=us-east-1/accountId=123456789012/eventDay=20240301/'
+
+@pytest.fixture(autouse=True)
+def typed_output(monkeypatch):
+    """
+    Write and compact with OUTPUT_SCHEMA=typed, rebuilding the cached source assets
+    """
+    for module in (app, compaction):
+        monkeypatch.setattr(module, 'OUTPUT_SCHEMA', 'typed')
+        monkeypatch.setattr(module.source_assets, 'typed_output', True)
+        monkeypatch.setattr(module.source_assets, '_assets', {})
+
+def write_partition(s3, context, invocations):
+    """
+    Write one file per invocation to PARTITION and return their keys
+    """
+    for seed in range(invocations):
+        key = f'alb-logs/{seed}.log.gz'
+        s3.put_object(Bucket=STAGING_BUCKET, Key=key, Body=generators.alb_log_file(100, seed))
+        app.lambda_handler({'Records': [generators.sqs_s3_record(STAGING_BUCKET, key, f'm{seed}')]}, context)
+    return [obj['Key'] for obj in compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)]
+
+def read_table(s3, key):
+    return pq.read_table(io.BytesIO(s3.get_object(Bucket=app.SEC_LAKE_BUCKET, Key=key)['Body'].read()))
+
+def test_compacted_file_keeps_the_typed_schema(s3, context):
+    keys = write_partition(s3, context, 3)
+    rows = sum(read_table(s3, key).num_rows for key in keys)
+
+    result = compaction.compact_partition(s3, app.SEC_LAKE_BUCKET, PARTITION)
+
+    assert result == {'compacted': 1, 'remaining': 0}
+    [key] = [obj['Key'] for obj in compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)]
+    table = read_table(s3, key)
+    assert table.num_rows == rows
+    typed_schema = compaction._typed_schema('aws-alb')
+    for field in typed_schema:
+        expected = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        actual = table.schema.field(field.name).type
+        assert (actual.value_type if pa.types.is_dictionary(actual) else actual) == expected
+
+def test_conflicting_types_are_left_uncompacted(s3, context):
+    keys = write_partition(s3, context, 2)
+    # A file holding the time as strings can't be cast back without guessing
+    table = read_table(s3, keys[0])
+    table = table.set_column(table.schema.get_field_index('time'), 'time', table.column('time').cast(pa.string()))
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    s3.put_object(Bucket=app.SEC_LAKE_BUCKET, Key=keys[0], Body=buffer.getvalue())
+
+    result = compaction.compact_partition(s3, app.SEC_LAKE_BUCKET, PARTITION)
+
+    assert result == {'compacted': 0, 'remaining': 1}
+    assert sorted(obj['Key'] for obj in compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)) == sorted(keys)
+
+def test_recent_manifest_is_left_to_its_run(s3, context):
+    keys = write_partition(s3, context, 3)
+    manifest_key = f'{PARTITION}{compaction.MANIFEST_PREFIX}0.json'
+    output_key = f'{PARTITION}{compaction.COMPACTED_PREFIX}0.gz.parquet'
+    s3.put_object(Bucket=app.SEC_LAKE_BUCKET, Key=manifest_key,
+                  Body=json.dumps({'output': output_key, 'inputs': keys[:2]}).encode('utf-8'))
+    s3.copy_object(Bucket=app.SEC_LAKE_BUCKET, Key=output_key, CopySource={'Bucket': app.SEC_LAKE_BUCKET, 'Key': keys[0]})
+    objects = compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)
+
+    held = compaction.recover_swaps(s3, app.SEC_LAKE_BUCKET, objects)
+
+    assert held == set(keys[:2]) | {output_key, manifest_key}
+    assert len(compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)) == 5
+
+    # Once the lease has passed the swap is completed
+    for obj in objects:
+        obj['LastModified'] = datetime.now(timezone.utc) - timedelta(hours=2)
+    compaction.recover_swaps(s3, app.SEC_LAKE_BUCKET, objects)
+
+    assert sorted(obj['Key'] for obj in compaction.list_objects(s3, app.SEC_LAKE_BUCKET, PARTITION)) == sorted([output_key, keys[2]])
@@ -0,0 +1,72 @@
+"""
+Tests of duplicate suppression across redeliveries, with the filter saved to a file
+"""
+import json
+
+import generators
+import pytest
+
+import app
+import dedup
+from conftest import STAGING_BUCKET
+
+def sqs_record(message_id):
+    """
+    Return an SQS notification for the test object, with the ETag fingerprints are made of
+    """
+    record = generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', message_id)
+    body = json.loads(record['body'])
+    body['Records'][0]['s3']['object']['eTag'] = 'd41d8cd98f00b204e9800998ecf8427e'
+    record['body'] = json.dumps(body)
+    return record
+
+@pytest.fixture
+def store_path(tmp_path, monkeypatch):
+    path = str(tmp_path / 'dedup.bin')
+    monkeypatch.setattr(app, 'deduplicator', dedup.Deduplicator(2000, 1e-6, dedup.FileStore(path)))
+    return path
+
+def test_redelivered_message_is_dropped(s3, context, lake_rows, store_path, caplog):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(100))
+
+    assert app.lambda_handler({'Records': [sqs_record('m1'), sqs_record('m2')]}, context) == {'batchItemFailures': []}
+    assert sum(lake_rows().values()) == 100
+
+    # A cold start loads the filter saved by the first invocation
+    app.deduplicator = dedup.Deduplicator(2000, 1e-6, dedup.FileStore(store_path))
+    assert app.lambda_handler({'Records': [sqs_record('m3')]}, context) == {'batchItemFailures': []}
+    assert sum(lake_rows().values()) == 100
+    assert 'Dropping 100 of 100 events of s3:' in caplog.text
+
+def test_saves_are_spaced_by_the_interval(tmp_path):
+    store = dedup.FileStore(str(tmp_path / 'dedup.bin'))
+    deduplicator = dedup.Deduplicator(1000, 1e-6, store, save_interval=3600)
+    deduplicator.commit([dedup._digest('first')])
+    deduplicator.save()
+    saved = store.load()
+
+    deduplicator.commit([dedup._digest('second')])
+    deduplicator.save()
+
+    assert store.load() == saved
+
+def test_retry_only_rewrites_failed_groups(s3, context, lake_rows, store_path, monkeypatch):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(500))
+    write_group = app.write_group
+    failures = []
+
+    def fail_once(source, eventday, *args, **kwargs):
+        if eventday == '20240302' and not failures:
+            failures.append(eventday)
+            raise RuntimeError('write failed')
+        return write_group(source, eventday, *args, **kwargs)
+    monkeypatch.setattr(app, 'write_group', fail_once)
+
+    assert app.lambda_handler({'Records': [sqs_record('m1')]}, context) == {'batchItemFailures': [{'itemIdentifier': 'm1'}]}
+    first = lake_rows()
+    assert list(first) == ['20240301']
+
+    assert app.lambda_handler({'Records': [sqs_record('m1')]}, context) == {'batchItemFailures': []}
+    rows = lake_rows()
+    assert rows['20240301'] == first['20240301']
+    assert sum(rows.values()) == 500
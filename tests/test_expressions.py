@@ -0,0 +1,24 @@
+"""
+Tests of the expression tokenizer and parser
+"""
+import pytest
+
+import expressions
+
+def parse(text):
+    return expressions._Parser(text).parse()
+
+def test_numbers_take_an_exponent():
+    assert parse('1e3 + 2.5E-2') == ('binary', '+', ('literal', 1000.0), ('literal', 0.025))
+
+def test_locator_ends_at_an_operator():
+    assert parse('$.bytes-in') == ('binary', '-', ('locator', '$.bytes'), ('field', ('in',)))
+
+def test_braced_locator_keeps_operators():
+    assert parse('{$.http-request.user agent} * 2') == ('binary', '*', ('locator', '$.http-request.user agent'), ('literal', 2))
+    assert expressions.expression_locators({'expr': 'coalesce({$.bytes-in}, 0)'}) == ['$.bytes-in']
+
+@pytest.mark.parametrize('text', ['2x', '1e', '3.5abs'])
+def test_name_after_a_number_is_rejected(text):
+    with pytest.raises(ValueError, match='Invalid number'):
+        parse(text)
@@ -0,0 +1,106 @@
+"""
+End-to-end tests of lambda_handler on the SQS and Kinesis paths
+"""
+import base64
+import json
+import threading
+
+import generators
+import pytest
+
+import app
+from conftest import STAGING_BUCKET
+
+def test_sqs_notification_is_written(s3, context, lake_rows):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(200))
+
+    response = app.lambda_handler({'Records': [generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', 'm1')]}, context)
+
+    assert response == {'batchItemFailures': []}
+    rows = lake_rows()
+    # The generated timestamps span two eventDays
+    assert sorted(rows) == ['20240301', '20240302']
+    assert sum(rows.values()) == 200
+
+def test_missing_object_is_reported(s3, context, lake_rows):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(50))
+    records = [
+        generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', 'm1'),
+        generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/missing.log.gz', 'm2')
+    ]
+
+    response = app.lambda_handler({'Records': records}, context)
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'm2'}]}
+    assert sum(lake_rows().values()) == 50
+
+def test_kinesis_records_are_written(s3, context, lake_rows):
+    records = generators.sysmon_kinesis_records(40)
+    mapping = app.source_assets.get('windows-sysmon').mapping['custom_source_events']['ocsf_mapping']
+    # Events whose EventId has no mapping are dropped as unmapped
+    mapped = [
+        record for record in records
+        if json.loads(base64.b64decode(record['kinesis']['data']))['message']['EventId'] in mapping
+    ]
+
+    response = app.lambda_handler({'Records': records}, context)
+
+    assert response == {'batchItemFailures': []}
+    assert 0 < len(mapped) < len(records)
+    assert sum(lake_rows().values()) == len(mapped)
+
+def test_failed_write_reports_its_records(s3, context, monkeypatch):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(50))
+    records = [generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', 'm1')] + generators.sysmon_kinesis_records(5)
+    write_group = app.write_group
+
+    def failing_write(source, *args, **kwargs):
+        if source == 'windows-sysmon':
+            raise RuntimeError('write failed')
+        return write_group(source, *args, **kwargs)
+    monkeypatch.setattr(app, 'write_group', failing_write)
+
+    response = app.lambda_handler({'Records': records}, context)
+
+    assert response == {'batchItemFailures': [
+        {'itemIdentifier': record['kinesis']['sequenceNumber']} for record in records[1:]
+    ]}
+
+def test_large_object_is_sharded(s3, context, monkeypatch):
+    body = generators.alb_log_file(300)
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=body)
+    record = generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', 'm1')
+    message = json.loads(record['body'])
+    message['Records'][0]['s3']['object']['size'] = len(body)
+    record['body'] = json.dumps(message)
+    monkeypatch.setattr(app, 'PREPROCESS_BATCH_SIZE', 20)
+    monkeypatch.setattr(app, 'SHARD_LINES', 40)
+    monkeypatch.setattr(app, 'SHARD_MIN_OBJECT_BYTES', 1)
+    started = []
+    pool = app.sharded_transform.WorkerPool
+
+    def worker_pool(*args):
+        started.append(pool(*args))
+        return started[-1]
+    monkeypatch.setattr(app.sharded_transform, 'WorkerPool', worker_pool)
+
+    unsharded = list(app.process_records([record]))
+    monkeypatch.setattr(app, 'TRANSFORM_WORKERS', 2)
+    sharded = list(app.process_records([record]))
+
+    assert len(started) == 1
+    assert sharded == unsharded
+    assert len(sharded[0][1]) == 300
+
+def test_stopped_read_raises_between_batches(s3):
+    s3.put_object(Bucket=STAGING_BUCKET, Key='alb-logs/a.log.gz', Body=generators.alb_log_file(50))
+    stop = threading.Event()
+    stop.set()
+
+    with pytest.raises(RuntimeError, match='deadline'):
+        app.process_s3_event(generators.sqs_s3_record(STAGING_BUCKET, 'alb-logs/a.log.gz', 'm1'), stop=stop)
+
+def test_unparsable_timestamp_leaves_the_batch_to_process_event():
+    events = [{'time': '2024-03-01T10:00:00.000000Z'}, {'time': 'yesterday'}]
+
+    assert app.batch_eventdays(events, 'aws-alb') == [None, None]
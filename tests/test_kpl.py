@@ -0,0 +1,80 @@
+"""
+Tests of KPL de-aggregation, on its own and through lambda_handler
+"""
+import base64
+import hashlib
+import json
+
+import generators
+
+import app
+import kpl
+
+def varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def field(number, payload):
+    """
+    Encode a length-delimited protobuf field
+    """
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+def user_record(data):
+    # partition_key_index = 0, then data
+    return varint(1 << 3) + varint(0) + field(3, data)
+
+def aggregate(records, digest=None):
+    """
+    Build a KPL-aggregated record from encoded Record messages
+    """
+    message = field(1, b'partition-key') + b''.join(field(3, record) for record in records)
+    return kpl.MAGIC + message + (digest or hashlib.md5(message).digest())
+
+def test_user_records_keep_their_order():
+    payloads = [f'{{"n": {n}}}'.encode('utf-8') for n in range(5)]
+
+    assert kpl.deaggregate(aggregate([user_record(payload) for payload in payloads])) == payloads
+
+def test_plain_record_is_its_only_payload():
+    assert kpl.deaggregate(b'{"n": 1}') == [b'{"n": 1}']
+
+def test_digest_mismatch_is_a_plain_record():
+    data = aggregate([user_record(b'a'), user_record(b'b')], digest=b'\0' * kpl.DIGEST_SIZE)
+
+    assert kpl.deaggregate(data) == [data]
+
+def test_truncated_varint_is_a_plain_record():
+    # A length whose continuation bit is set on the last byte of the message
+    message = varint(3 << 3 | 2) + b'\x80'
+    data = kpl.MAGIC + message + hashlib.md5(message).digest()
+
+    assert kpl.deaggregate(data) == [data]
+
+def test_record_without_data_is_a_plain_record():
+    data = aggregate([user_record(b'a'), varint(1 << 3) + varint(0)])
+
+    assert kpl.deaggregate(data) == [data]
+
+def test_aggregated_kinesis_record_fans_out(s3, context, lake_rows):
+    mapping = app.source_assets.get('windows-sysmon').mapping['custom_source_events']['ocsf_mapping']
+    payloads = [
+        base64.b64decode(record['kinesis']['data'])
+        for record in generators.sysmon_kinesis_records(40)
+    ]
+    payloads = [payload for payload in payloads if json.loads(payload)['message']['EventId'] in mapping]
+    record = generators.kinesis_record({}, 1)
+    record['kinesis']['data'] = base64.b64encode(aggregate([user_record(payload) for payload in payloads])).decode('ascii')
+
+    response = app.lambda_handler({'Records': [record]}, context)
+
+    assert response == {'batchItemFailures': []}
+    assert len(payloads) > 1
+    assert sum(lake_rows().values()) == len(payloads)
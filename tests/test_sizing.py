@@ -0,0 +1,73 @@
+"""
+Tests of the throughput sizing and of the stack it sizes
+"""
+import os
+
+import pytest
+
+from ocsf_transformation import sizing
+from ocsf_transformation.sizing import ThroughputProfile, size_for_throughput
+
+CDK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cdk')
+
+# A small lab deployment and a busy one with a one second latency target
+LOW_PROFILE = ThroughputProfile(200, average_object_size_mb=1, latency_target_seconds=300)
+HIGH_PROFILE = ThroughputProfile(100000, average_object_size_mb=0.1, latency_target_seconds=1)
+
+def test_sqs_concurrency_stays_within_lambda_limits():
+    for events_per_second in (1, 1000, 10 ** 9):
+        concurrency = sizing.size_sqs_path(ThroughputProfile(events_per_second, average_object_size_mb=0.01))['concurrency']
+        assert sizing.MIN_SQS_CONCURRENCY <= concurrency <= sizing.MAX_SQS_CONCURRENCY
+
+def test_high_profile_scales_every_setting():
+    low = size_for_throughput(LOW_PROFILE)
+    high = size_for_throughput(HIGH_PROFILE)
+
+    assert high.shard_count > low.shard_count
+    assert high.reserved_concurrency > low.reserved_concurrency
+    assert high.enhanced_fan_out and not low.enhanced_fan_out
+
+def synth(monkeypatch, profile):
+    """
+    Return the template of the stack sized for a profile
+    """
+    # The function code asset is resolved from the cdk directory, by a jsii
+    # process that keeps the working directory of the first import
+    monkeypatch.chdir(CDK_DIR)
+    cdk = pytest.importorskip('aws_cdk')
+    from aws_cdk.assertions import Template
+    from ocsf_transformation.ocsf_transformation_stack import OcsfTransformationStack
+
+    # Bundling installs the function requirements, which the template doesn't depend on
+    stack = OcsfTransformationStack(
+        cdk.App(context={'aws:cdk:bundling-stacks': []}), 'OcsfTransformation',
+        asl_bucket_location='test-security-lake',
+        throughput_profile=profile,
+        env=cdk.Environment(account='123456789012', region='us-east-1')
+    )
+    return Template.from_stack(stack)
+
+@pytest.mark.parametrize('profile', [LOW_PROFILE, HIGH_PROFILE], ids=['low', 'high'])
+def test_stack_uses_the_sizing(monkeypatch, profile):
+    expected = size_for_throughput(profile)
+
+    template = synth(monkeypatch, profile)
+
+    template.has_resource_properties('AWS::Lambda::Function', {
+        'Handler': 'app.lambda_handler',
+        'MemorySize': expected.memory_size,
+        'Timeout': expected.timeout_seconds,
+        'ReservedConcurrentExecutions': expected.reserved_concurrency
+    })
+    template.has_resource_properties('AWS::Kinesis::Stream', {'ShardCount': expected.shard_count})
+    template.has_resource_properties('AWS::Lambda::EventSourceMapping', {
+        'BatchSize': expected.sqs_batch_size,
+        'ScalingConfig': {'MaximumConcurrency': expected.sqs_max_concurrency}
+    })
+    template.has_resource_properties('AWS::Lambda::EventSourceMapping', {
+        'BatchSize': expected.kinesis_batch_size,
+        'ParallelizationFactor': expected.parallelization_factor,
+        'BisectBatchOnFunctionError': True
+    })
+    template.resource_count_is('AWS::Kinesis::StreamConsumer', 1 if expected.enhanced_fan_out else 0)
+    template.has_resource_properties('AWS::SQS::Queue', {'RedrivePolicy': {'maxReceiveCount': 5}})
@@ -0,0 +1,29 @@
+"""
+Tests of the prebuilt configuration artifact
+"""
+import json
+import os
+
+import source_assets
+
+FUNCTION_DIR = os.path.dirname(os.path.abspath(source_assets.__file__))
+
+def test_artifact_is_ignored_after_a_pyarrow_upgrade(tmp_path, monkeypatch):
+    with open(os.path.join(FUNCTION_DIR, 'sources_config.json')) as f:
+        sources_config = json.load(f)
+    path = str(tmp_path / source_assets.ARTIFACT_FILE)
+    source_assets.build_artifact(FUNCTION_DIR, path)
+    monkeypatch.setattr(source_assets, 'ARTIFACT_FILE', path)
+
+    assert source_assets.load_artifact(FUNCTION_DIR, sources_config) is not None
+
+    monkeypatch.setattr(source_assets.pa, '__version__', '0.0.1')
+    assert source_assets.load_artifact(FUNCTION_DIR, sources_config) is None
+
+def test_decoder_without_orjson_is_plain_json(monkeypatch):
+    import json_decoder
+
+    projection = json_decoder.build_projection([('event', 'src_ip')])
+    monkeypatch.setattr(json_decoder, 'orjson', None)
+
+    assert json_decoder.make_decoder(projection) is json.loads
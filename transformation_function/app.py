@@ -1,20 +1,79 @@
-import boto3
 import base64
 import json
-import gzip
 import os
-import re
 import logging
+import threading
 import uuid
 import urllib
-import importlib
-import pandas as pd
-import awswrangler as wr
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from io import BytesIO
-from datetime import datetime
+import json_decoder
+from timestamps import get_eventday_parser
+from routing import SourceRouter
+import columnar
+import sharded_transform
+import ocsf_schemas
+from parquet_options import ParquetOptions, load_parquet_options
+from stream_reader import READ_CHUNK_SIZE, iter_decompressed, iter_lines, iter_batches
+from metrics import MetricsCollector, count_event
+from log_limiter import limiter
+from source_assets import SourceAssetCache, load_artifact
+import dedup
+import kpl
+import cloudwatch_logs
 
 SEC_LAKE_BUCKET = os.environ['SEC_LAKE_BUCKET']
 
+# 'record' maps each event to a nested dict, 'columnar' maps batches into Arrow columns
+TRANSFORM_MODE = os.environ.get('TRANSFORM_MODE', 'record').lower()
+
+# 'typed' writes every source through its OCSF class schemas, 'inferred' keeps per-batch type inference
+OUTPUT_SCHEMA = os.environ.get('OUTPUT_SCHEMA', 'inferred').lower()
+
+# Default Parquet settings, overridable per source with an 'output' block in sources_config.json
+PARQUET_DEFAULTS = {
+    'compression': os.environ.get('PARQUET_COMPRESSION', 'gzip'),
+    'row_group_size': os.environ.get('PARQUET_ROW_GROUP_SIZE') or None,
+    'sort_by': os.environ.get('PARQUET_SORT_BY', 'time'),
+    'bloom_filter_columns': os.environ.get('PARQUET_BLOOM_FILTER_COLUMNS', ''),
+    # 'source' writes all classes of a source together, 'class' writes one file per OCSF class
+    'partition_by': os.environ.get('OUTPUT_PARTITIONING', 'source')
+}
+
+# Number of S3 objects fetched and decoded concurrently per invocation
+S3_FETCH_CONCURRENCY = max(1, int(os.environ.get('S3_FETCH_CONCURRENCY', '10')))
+
+# Time kept in reserve to write the mapped events before the function times out
+DEADLINE_RESERVE_MS = int(os.environ.get('DEADLINE_RESERVE_MS', '2000'))
+
+# Number of S3 object lines handed to a batch preprocessor at once
+PREPROCESS_BATCH_SIZE = 10000
+
+# Worker processes transforming the lines of a large S3 object, 1 disables sharding
+TRANSFORM_WORKERS = max(1, int(os.environ.get('TRANSFORM_WORKERS') or 1))
+
+# Compressed size from which an S3 object is transformed in worker processes, as reported by its notification
+SHARD_MIN_OBJECT_BYTES = int(os.environ.get('SHARD_MIN_OBJECT_BYTES', str(128 * 1024 * 1024)))
+
+# Number of S3 object lines sent to a worker process at once
+SHARD_LINES = 5 * PREPROCESS_BATCH_SIZE
+
+# Emit per-stage timings and per-source event counts as CloudWatch EMF once per invocation
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'OCSFTransformation')
+
+# Drop events already written by an earlier delivery of the same SQS message or Kinesis record
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'false').lower() == 'true'
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', '1000000'))
+# A false positive drops a new event, so the rate is kept low at the cost of a larger filter
+DEDUP_ERROR_RATE = float(os.environ.get('DEDUP_ERROR_RATE', '1e-6'))
+# s3://bucket/key or a local path the duplicate filter is kept in, empty for memory only
+DEDUP_STORE = os.environ.get('DEDUP_STORE', '')
+# Minimum seconds between two saves of the duplicate filter to its store, 0 to save after every invocation
+DEDUP_SAVE_INTERVAL = float(os.environ.get('DEDUP_SAVE_INTERVAL', '0'))
+
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -32,61 +91,52 @@ with open(sources_config_path) as f:
     sources_config = json.load(f)
     logger.info(f"Loaded source configuration with {len(sources_config['sources'])} sources")
 
-# Load mapping configurations
-source_mappings = {}
-for source in sources_config['sources']:
-    mapping_path = os.path.join(current_dir, 'mappings', source['mapping_file'])
-    if os.path.exists(mapping_path):
-        with open(mapping_path) as f:
-            source_mappings[source['name']] = json.load(f)
-            logger.info(f"Loaded mapping for source: {source['name']}")
-    else:
-        logger.warning(f"Mapping file not found for source: {source['name']}")
+# Build the source routing index once for S3 keys and Kinesis metadata
+source_router = SourceRouter(sources_config)
 
-# Load all preprocessors at initialization time
-preprocessors = {}
-for source in sources_config['sources']:
-    try:
-        # Check if preprocessor_module exists and is not empty
-        module_name = source.get('preprocessor_module')
-        if not module_name:  # handles None, empty string, or key not existing
-            logger.info(f"No preprocessor defined for source: {source['name']}, skipping")
-            continue
-            
-        # Import the specific module mentioned in the config
-        module = importlib.import_module(f'preprocessors.{module_name}')
-        
-        if hasattr(module, 'preprocess_event'):
-            preprocessors[source['name']] = module.preprocess_event
-            logger.info(f"Loaded preprocessor for source: {source['name']}")
-        else:
-            logger.warning(f"Preprocessor module {module_name} does not have preprocess_event function")
-    except ImportError as e:
-        logger.warning(f"Could not import preprocessor for {source['name']}: {e}")
-
-# function to return type_uid based on activity_id and class_uid
-def type_uid_calculation(activity_id, class_uid):
-    type_uid = ((int(class_uid) * 100) + int(activity_id))
-    return type_uid
+# Resolve the Parquet codec, row groups, sort order and Bloom filters per source
+parquet_options = load_parquet_options(sources_config, PARQUET_DEFAULTS)
+
+# Mappings, decoders, schemas and preprocessors are built per source on first use,
+# from the prebuilt configuration artifact when one is shipped
+source_assets = SourceAssetCache(
+    sources_config, current_dir,
+    transform_mode=TRANSFORM_MODE,
+    typed_output=OUTPUT_SCHEMA == 'typed',
+    artifact=load_artifact(current_dir, sources_config)
+)
+
+# Stage timings and event counts of the current invocation
+invocation_metrics = MetricsCollector(METRICS_ENABLED, METRICS_NAMESPACE)
+
+# Shared S3 client, created on first use and reused across invocations
+s3_client = None
+
+def get_s3_client():
+    """
+    Return the shared S3 client, sized so every fetch thread gets a pooled connection
+    """
+    global s3_client
+    if s3_client is None:
+        # Imported on first use so invocations that never touch S3 don't pay for it at startup
+        import boto3
+        from botocore.config import Config
+        s3_client = boto3.client('s3', config=Config(
+            max_pool_connections=max(S3_FETCH_CONCURRENCY, 10),
+            tcp_keepalive=True,
+            retries={'mode': 'standard'}
+        ))
+    return s3_client
+
+# Duplicate filter kept warm across the invocations of this execution environment
+deduplicator = None
+if DEDUP_ENABLED:
+    deduplicator = dedup.Deduplicator(DEDUP_CAPACITY, DEDUP_ERROR_RATE, dedup.store_from_url(DEDUP_STORE, get_s3_client),
+                                      DEDUP_SAVE_INTERVAL)
 
 # function to return eventday format from user-specified timestamp found in logs
 def timestamp_transform(timestamp, format):
-    if format == 'epoch':
-        dt_event = datetime.fromtimestamp(int(timestamp))
-        eventday = str(dt_event.year)+f'{dt_event.month:02d}'+f'{dt_event.day:02d}'
-        return eventday
-    else:
-        dt_event = datetime.strptime(timestamp, format)
-        eventday = str(dt_event.year)+f'{dt_event.month:02d}'+f'{dt_event.day:02d}'
-        return eventday
-
-# function to convert S3 prefix pattern to regex pattern
-def create_regex_from_prefix(prefix: str) -> str:
-    # Escape any forward slashes first
-    prefix = prefix.replace('/', '\\/')
-    # Replace /* with regex pattern that matches anything
-    regex_pattern = prefix.replace('*', '.*')
-    return f"^{regex_pattern}$"
+    return get_eventday_parser(format).parse(timestamp)
 
 # function to return value from '$.' reference in config line
 def get_dot_locator_value(dot_locator, event):
@@ -105,7 +155,7 @@ def get_dot_locator_value(dot_locator, event):
                 break
         return str(result) if result is not None else None
     else:
-        logger.info("Unable to process matched field -"+dot_locator)
+        limiter.info(None, dot_locator, "Unable to process matched field -%s", dot_locator)
         return None
 
 # function to map original log record to mapping defined in config file
@@ -132,19 +182,16 @@ def perform_transform(event_mapping, event):
                         new_record[key] = locator_value
                     else:
                         # Field not found but continue processing
-                        logger.warning(f"Field {event_mapping[key]} not found in event, setting to null")
+                        limiter.warning(None, event_mapping[key], "Field %s not found in event, setting to null", event_mapping[key])
                         new_record[key] = None
                 else:
                     # otherwise just map it
                     new_record[key] = event_mapping[key]
         except Exception as e:
             # Catch any errors during transformation of this field and continue
-            logger.warning(f"Error transforming field {key}: {str(e)}, setting to null")
+            limiter.warning(None, key, "Error transforming field %s: %s, setting to null", key, e)
             new_record[key] = None
 
-    # Need to move this
-    # new_record["type_uid"] = type_uid_calculation(new_record["activity_id"], new_record["class_uid"])
-            
     return new_record
 
 # Detect source from Kinesis event
@@ -153,25 +200,13 @@ def detect_source_from_kinesis(payload_json):
     Detect the source of a Kinesis event based on configuration
     Returns None if source cannot be determined
     """
-    for source in sources_config['sources']:
-        kinesis_config = source['input_paths'].get('kinesis', {})
-        
-        if kinesis_config.get('enabled', False):
-            metadata_field = kinesis_config.get('metadata_field', 'source')
-            
-            # Check if the metadata field exists and matches the source name
-            if metadata_field in payload_json and payload_json[metadata_field] == source['name']:
-                logger.debug(f"Detected source from Kinesis metadata: {source['name']}")
-                return source['name']
-            
-            # Check nested metadata
-            if 'metadata' in payload_json and metadata_field in payload_json['metadata']:
-                if payload_json['metadata'][metadata_field] == source['name']:
-                    logger.debug(f"Detected source from Kinesis nested metadata: {source['name']}")
-                    return source['name']
+    source_name = source_router.route_kinesis(payload_json)
+    if source_name is not None:
+        logger.debug("Detected source from Kinesis metadata: %s", source_name)
+        return source_name
     
     # If no source detected, return None
-    logger.warning("No source detected for Kinesis event")
+    limiter.warning(None, 'source', "No source detected for Kinesis event")
     return None
 
 # Detect source from S3 object key
@@ -180,78 +215,276 @@ def detect_source_from_s3_key(bucket_name, object_key):
     Detect the source based on bucket name and S3 object key prefix pattern
     Returns None if source cannot be determined
     """
-    for source in sources_config['sources']:
-        s3_config = source['input_paths'].get('s3', {})
-        
-        if s3_config.get('enabled', False):
-            source_buckets = s3_config.get('source_buckets', [])
-            # First check if this is the right bucket
-            for source_bucket in source_buckets:
-                if source_bucket.get('bucket_name') == bucket_name:
-                    # Get prefix directly from source_bucket
-                    prefix = source_bucket.get('prefix')
-                    if prefix:
-                        pattern = create_regex_from_prefix(prefix)
-                        if re.match(pattern, object_key):
-                            logger.debug(f"Detected source from S3 bucket/key pattern match: {source['name']}")
-                            return source['name']
+    source_name = source_router.route_s3(bucket_name, object_key)
+    if source_name is not None:
+        logger.debug("Detected source from S3 bucket/key pattern match: %s", source_name)
+        return source_name
     
     # If no source detected, return None
     logger.warning(f"No source detected for bucket: {bucket_name}, key: {object_key}")
     return None
 
 # Process a single event
-def process_event(processed_json, source_name):
+def process_event(processed_json, source_name, eventday=None, counts=None):
     """
     Process an event for a specific source
+
+    eventday can be passed in when it was already derived for a batch, and
+    counts is the metrics counts dict the outcome is tallied in, if any
     """ 
     # Check if we have a mapping for this source
-    if source_name not in source_mappings:
-        logger.warning(f"No mapping configuration found for source: {source_name}")
+    assets = source_assets.get(source_name)
+    if assets is None or assets.compiled is None:
+        limiter.warning(source_name, 'mapping', "No mapping configuration found for source: %s", source_name)
+        count_event(counts, source_name, None, 'unmapped')
         return None, processed_json
         
-    mapping = source_mappings[source_name]
+    compiled = assets.compiled
     
     # Extract timestamp
-    timestamp_field = mapping['custom_source_events']['timestamp']['field']
-    timestamp_format = mapping['custom_source_events']['timestamp']['format']
+    timestamp_field = compiled['timestamp_field']
     
-    timestamp = get_dot_locator_value(timestamp_field, processed_json)
-    if not timestamp:
-        logger.warning(f"Could not extract timestamp from field {timestamp_field}")
-        return None, processed_json
-    
-    eventday = timestamp_transform(timestamp, timestamp_format)
-    logger.debug(f"Eventday: {eventday}")
+    if eventday is None:
+        timestamp = compiled['timestamp_locator'](processed_json)
+        if not timestamp:
+            limiter.warning(source_name, timestamp_field, "Could not extract timestamp from field %s", timestamp_field)
+            count_event(counts, source_name, None, 'unmapped')
+            return None, processed_json
+        
+        eventday = compiled['eventday_parser'].parse(timestamp)
+    logger.debug("Eventday: %s", eventday)
     # Extract matched field for event type
-    matched_field = mapping['custom_source_events']['matched_field']
-    matched_value = get_dot_locator_value(matched_field, processed_json)
+    matched_field = compiled['matched_field']
+    matched_value = compiled['matched_locator'](processed_json)
     
     if not matched_value:
-        logger.warning(f"Could not extract matched value from field {matched_field}")
+        limiter.warning(source_name, matched_field, "Could not extract matched value from field %s", matched_field)
+        count_event(counts, source_name, None, 'unmapped')
         return None, processed_json
     
     # Check if we have a mapping for this event type
-    if matched_value in mapping['custom_source_events']['ocsf_mapping']:
-        event_mapping = mapping['custom_source_events']['ocsf_mapping'][matched_value]
-        transformed_data = perform_transform(event_mapping['schema_mapping'], processed_json)
+    if matched_value in compiled['ocsf_mapping']:
+        target_schema, transform = compiled['ocsf_mapping'][matched_value]
+        count_event(counts, source_name, matched_value, 'mapped')
+        if TRANSFORM_MODE == 'columnar':
+            # Defer mapping to the batch writer, which builds the columns directly
+            return {
+                'source': source_name,
+                'target_schema': target_schema,
+                'matched_value': matched_value,
+                'event': processed_json,
+                'eventday': eventday
+            }, None
+
+        transformed_data = transform(processed_json)
         
         result = {
             'source': source_name,
-            'target_schema': event_mapping['schema'],
+            'target_schema': target_schema,
+            'matched_value': matched_value,
             'target_mapping': transformed_data,
             'eventday': eventday
         }
 
-        logger.debug("Transformed OCSF record: "+str(result))
+        logger.debug("Transformed OCSF record: %s", result)
         
         return result, None
     else:
-        logger.info(f"No mapping found for {source_name} event with matched value: {matched_value}")
+        limiter.info(source_name, matched_field, "No mapping found for %s event with matched value: %s", source_name, matched_value)
+        # Unmapped values come from the data, so they share one dimension value
+        count_event(counts, source_name, 'other', 'unmapped')
         return None, processed_json
 
-# Process a single event
-def process_s3_event(record):
+# function to derive the eventday of a batch of preprocessed events in one call
+def batch_eventdays(processed_events, source_name):
+    """
+    Return the eventday of each event, or None where process_event has to derive it
+
+    A batch with any timestamp that can't be parsed is left to process_event
+    entirely, so each bad event is reported on its own.
+    """
+    assets = source_assets.get(source_name)
+    compiled = assets.compiled if assets is not None else None
+    if compiled is not None:
+        locate = compiled['timestamp_locator']
+        try:
+            timestamps = [
+                (locate(processed_json) or None) if processed_json is not None else None
+                for processed_json in processed_events
+            ]
+            return compiled['eventday_parser'].parse_batch(timestamps)
+        except (ValueError, TypeError, KeyError, AttributeError, OverflowError) as e:
+            # Unparsable or out of range timestamps, and locators meeting an event of another shape
+            logger.debug("Deriving the eventdays of %s events one by one: %s", source_name, e)
+    return [None] * len(processed_events)
+
+# function to preprocess a single raw line from an S3 object
+def preprocess_line(raw_line, source_name):
+    """
+    Preprocess one raw line, returning (processed_json, error)
+    """
+    assets = source_assets.get(source_name)
+    try:
+        # Process the raw line
+        if assets is not None and assets.preprocess_event is not None:
+            return assets.preprocess_event(raw_line), None
+        # If no preprocessor, try to parse as JSON, fallback to raw text
+        try:
+            decode = assets.decoder if assets is not None and assets.decoder is not None else json_decoder.loads
+            return decode(raw_line), None
+        except json.JSONDecodeError:
+            return {"rawData": raw_line}, None
+    except Exception as e:
+        return None, e
+
+# function to preprocess the lines of an S3 object, in batches where the source supports it
+def preprocess_lines(raw_lines, source_name):
+    """
+    Yield (raw_line, processed_json, error) for each line of an S3 object
+
+    Sources whose preprocessor module offers preprocess_batch get their lines
+    in batches of PREPROCESS_BATCH_SIZE; a failing batch is retried line by line.
+    """
+    assets = source_assets.get(source_name)
+    batch_preprocessor = assets.preprocess_batch if assets is not None else None
+    if batch_preprocessor is None:
+        for raw_line in raw_lines:
+            yield (raw_line,) + preprocess_line(raw_line, source_name)
+        return
+
+    for batch in iter_batches(raw_lines, PREPROCESS_BATCH_SIZE):
+        try:
+            processed_batch = batch_preprocessor(batch)
+        except Exception as e:
+            limiter.warning(source_name, 'preprocess_batch', "Batch preprocessing failed for source %s, retrying line by line: %s", source_name, e)
+            for raw_line in batch:
+                yield (raw_line,) + preprocess_line(raw_line, source_name)
+            continue
+        for raw_line, processed_json in zip(batch, processed_batch):
+            yield raw_line, processed_json, None
+
+# function to preprocess and map the lines of an S3 object
+def process_lines(raw_batches, source_name, counts=None):
+    """
+    Preprocess and map batches of raw lines, returning (mapped_events, unmapped_events)
+
+    Lines that fail to preprocess or map are returned as unmapped events
+    carrying the raw line and the error.
+    """
+    mapped_events = []
+    unmapped_events = []
+    for raw_batch in raw_batches:
+        with invocation_metrics.stage('preprocess', source_name):
+            batch = list(preprocess_lines(raw_batch, source_name))
+
+        with invocation_metrics.stage('transform', source_name):
+            eventdays = batch_eventdays([processed_json for _, processed_json, _ in batch], source_name)
+
+            for (raw_line, processed_json, error), eventday in zip(batch, eventdays):
+                logger.debug("Raw log: %s", raw_line)
+
+                if error is None:
+                    try:
+                        # Process the event
+                        mapped_event, unmapped_event = process_event(processed_json, source_name, eventday, counts)
+                        
+                        if mapped_event:
+                            mapped_events.append(mapped_event)
+                        elif unmapped_event:
+                            unmapped_events.append(unmapped_event)
+                    except Exception as e:
+                        error = e
+
+                if error is not None:
+                    limiter.error(source_name, 'line', "Error processing line: %s", error)
+                    count_event(counts, source_name, None, 'errored')
+                    unmapped_events.append({"raw": raw_line, "error": str(error)})
+
+    return mapped_events, unmapped_events
+
+# function to stop reading an S3 object once the invocation stopped processing
+def until_stopped(batches, stop=None):
+    """
+    Yield batches until stop is set, then raise so the fetch thread unwinds
+
+    Checked between batches, so a thread left running at the deadline stops
+    within one batch instead of reading on into the next invocation.
+    """
+    for batch in batches:
+        if stop is not None and stop.is_set():
+            raise RuntimeError("Stopped reading at the invocation deadline")
+        yield batch
+
+# function to preprocess and map one shard of lines, run in a worker process
+def transform_shard(task):
+    """
+    Preprocess and map a (source name, lines, count events) task from process_lines_sharded
+
+    Returns:
+        tuple: (mapped events, unmapped events, event counts or None)
+    """
+    source_name, shard, with_counts = task
+    shard_counts = {} if with_counts else None
+    mapped, unmapped = process_lines(iter_batches(shard, PREPROCESS_BATCH_SIZE), source_name, shard_counts)
+    return mapped, unmapped, shard_counts
+
+# function to start the transform workers for a batch holding a large S3 object
+def start_transform_workers(records, s3_indexes):
+    """
+    Fork TRANSFORM_WORKERS processes if a notification in the batch reports an object of at least SHARD_MIN_OBJECT_BYTES
+
+    Called before the fetch threads start, as a fork taken while another
+    thread holds a lock leaves that lock held in the child. The sources of
+    the large objects are loaded first so the workers share their compiled
+    mappings. Notifications without a size are never sharded.
+
+    Returns:
+        sharded_transform.WorkerPool, or None if no object needs sharding
+    """
+    if TRANSFORM_WORKERS <= 1:
+        return None
+    large_object = False
+    for index in s3_indexes:
+        try:
+            s3_details = json.loads(records[index]['body'])['Records'][0]['s3']
+            if (s3_details['object'].get('size') or 0) < SHARD_MIN_OBJECT_BYTES:
+                continue
+            source_name = detect_source_from_s3_key(s3_details['bucket']['name'],
+                                                    urllib.parse.unquote(s3_details['object']['key']))
+            if source_name is not None:
+                source_assets.get(source_name)
+                large_object = True
+        except Exception as e:
+            # The record fails on its own when it is processed
+            logger.debug("Not sharding record %d: %s", index, str(e))
+    if not large_object:
+        return None
+    return sharded_transform.WorkerPool(transform_shard, TRANSFORM_WORKERS)
+
+# function to preprocess and map the lines of a large S3 object in worker processes
+def process_lines_sharded(raw_lines, source_name, workers, counts=None, stop=None):
+    """
+    Preprocess and map raw lines in shards of SHARD_LINES across the processes of a WorkerPool
+
+    Shards are made of whole preprocessing batches and merged back in order,
+    so the result is the same as process_lines over the same lines.
+    """
+    mapped_events = []
+    unmapped_events = []
+    shards = until_stopped(invocation_metrics.timed(iter_batches(raw_lines, SHARD_LINES), 'decompress', source_name), stop)
+    tasks = ((source_name, shard, counts is not None) for shard in shards)
+    with invocation_metrics.stage('transform', source_name):
+        for mapped, unmapped, shard_counts in workers.map(tasks):
+            mapped_events.extend(mapped)
+            unmapped_events.extend(unmapped)
+            if shard_counts:
+                for key, value in shard_counts.items():
+                    counts[key] = counts.get(key, 0) + value
+    return mapped_events, unmapped_events
+
+# Process a single event, sharding a large object over the processes of workers if given
+# and stopping between batches once stop is set
+def process_s3_event(record, workers=None, stop=None):
     logger.info('Processing S3 event')
     mapped_events = []
     unmapped_events = []
@@ -270,150 +503,466 @@ def process_s3_event(record):
 
     # URL decode the object key
     decoded_key = urllib.parse.unquote(object_key)
-    logger.debug(f"Decoded key: {decoded_key}")
+    logger.debug("Decoded key: %s", decoded_key)
     
     # Detect source from S3 bucket and key
-    source_name = detect_source_from_s3_key(bucket_name, decoded_key)
+    with invocation_metrics.stage('route'):
+        source_name = detect_source_from_s3_key(bucket_name, decoded_key)
     if source_name is None:
         logger.error(f"Cannot determine source for S3 object: {bucket_name}/{decoded_key}")
         return [], []
         
     logger.info(f"Processing S3 object from source: {source_name}, key: {decoded_key}")
 
-    s3_client = boto3.client('s3')
-    response = s3_client.get_object(
-        Bucket=bucket_name,
-        Key=decoded_key
-    )
+    with invocation_metrics.stage('s3_get', source_name):
+        response = get_s3_client().get_object(
+            Bucket=bucket_name,
+            Key=decoded_key
+        )
 
-    log_file = gzip.GzipFile(
-        None,
-        'rb',
-        fileobj=BytesIO(response['Body'].read())
-    )
+    # Decompress and split the object as it streams in instead of buffering it
+    body_chunks = invocation_metrics.timed(response['Body'].iter_chunks(READ_CHUNK_SIZE), 's3_get', source_name)
+    raw_lines = iter_lines(iter_decompressed(body_chunks))
+    counts = invocation_metrics.new_counts()
 
-    for line in log_file:
-        raw_line = line.decode("utf-8")
-        logger.debug("Raw log: " + raw_line)
+    object_size = response.get('ContentLength') or 0
+    if workers is not None and object_size >= SHARD_MIN_OBJECT_BYTES and workers.try_acquire():
+        try:
+            logger.info(f"Transforming {object_size} byte object in {TRANSFORM_WORKERS} worker processes")
+            mapped_events, unmapped_events = process_lines_sharded(raw_lines, source_name, workers, counts, stop)
+        finally:
+            workers.release()
+    else:
+        raw_batches = invocation_metrics.timed(iter_batches(raw_lines, PREPROCESS_BATCH_SIZE), 'decompress', source_name)
+        mapped_events, unmapped_events = process_lines(until_stopped(raw_batches, stop), source_name, counts)
+
+    invocation_metrics.add_counts(counts)
+    return mapped_events, unmapped_events
+
+# function to decode and route one Kinesis payload
+def route_kinesis_payload(data, events_by_source, unmapped_events, counts):
+    """
+    Decode one Kinesis payload and queue its log data under the detected source
+
+    Payloads that aren't JSON or whose source can't be determined are added
+    to unmapped_events instead.
+    """
+    source_name = None
+    try:
+        with invocation_metrics.stage('decode'):
+            payload = data.decode('utf-8')
+        logger.debug("Raw log: %s", payload)
 
         try:
-            # Process the raw line
-            if source_name in preprocessors:
-                processed_json = preprocessors[source_name](raw_line)
-            else:
-                # If no preprocessor, try to parse as JSON, fallback to raw text
-                try:
-                    processed_json = json.loads(raw_line)
-                except json.JSONDecodeError:
-                    processed_json = {"rawData": raw_line}
-            
-            # Process the event
-            mapped_event, unmapped_event = process_event(processed_json, source_name)
-            
+            with invocation_metrics.stage('decode'):
+                payload_json = json_decoder.loads(payload)
+        except json.JSONDecodeError as e:
+            limiter.error(None, 'json', "Error decoding JSON: %s", e)
+            count_event(counts, None, None, 'errored')
+            unmapped_events.append({"raw": payload, "error": "JSON decode error"})
+            return
+
+        # Detect source from Kinesis event
+        with invocation_metrics.stage('route'):
+            source_name = detect_source_from_kinesis(payload_json)
+        if source_name is None:
+            limiter.error(None, 'source', "Cannot determine source for Kinesis event, skipping processing")
+            count_event(counts, None, None, 'errored')
+            unmapped_events.append({"raw": payload, "error": "Source could not be determined"})
+            return
+
+        logger.debug("Processing Kinesis event from source: %s", source_name)
+
+        # Extract the actual log data from the message field
+        events_by_source.setdefault(source_name, []).append(payload_json.get('message', payload_json))
+    except Exception as outer_e:
+        limiter.error(source_name, 'record', "Fatal error processing Kinesis record: %s", outer_e)
+        count_event(counts, source_name, None, 'errored')
+        unmapped_events.append({"error": f"Fatal Kinesis processing error: {str(outer_e)}"})
+
+# function to decompress and route the log events of a CloudWatch Logs subscription payload
+def route_subscription_payload(data, events_by_source, unmapped_events, counts):
+    """
+    Queue the log events of a CloudWatch Logs subscription payload under the source of its log group
+
+    Control messages are dropped. Log event messages are decoded as JSON,
+    with the source's field projection when it has no preprocessor, and are
+    kept as rawData when they aren't JSON.
+    """
+    try:
+        with invocation_metrics.stage('decompress'):
+            subscription = cloudwatch_logs.read_subscription(data)
+    except ValueError as e:
+        limiter.error(None, 'subscription', "Error reading CloudWatch Logs subscription payload: %s", e)
+        count_event(counts, None, None, 'errored')
+        unmapped_events.append({"error": f"Subscription payload error: {str(e)}"})
+        return
+    if subscription is None:
+        return
+
+    log_group, messages = subscription
+    with invocation_metrics.stage('route'):
+        source_name = source_router.route_log_group(log_group)
+    if source_name is None:
+        limiter.error(None, 'source', "Cannot determine source for log group %s, skipping processing", log_group)
+        for message in messages:
+            count_event(counts, None, None, 'errored')
+            unmapped_events.append({"raw": message, "error": "Source could not be determined"})
+        return
+    logger.debug("Processing %d log events from log group %s as source: %s", len(messages), log_group, source_name)
+
+    assets = source_assets.get(source_name)
+    if assets is not None and assets.preprocess_event is None and assets.decoder is not None:
+        decode = assets.decoder
+    else:
+        decode = json_decoder.loads
+    log_events = events_by_source.setdefault(source_name, [])
+    with invocation_metrics.stage('decode', source_name):
+        for message in messages:
+            try:
+                log_events.append(decode(message))
+            except (json.JSONDecodeError, TypeError):
+                log_events.append({"rawData": message})
+
+# function to preprocess and map the Kinesis log events of one source
+def process_kinesis_batch(source_name, log_events, mapped_events, unmapped_events, counts):
+    """
+    Preprocess and map the log events of one source taken from a Kinesis record
+    """
+    def fail(e):
+        limiter.error(source_name, 'record', "Fatal error processing Kinesis record: %s", e)
+        count_event(counts, source_name, None, 'errored')
+        unmapped_events.append({"error": f"Fatal Kinesis processing error: {str(e)}"})
+
+    # Process the log data
+    processed_events = []
+    with invocation_metrics.stage('preprocess', source_name):
+        assets = source_assets.get(source_name)
+        preprocess = assets.preprocess_event if assets is not None else None
+        for log_data in log_events:
+            try:
+                processed_events.append(preprocess(log_data) if preprocess is not None else log_data)
+            except Exception as e:
+                fail(e)
+
+    # Process the events
+    with invocation_metrics.stage('transform', source_name):
+        eventdays = batch_eventdays(processed_events, source_name)
+        for processed_json, eventday in zip(processed_events, eventdays):
+            try:
+                mapped_event, unmapped_event = process_event(processed_json, source_name, eventday, counts)
+            except Exception as e:
+                fail(e)
+                continue
             if mapped_event:
                 mapped_events.append(mapped_event)
             elif unmapped_event:
                 unmapped_events.append(unmapped_event)
-                
-        except Exception as e:
-            logger.error(f"Error processing line: {str(e)}")
-            unmapped_events.append({"raw": raw_line, "error": str(e)})
-
-    return mapped_events, unmapped_events
 
 # function to process event if received from Kinesis
 def process_kinesis_event(record):
-    logger.info('Processing Kinesis event')
+    """
+    Process a Kinesis record holding one payload or, when written by the KPL
+    with aggregation, many user records
+
+    Payloads are either JSON events naming their source or CloudWatch Logs
+    subscription payloads, whose log events are routed by their log group.
+    Payloads are routed one by one, then the log events of each source are
+    preprocessed and mapped together.
+    """
+    logger.debug('Processing Kinesis event')
     mapped_events = []
     unmapped_events = []
+    counts = invocation_metrics.new_counts()
 
     try:
-        payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
-        logger.debug("Raw log: " + str(payload))
-        
-        try:
-            payload_json = json.loads(payload)
-            
-            # Detect source from Kinesis event
-            source_name = detect_source_from_kinesis(payload_json)
-            if source_name is None:
-                logger.error("Cannot determine source for Kinesis event, skipping processing")
-                unmapped_events.append({"raw": payload, "error": "Source could not be determined"})
-                return mapped_events, unmapped_events
-                
-            logger.info(f"Processing Kinesis event from source: {source_name}")
-            
-            # Extract the actual log data from the message field
-            log_data = payload_json.get('message', payload_json)
-            
-            # Process the log data
-            if source_name in preprocessors:
-                processed_json = preprocessors[source_name](log_data)
+        with invocation_metrics.stage('decode'):
+            payloads = kpl.deaggregate(base64.b64decode(record['kinesis']['data']))
+        if len(payloads) > 1:
+            logger.debug("De-aggregated %d user records from KPL record", len(payloads))
+
+        events_by_source = {}
+        for payload in payloads:
+            if cloudwatch_logs.is_subscription_payload(payload):
+                route_subscription_payload(payload, events_by_source, unmapped_events, counts)
             else:
-                processed_json = log_data
-            
-            # Process the event
-            mapped_event, unmapped_event = process_event(processed_json, source_name)
-            
-            if mapped_event:
-                mapped_events.append(mapped_event)
-            elif unmapped_event:
-                unmapped_events.append(unmapped_event)
-                
-        except json.JSONDecodeError as e:
-            logger.error(f"Error decoding JSON: {e}")
-            unmapped_events.append({"raw": payload, "error": "JSON decode error"})
+                route_kinesis_payload(payload, events_by_source, unmapped_events, counts)
+        for source_name, log_events in events_by_source.items():
+            process_kinesis_batch(source_name, log_events, mapped_events, unmapped_events, counts)
     except Exception as outer_e:
-        logger.error(f"Fatal error processing Kinesis record: {str(outer_e)}")
+        limiter.error(None, 'record', "Fatal error processing Kinesis record: %s", outer_e)
+        count_event(counts, None, None, 'errored')
         unmapped_events.append({"error": f"Fatal Kinesis processing error: {str(outer_e)}"})
-    
+
+    invocation_metrics.add_counts(counts)
     return mapped_events, unmapped_events
 
+# function to return the identifier Lambda expects in batchItemFailures for a record
+def batch_item_identifier(record):
+    """
+    Return the SQS messageId or Kinesis sequence number of a record
+    """
+    if record.get('eventSource') == 'aws:kinesis':
+        return record['kinesis']['sequenceNumber']
+    return record.get('messageId')
+
+# function to drop the mapped events of a record that were already written
+def drop_duplicates(record, mapped, pending):
+    """
+    Filter the mapped events of one record through the duplicate filter
+
+    Returns the kept events, the digest of each kept event to commit once it
+    is written (None for events that can't be fingerprinted) and the number of
+    dropped duplicates. Records without a fingerprint, such as S3
+    notifications without an ETag, are passed through.
+    """
+    prefix = dedup.record_fingerprint(record)
+    if prefix is None or not mapped:
+        return mapped, [None] * len(mapped), 0
+    kept, digests, duplicates = deduplicator.filter(prefix, mapped, pending)
+    if duplicates:
+        # A false positive drops a new event, so every drop is traceable to its record
+        logger.info(f"Dropping {len(duplicates)} of {len(mapped)} events of {prefix} as already written, "
+                    f"estimated false-positive rate {deduplicator.false_positive_rate():.1e}")
+        counts = invocation_metrics.new_counts()
+        for mapped_event in duplicates:
+            count_event(counts, mapped_event['source'], mapped_event.get('matched_value'), 'duplicate')
+        invocation_metrics.add_counts(counts)
+    return kept, digests, len(duplicates)
+
+# function to process the records of a batch, fetching S3 objects concurrently
+def process_records(records, time_left=None):
+    """
+    Process Kinesis and SQS records, yielding (index, mapped, unmapped, error) per record in batch order
+
+    S3 objects referenced by SQS records are fetched, decompressed and mapped
+    on a bounded thread pool sharing one S3 client, while Kinesis records are
+    processed on the calling thread. Large objects are sharded over worker
+    processes forked before the pool starts. time_left returns the seconds
+    left for processing; once it runs out no further records are yielded, so
+    the records after the last yielded index were not processed, and the
+    threads still reading objects stop at their next batch.
+    """
+    s3_indexes = [index for index, record in enumerate(records) if record['eventSource'] == 'aws:sqs']
+    executor = None
+    workers = None
+    stop = threading.Event()
+    s3_futures = {}
+    if s3_indexes:
+        workers = start_transform_workers(records, s3_indexes)
+        get_s3_client()
+        executor = ThreadPoolExecutor(max_workers=min(S3_FETCH_CONCURRENCY, len(s3_indexes)))
+        s3_futures = {index: executor.submit(process_s3_event, records[index], workers, stop) for index in s3_indexes}
+
+    completed = False
+    try:
+        for index, record in enumerate(records):
+            if time_left is not None and time_left() <= 0:
+                logger.warning(f"Deadline reached, leaving {len(records) - index} records unprocessed")
+                return
+            logger.debug("Record eventSource: %s", record['eventSource'])
+            try:
+                if record['eventSource'] == 'aws:kinesis':
+                    logger.debug("Record eventID: %s", record['eventID'])
+                    mapped, unmapped = process_kinesis_event(record)
+                elif record['eventSource'] == 'aws:sqs':
+                    logger.debug("Record messageId: %s", record['messageId'])
+                    mapped, unmapped = s3_futures[index].result(
+                        timeout=max(time_left(), 0) if time_left is not None else None
+                    )
+                else:
+                    logger.info("Event source not supported.")
+                    mapped, unmapped = [], []
+            except FuturesTimeoutError:
+                logger.warning(f"Deadline reached while processing record {index}, leaving {len(records) - index} records unprocessed")
+                return
+            except Exception as e:
+                logger.error(f"Error processing record {index}: {str(e)}")
+                yield index, [], [], e
+                continue
+            yield index, mapped, unmapped, None
+        completed = True
+    finally:
+        if executor is not None:
+            # Don't wait for objects still being read when stopping at the deadline,
+            # but have their threads stop at the next batch
+            stop.set()
+            executor.shutdown(wait=completed, cancel_futures=True)
+        if workers is not None:
+            workers.close()
+
+# function to return the output group of a mapped event
+def output_group_key(mapped_event):
+    """
+    Return the (source, eventday, schema) group a mapped event is written in
+
+    schema is the event's target schema if its source writes each OCSF class
+    to its own files, otherwise None so all classes share one file.
+    """
+    source = mapped_event['source']
+    options = parquet_options.get(source) or ParquetOptions(**PARQUET_DEFAULTS)
+    schema = mapped_event['target_schema'] if options.split_by_class else None
+    return (source, mapped_event['eventday'], schema)
+
+# function to build the Arrow table of one output group
+def build_group_table(source, group, target_schema=None):
+    """
+    Transform a group of mapped events into a table, typed with the source's output schema
+
+    A group holding a single class, written with target_schema, is typed
+    with that class's schema so the file only has the class's columns.
+    """
+    assets = source_assets.get(source)
+    expressions = assets.compiled['expressions']
+    if TRANSFORM_MODE == 'columnar':
+        table = columnar.build_table(assets.column_plans, group, expressions)
+    elif expressions:
+        # Expression fields are computed per matched value over the records' columns
+        table = columnar.build_record_table(group, expressions)
+    else:
+        # Records of different matched values have different keys, so infer the union struct
+        table = pa.Table.from_struct_array(pa.array([mapped_event['target_mapping'] for mapped_event in group]))
+    if target_schema is not None and assets.class_schemas is not None and target_schema in assets.class_schemas:
+        return ocsf_schemas.conform_table(table, assets.class_schemas[target_schema])
+    if assets.output_schema is not None:
+        table = ocsf_schemas.conform_table(table, assets.output_schema)
+    return table
+
+# function to write the mapped events of one output group as Parquet
+def write_group(source, eventday, group, aws_region, aws_account_id, target_schema=None):
+    """
+    Write one Parquet object for a group of mapped events, through Arrow or awswrangler
+
+    target_schema is the group's schema from output_group_key, None when the
+    source writes all its classes to one location
+    """
+    options = parquet_options.get(source) or ParquetOptions(**PARQUET_DEFAULTS)
+    prefix = options.object_prefix(source, eventday, aws_region, aws_account_id, target_schema)
+
+    if TRANSFORM_MODE != 'columnar' and OUTPUT_SCHEMA != 'typed':
+        # Only this writer needs pandas and awswrangler, so they are imported on first use
+        import awswrangler as wr
+        import pandas as pd
+
+        # Extract just the target_mapping column and add schema as a column
+        records = [mapped_event['target_mapping'] for mapped_event in group]
+        if source_assets.get(source).compiled['expressions']:
+            # Expression fields are computed in Arrow, then handed back as records
+            with invocation_metrics.stage('transform', source):
+                records = build_group_table(source, group, target_schema).to_pylist()
+        df_map = pd.json_normalize(records, max_level=0)
+        df_map = options.sort_frame(df_map).reset_index(drop=True)
+
+        s3_url = f's3://{SEC_LAKE_BUCKET}/{prefix}{uuid.uuid4().hex}{options.file_suffix}'
+
+        logger.info(f"Writing {len(df_map)} transformed events to: {s3_url}")
+        wr.s3.to_parquet(
+            df=df_map,
+            path=s3_url,
+            compression=options.compression if options.compression != 'none' else None
+        )
+        logger.info(f"Successfully wrote to: {s3_url}")
+        return
+
+    # Sorted rows give row groups narrow time ranges that queries can skip
+    with invocation_metrics.stage('transform', source):
+        table = build_group_table(source, group, target_schema)
+    table = options.sort_table(table)
+
+    s3_key = f'{prefix}{uuid.uuid4().hex}{options.file_suffix}'
+
+    logger.info(f"Writing {table.num_rows} transformed events to: s3://{SEC_LAKE_BUCKET}/{s3_key}")
+    # Typed tables only dictionary-encode their low-cardinality columns
+    use_dictionary = ocsf_schemas.dictionary_columns(table.schema) if OUTPUT_SCHEMA == 'typed' else True
+    buffer = BytesIO()
+    pq.write_table(table, buffer, use_dictionary=use_dictionary, **options.write_table_kwargs(table))
+    get_s3_client().put_object(
+        Bucket=SEC_LAKE_BUCKET,
+        Key=s3_key,
+        Body=buffer.getvalue()
+    )
+    logger.info(f"Successfully wrote to: s3://{SEC_LAKE_BUCKET}/{s3_key}")
+
 def lambda_handler(event, context):
     aws_account_id = context.invoked_function_arn.split(":")[4]
     aws_region = context.invoked_function_arn.split(":")[3]
 
-    mapped_events = []
-    unmapped_events = []
-
-    for record in event['Records']:
-        logger.info('Record eventSource: '+record['eventSource'])
-        if record['eventSource'] == 'aws:kinesis':
-            logger.info('Record eventID: '+record['eventID'])
-            mapped, unmapped = process_kinesis_event(record)
-            mapped_events.extend(mapped)
-            unmapped_events.extend(unmapped)
-        elif record['eventSource'] == 'aws:sqs':
-            logger.info('Record messageId: '+record['messageId'])
-            mapped, unmapped = process_s3_event(record)
-            mapped_events.extend(mapped)
-            unmapped_events.extend(unmapped)
-        else:
-            logger.info("Event source not supported.")
-
-    if mapped_events:
-        df = pd.DataFrame(mapped_events)
-        # Group by source and eventday only (not by schema)
-        source_groups = df.groupby(['source', 'eventday'])
-        
-        for (source, eventday), group in source_groups:
-            # Extract just the target_mapping column and add schema as a column
-            df_map = pd.json_normalize(group['target_mapping'], max_level=0)
-            
-            # Write all schemas to the same location
-            s3_url = f's3://{SEC_LAKE_BUCKET}/ext/{source}/region={aws_region}/accountId={aws_account_id}/eventDay={eventday}/{uuid.uuid4().hex}.gz.parquet'
-            
-            logger.info(f"Writing {len(df_map)} transformed events to: {s3_url}")
-            wr.s3.to_parquet(
-                df=df_map,
-                path=s3_url,
-                compression='gzip'
-            )
-            logger.info(f"Successfully wrote to: {s3_url}")
-
-    if unmapped_events:
-        logger.info(f'Dropping {len(unmapped_events)} unmapped records.')
-
-    logger.info(f'Successfully processed {len(event["Records"])} records.')
-
-    return
\ No newline at end of file
+    records = event['Records']
+
+    # Stop processing in time to write what was mapped before the function times out
+    time_left = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        def time_left():
+            return (context.get_remaining_time_in_millis() - DEADLINE_RESERVE_MS) / 1000
+
+    # Group by source and eventday, and by schema for sources writing each class apart,
+    # remembering which records fed each group
+    source_groups = {}
+    group_records = {}
+    failed_records = set(range(len(records)))
+    unmapped_count = 0
+    duplicate_count = 0
+    # Fingerprint digests per output group, committed to the duplicate filter as soon as the group
+    # is written, so a retried record only rewrites the groups that failed
+    group_digests = {}
+    pending_digests = set()
+
+    for index, mapped, unmapped, error in process_records(records, time_left):
+        if error is not None:
+            continue
+        failed_records.discard(index)
+        unmapped_count += len(unmapped)
+        digests = None
+        if deduplicator is not None:
+            with invocation_metrics.stage('dedup'):
+                mapped, digests, duplicates = drop_duplicates(records[index], mapped, pending_digests)
+            duplicate_count += duplicates
+        with invocation_metrics.stage('group'):
+            for position, mapped_event in enumerate(mapped):
+                group_key = output_group_key(mapped_event)
+                source_groups.setdefault(group_key, []).append(mapped_event)
+                group_records.setdefault(group_key, set()).add(index)
+                if digests is not None and digests[position] is not None:
+                    group_digests.setdefault(group_key, []).append(digests[position])
+
+    for group_key, group in source_groups.items():
+        source, eventday, target_schema = group_key
+        try:
+            with invocation_metrics.stage('write', source):
+                write_group(source, eventday, group, aws_region, aws_account_id, target_schema)
+            if group_key in group_digests:
+                with invocation_metrics.stage('dedup'):
+                    deduplicator.commit(group_digests[group_key])
+        except Exception as e:
+            # Records feeding a failed write are retried as a whole
+            logger.error(f"Error writing {len(group)} events for source {source}, eventDay {eventday}"
+                         f"{f', class {target_schema}' if target_schema else ''}: {str(e)}")
+            failed_records.update(group_records[(source, eventday, target_schema)])
+
+    if deduplicator is not None:
+        with invocation_metrics.stage('dedup'):
+            deduplicator.save()
+
+    if unmapped_count:
+        logger.info(f'Dropping {unmapped_count} unmapped records.')
+    if duplicate_count:
+        logger.info(f'Dropping {duplicate_count} events already written by an earlier delivery.')
+
+    if failed_records:
+        logger.warning(f'Reporting {len(failed_records)} of {len(records)} records as batch item failures.')
+    logger.info(f'Successfully processed {len(records) - len(failed_records)} records.')
+    limiter.log_summary()
+
+    invocation_metrics.set_value('Records', len(records))
+    invocation_metrics.set_value('BatchItemFailures', len(failed_records))
+    invocation_metrics.set_value('DroppedEvents', unmapped_count)
+    if deduplicator is not None:
+        invocation_metrics.set_value('DroppedDuplicates', duplicate_count)
+    invocation_metrics.flush()
+
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': batch_item_identifier(records[index])}
+            for index in sorted(failed_records)
+        ]
+    }
@@ -0,0 +1,246 @@
+"""
+Backfill module.
+This module reprocesses historical logs of one source from a local directory
+or an S3 prefix, for example after a mapping was added or fixed. It reuses
+the preprocessors, process_event and write_group of the transformation
+function over a process pool, writes the same ext/ partition layout as
+lambda_handler and records finished inputs in a checkpoint file so an
+interrupted run can be resumed.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain
+
+import boto3
+
+from stream_reader import READ_CHUNK_SIZE, iter_decompressed, iter_lines, iter_batches
+
+logger = logging.getLogger()
+
+# Input objects or files processed per task, like the SQS batch of the function
+BACKFILL_BATCH_SIZE = 10
+
+# First bytes of a gzip member
+GZIP_MAGIC = b'\x1f\x8b'
+
+# function to split an s3://bucket/prefix URL
+def parse_s3_url(url):
+    """
+    Return (bucket, prefix) of an s3:// URL
+    """
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+# function to list the inputs of a backfill run
+def list_inputs(location):
+    """
+    Return the files under a local directory or the objects under an S3 prefix
+
+    Args:
+        location (str): Local directory or s3://bucket/prefix URL
+
+    Returns:
+        list: Local paths or s3:// URLs in sorted order
+    """
+    if location.startswith('s3://'):
+        bucket, prefix = parse_s3_url(location)
+        paginator = boto3.client('s3').get_paginator('list_objects_v2')
+        inputs = []
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            inputs.extend(f"s3://{bucket}/{obj['Key']}" for obj in page.get('Contents', [])
+                          if obj['Size'] > 0 and not obj['Key'].endswith('/'))
+        return sorted(inputs)
+
+    inputs = []
+    for root, _, files in os.walk(location):
+        inputs.extend(os.path.join(root, name) for name in files)
+    return sorted(inputs)
+
+# function to stream the lines of one input, gzip or plain text
+def iter_input_lines(location):
+    """
+    Stream the lines of a local file or S3 object, decompressing gzip input
+
+    Args:
+        location (str): Local path or s3:// URL
+
+    Returns:
+        generator: Lines as str
+    """
+    if location.startswith('s3://'):
+        bucket, key = parse_s3_url(location)
+        body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body']
+        chunks = body.iter_chunks(READ_CHUNK_SIZE)
+    else:
+        def read_file():
+            with open(location, 'rb') as f:
+                while True:
+                    chunk = f.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+        chunks = read_file()
+
+    first = next(chunks, b'')
+    chunks = chain([first], chunks)
+    if first.startswith(GZIP_MAGIC):
+        chunks = iter_decompressed(chunks)
+    yield from iter_lines(chunks)
+
+# function to reprocess one batch of inputs in a pool worker
+def backfill_batch(inputs, source_name, aws_region, aws_account_id):
+    """
+    Transform a batch of inputs and write one Parquet object per eventDay, or
+    per eventDay and class for sources writing each OCSF class apart
+
+    Args:
+        inputs (list): Local paths or s3:// URLs
+        source_name (str): Source whose preprocessor and mapping are applied
+        aws_region (str): Region of the ext/ partitions
+        aws_account_id (str): Account of the ext/ partitions
+
+    Returns:
+        dict: Inputs and event counts of the batch
+    """
+    # Imported here so SEC_LAKE_BUCKET and the function settings are set first
+    import app
+
+    groups = {}
+    unmapped_count = 0
+    for location in inputs:
+        raw_batches = iter_batches(iter_input_lines(location), app.PREPROCESS_BATCH_SIZE)
+        mapped, unmapped = app.process_lines(raw_batches, source_name)
+        unmapped_count += len(unmapped)
+        for mapped_event in mapped:
+            groups.setdefault(app.output_group_key(mapped_event), []).append(mapped_event)
+
+    for (_, eventday, target_schema), group in groups.items():
+        app.write_group(source_name, eventday, group, aws_region, aws_account_id, target_schema)
+    app.limiter.log_summary()
+
+    return {
+        'inputs': inputs,
+        'mapped': sum(len(group) for group in groups.values()),
+        'unmapped': unmapped_count,
+        'files': len(groups)
+    }
+
+# function to read the inputs finished by earlier runs
+def load_checkpoint(path):
+    """
+    Return the set of inputs recorded in a checkpoint file
+    """
+    done = set()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    done.add(json.loads(line)['input'])
+    return done
+
+# function to record finished inputs
+def append_checkpoint(path, result):
+    """
+    Append the inputs of a finished batch to the checkpoint file
+    """
+    with open(path, 'a') as f:
+        for location in result['inputs']:
+            f.write(json.dumps({'input': location}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def run_backfill(source_name, location, aws_region, aws_account_id, workers=None, checkpoint=None,
+                 batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Reprocess every input under a location that the checkpoint doesn't list yet
+
+    Inputs are recorded in the checkpoint once the Parquet objects of their
+    batch were written; a batch that fails is left out and retried by the
+    next run.
+
+    Args:
+        source_name (str): Source whose preprocessor and mapping are applied
+        location (str): Local directory or s3://bucket/prefix URL
+        aws_region (str): Region of the ext/ partitions
+        aws_account_id (str): Account of the ext/ partitions
+        workers (int): Pool processes, None for one per CPU
+        checkpoint (str): Checkpoint file path, None to disable resuming
+        batch_size (int): Inputs per task
+
+    Returns:
+        dict: Totals of the run
+    """
+    done = load_checkpoint(checkpoint)
+    inputs = [location for location in list_inputs(location) if location not in done]
+    logger.info(f"Backfilling {len(inputs)} inputs for source {source_name}, {len(done)} already done")
+    batches = [inputs[i:i + batch_size] for i in range(0, len(inputs), batch_size)]
+
+    totals = {'inputs': 0, 'mapped': 0, 'unmapped': 0, 'files': 0, 'failed_batches': 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(backfill_batch, batch, source_name, aws_region, aws_account_id): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Backfill of {len(futures[future])} inputs starting at {futures[future][0]} failed: {str(e)}")
+                totals['failed_batches'] += 1
+                continue
+            if checkpoint:
+                append_checkpoint(checkpoint, result)
+            totals['inputs'] += len(result['inputs'])
+            for key in ('mapped', 'unmapped', 'files'):
+                totals[key] += result[key]
+            logger.info(f"Backfilled {totals['inputs']} of {len(inputs)} inputs")
+    return totals
+
+def main():
+    """
+    Command line entry point
+    """
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description='Reprocess historical logs of one source into Security Lake ext/ partitions')
+    parser.add_argument('input', help='Local directory or s3://bucket/prefix holding the raw logs')
+    parser.add_argument('--source', required=True, help='Source name from sources_config.json')
+    parser.add_argument('--bucket', default=os.environ.get('SEC_LAKE_BUCKET'), help='Security Lake bucket')
+    parser.add_argument('--region', help='Region of the partitions (default the session region)')
+    parser.add_argument('--account-id', help='Account of the partitions (default the caller account)')
+    parser.add_argument('--workers', type=int, help='Worker processes (default one per CPU)')
+    parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE,
+                        help=f'Inputs written together per task (default {BACKFILL_BATCH_SIZE})')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default backfill-<source>.checkpoint.jsonl)')
+    args = parser.parse_args()
+    if not args.bucket:
+        parser.error('--bucket or SEC_LAKE_BUCKET is required')
+
+    # The function settings are read when app is imported in the workers
+    os.environ['SEC_LAKE_BUCKET'] = args.bucket
+    # The pool already uses every CPU, so don't shard objects again inside a worker
+    os.environ['TRANSFORM_WORKERS'] = '1'
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sources_config.json')) as f:
+        source_names = [source['name'] for source in json.load(f)['sources']]
+    if args.source not in source_names:
+        parser.error(f"Unknown source {args.source}, expected one of {', '.join(source_names)}")
+
+    aws_region = args.region or boto3.session.Session().region_name
+    aws_account_id = args.account_id or boto3.client('sts').get_caller_identity()['Account']
+    totals = run_backfill(
+        args.source, args.input, aws_region, aws_account_id,
+        workers=args.workers,
+        checkpoint=args.checkpoint or f'backfill-{args.source}.checkpoint.jsonl',
+        batch_size=args.batch_size
+    )
+    print(json.dumps(totals))
+    if totals['failed_batches']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
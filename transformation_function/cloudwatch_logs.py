@@ -0,0 +1,58 @@
+"""
+CloudWatch Logs subscription module.
+This module reads the payloads a CloudWatch Logs subscription filter writes
+to a Kinesis data stream. Each payload is a gzip-compressed JSON envelope
+naming the log group and carrying a batch of log events, or a control
+message CloudWatch Logs sends to check that the destination is reachable.
+"""
+import logging
+import zlib
+
+import json_decoder
+
+logger = logging.getLogger()
+
+# First bytes of a gzip stream
+GZIP_MAGIC = b'\x1f\x8b'
+
+# messageType of the envelopes carrying log events
+DATA_MESSAGE = 'DATA_MESSAGE'
+
+# messageType of the reachability checks, which carry no log data
+CONTROL_MESSAGE = 'CONTROL_MESSAGE'
+
+def is_subscription_payload(data):
+    """
+    Return True if Kinesis payload bytes are gzip-compressed, as subscription payloads are
+    """
+    return data[:len(GZIP_MAGIC)] == GZIP_MAGIC
+
+def read_subscription(data):
+    """
+    Decompress and decode a subscription payload
+
+    Args:
+        data (bytes): Gzip-compressed payload of a Kinesis record
+
+    Returns:
+        tuple: (log group, list of log event messages), or None for a control message
+
+    Raises:
+        ValueError: If the payload isn't a subscription envelope; JSON and
+            UTF-8 decoding errors are ValueErrors too
+    """
+    try:
+        # wbits=31 reads the gzip header and trailer in one call
+        envelope = json_decoder.loads(zlib.decompress(data, 31).decode('utf-8'))
+    except zlib.error as e:
+        raise ValueError(f'Could not decompress subscription payload: {str(e)}') from e
+    if type(envelope) is not dict:
+        raise ValueError('Subscription payload is not a JSON object')
+
+    message_type = envelope.get('messageType')
+    if message_type == CONTROL_MESSAGE:
+        logger.debug("Dropping CloudWatch Logs control message")
+        return None
+    if message_type != DATA_MESSAGE or type(envelope.get('logEvents')) is not list:
+        raise ValueError(f'Unsupported subscription message type: {message_type}')
+    return envelope.get('logGroup'), [log_event.get('message') for log_event in envelope['logEvents']]
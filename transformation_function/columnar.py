@@ -0,0 +1,361 @@
+"""
+Columnar batch transform module.
+This module maps a batch of preprocessed events for one source straight into
+Arrow columns, field by field, instead of building a nested dict per record.
+"""
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from mapping_compiler import compile_locator
+from log_limiter import limiter
+from expressions import apply_expressions, split_mapping
+
+logger = logging.getLogger()
+
+_MISSING = object()
+
+def _compile_node(node):
+    """
+    Compile a schema_mapping node into a column plan node
+
+    Args:
+        node: A value from a schema_mapping tree
+
+    Returns:
+        tuple: Plan node, or None if the interpreter leaves the key out
+    """
+    try:
+        if type(node) is dict:
+            if 'enum' in node:
+                enum = node['enum']
+                evaluate = enum['evaluate']
+                if not (isinstance(evaluate, str) and evaluate.startswith('$.')):
+                    return None
+                return ('enum', evaluate, compile_locator(evaluate),
+                        evaluate.split('.')[1] == 'UserDefined',
+                        enum['values'], enum.get('other', _MISSING))
+            children = []
+            for key, child in node.items():
+                plan = _compile_node(child)
+                if plan is not None:
+                    children.append((key, plan))
+            return ('struct', tuple(children))
+        if isinstance(node, str) and node.startswith('$.'):
+            return ('locator', node, compile_locator(node),
+                    node.split('.')[1] == 'UserDefined')
+        return ('constant', node)
+    except Exception as e:
+        return ('error', e)
+
+def compile_column_plan(event_mapping):
+    """
+    Compile a schema_mapping tree into a column plan for build_columns
+
+    Args:
+        event_mapping (dict): The schema_mapping of one ocsf_mapping entry
+
+    Returns:
+        tuple: (key, plan node) pairs for the top-level columns
+    """
+    return _compile_node(event_mapping)[1]
+
+def compile_source_plans(mapping):
+    """
+    Compile the column plans for every matched value of a mapping file
+
+    Expression nodes are planned as null columns and filled in by
+    build_table with the expressions from compile_source_mapping.
+
+    Args:
+        mapping (dict): Parsed mapping file with custom_source_events
+
+    Returns:
+        dict: Column plan per matched value in ocsf_mapping
+    """
+    return {
+        matched_value: compile_column_plan(split_mapping(event_mapping['schema_mapping'])[0])
+        for matched_value, event_mapping in mapping['custom_source_events']['ocsf_mapping'].items()
+    }
+
+def _extract(key, locate, events, source=None):
+    """
+    Extract the located value of every event, nulling values that fail
+
+    Args:
+        key (str): Target field name, used for error reporting
+        locate (function): Compiled locator
+        events (list): Preprocessed events
+        source (str): Source the warnings are rate-limited for
+
+    Returns:
+        list: Located values in event order
+    """
+    try:
+        return [locate(event) for event in events]
+    except Exception:
+        pass
+    values = []
+    for event in events:
+        try:
+            values.append(locate(event))
+        except Exception as e:
+            limiter.warning(source, key, "Error transforming field %s: %s, setting to null", key, e)
+            values.append(None)
+    return values
+
+def _to_array(values, user_defined):
+    """
+    Build an Arrow array from located values
+
+    Locator values are strings, so they get a string column; UserDefined
+    values are taken as-is and fall back to strings if they don't share a type.
+    """
+    if not user_defined:
+        return pa.array(values, type=pa.string())
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([str(v) if v is not None else None for v in values], type=pa.string())
+
+def _constant_column(value, length):
+    """
+    Broadcast a constant mapping value, dictionary-encoding strings
+    """
+    if isinstance(value, str):
+        return pa.DictionaryArray.from_arrays(
+            pa.repeat(pa.scalar(0, type=pa.int32()), length),
+            pa.array([value], type=pa.string())
+        )
+    if value is None:
+        return pa.nulls(length)
+    return pa.repeat(pa.scalar(value), length)
+
+def _enum_column(key, plan, events, source=None):
+    """
+    Resolve an enum field for a batch with a vectorized table lookup
+    """
+    _, _, locate, user_defined, values, other = plan
+    keys = _extract(key, locate, events, source)
+    if not user_defined:
+        try:
+            lookup = pa.array(list(values.values()) + ([other] if other is not _MISSING else []))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Enum values of mixed types can't share a lookup array, resolve them one by one
+            lookup = None
+        if lookup is not None:
+            indices = pc.index_in(pa.array(keys, type=pa.string()),
+                                  value_set=pa.array(list(values.keys()), type=pa.string()))
+            missing_other = 0
+            if other is not _MISSING:
+                indices = indices.fill_null(len(values))
+            else:
+                missing_other = indices.null_count
+            return _warn_missing_other(key, missing_other, lookup.take(indices), source)
+    resolved = []
+    for value in keys:
+        try:
+            resolved.append(values[value] if value in values else other)
+        except TypeError as e:
+            limiter.warning(source, key, "Error transforming field %s: %s, setting to null", key, e)
+            resolved.append(None)
+    missing_other = resolved.count(_MISSING)
+    resolved = [None if value is _MISSING else value for value in resolved]
+    return _warn_missing_other(key, missing_other, _to_array(resolved, True), source)
+
+def _warn_missing_other(key, count, column, source=None):
+    """
+    Log once for enum values with no match and no 'other' fallback
+    """
+    if count:
+        limiter.warning(source, key, "Error transforming field %s: 'other' missing for %d events, setting to null",
+                        key, count, count=count)
+    return column
+
+def _locator_column(key, plan, events, source=None):
+    """
+    Extract a locator field for a batch into a typed column
+    """
+    _, dot_locator, locate, user_defined = plan
+    values = _extract(key, locate, events, source)
+    column = _to_array(values, user_defined)
+    if column.null_count:
+        # Field not found but continue processing
+        limiter.warning(source, dot_locator, "Field %s not found in %d events, setting to null",
+                        dot_locator, column.null_count, count=column.null_count)
+    return column
+
+def _build_column(key, plan, events, source=None):
+    """
+    Build the column for one plan node over a batch of events
+    """
+    kind = plan[0]
+    if kind == 'constant':
+        return _constant_column(plan[1], len(events))
+    if kind == 'locator':
+        return _locator_column(key, plan, events, source)
+    if kind == 'enum':
+        return _enum_column(key, plan, events, source)
+    if kind == 'struct':
+        return _struct_column(plan[1], events, source)
+    limiter.warning(source, key, "Error transforming field %s: %s, setting to null", key, plan[1], count=len(events))
+    return pa.nulls(len(events))
+
+def _struct_column(children, events, source=None):
+    """
+    Build a struct column from the plan nodes of a nested mapping dict
+    """
+    if not children:
+        return pa.array([{}] * len(events), type=pa.struct([]))
+    arrays = [_build_column(key, plan, events, source) for key, plan in children]
+    return pa.StructArray.from_arrays(arrays, names=[key for key, _ in children])
+
+def build_columns(plan, events, source=None):
+    """
+    Map a batch of events sharing one schema_mapping into an Arrow table
+
+    Args:
+        plan (tuple): Column plan from compile_column_plan
+        events (list): Preprocessed events matched to that mapping
+        source (str): Source the field warnings are rate-limited for
+
+    Returns:
+        pyarrow.Table: One column per top-level mapping key
+    """
+    arrays = [_build_column(key, node, events, source) for key, node in plan]
+    return pa.Table.from_arrays(arrays, names=[key for key, _ in plan])
+
+def merge_types(left, right):
+    """
+    Merge two column types into one that can hold both
+    """
+    if left == right:
+        return left
+    if pa.types.is_null(left):
+        return right
+    if pa.types.is_null(right):
+        return left
+    if pa.types.is_struct(left) and pa.types.is_struct(right):
+        merged = {field.name: field.type for field in left}
+        for field in right:
+            merged[field.name] = merge_types(merged[field.name], field.type) if field.name in merged else field.type
+        return pa.struct(list(merged.items()))
+    if pa.types.is_dictionary(left):
+        return merge_types(left.value_type, right)
+    if pa.types.is_dictionary(right):
+        return merge_types(left, right.value_type)
+    # Incompatible leaf types fall back to strings
+    return pa.string()
+
+def _conform(column, target):
+    """
+    Cast a column to a merged type, adding null children to structs
+    """
+    if column.type == target:
+        return column
+    if pa.types.is_null(column.type):
+        return pa.nulls(len(column), type=target)
+    if pa.types.is_struct(target):
+        names = {field.name for field in column.type}
+        children = [
+            _conform(column.field(field.name), field.type) if field.name in names else pa.nulls(len(column), type=field.type)
+            for field in target
+        ]
+        mask = column.is_null() if column.null_count else None
+        return pa.StructArray.from_arrays(children, fields=list(target), mask=mask)
+    return column.cast(target)
+
+def concat_tables(tables):
+    """
+    Concatenate tables with different columns into one union table
+
+    Columns keep the order in which they first appear, missing columns are
+    filled with nulls and struct columns are widened to the union of fields.
+
+    Args:
+        tables (list): pyarrow.Table objects
+
+    Returns:
+        pyarrow.Table: Union of all rows
+    """
+    if len(tables) == 1:
+        return tables[0]
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types[field.name] = merge_types(types[field.name], field.type) if field.name in types else field.type
+    conformed = []
+    for table in tables:
+        arrays = [
+            _conform(table.column(name).combine_chunks(), column_type) if name in table.column_names
+            else pa.nulls(table.num_rows, type=column_type)
+            for name, column_type in types.items()
+        ]
+        conformed.append(pa.Table.from_arrays(arrays, names=list(types)))
+    return pa.concat_tables(conformed)
+
+def _build_batches(entries, build_batch):
+    """
+    Build one table per matched value of a group of entries and combine them in entry order
+    """
+    batches = {}
+    for index, entry in enumerate(entries):
+        batch = batches.setdefault(entry['matched_value'], ([], []))
+        batch[0].append(index)
+        batch[1].append(entry)
+
+    tables = []
+    order = []
+    for matched_value, (indices, batch) in batches.items():
+        tables.append(build_batch(matched_value, batch, batch[0]['source']))
+        order.extend(indices)
+
+    table = concat_tables(tables)
+    if len(tables) > 1:
+        table = table.take(pc.sort_indices(pa.array(order)))
+    return table
+
+def build_table(plans, entries, expressions=None):
+    """
+    Transform a group of mapped entries for one source into one Arrow table
+
+    Entries are batched per matched value, mapped column by column and
+    combined back in their original order.
+
+    Args:
+        plans (dict): Column plans per matched value from compile_source_plans
+        entries (list): Results of process_event in columnar mode
+        expressions (dict): Expressions per matched value from compile_source_mapping
+
+    Returns:
+        pyarrow.Table: Transformed OCSF records
+    """
+    expressions = expressions or {}
+
+    def build_batch(matched_value, batch, source):
+        table = build_columns(plans[matched_value], [entry['event'] for entry in batch], source)
+        if matched_value in expressions:
+            table = apply_expressions(table, expressions[matched_value], source)
+        return table
+    return _build_batches(entries, build_batch)
+
+def build_record_table(entries, expressions):
+    """
+    Combine records transformed in record mode into one Arrow table, evaluating expressions
+
+    Records are batched per matched value so each batch has the columns its
+    expressions read, then combined back in their original order.
+
+    Args:
+        entries (list): Results of process_event in record mode
+        expressions (dict): Expressions per matched value from compile_source_mapping
+
+    Returns:
+        pyarrow.Table: Transformed OCSF records
+    """
+    def build_batch(matched_value, batch, source):
+        table = pa.Table.from_struct_array(pa.array([entry['target_mapping'] for entry in batch]))
+        if matched_value in expressions:
+            table = apply_expressions(table, expressions[matched_value], source)
+        return table
+    return _build_batches(entries, build_batch)
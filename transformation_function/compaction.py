@@ -0,0 +1,548 @@
+"""
+Partition compaction module.
+This module merges the small Parquet files the transformation function writes
+under ext/{source}/region=.../accountId=.../eventDay=... into target-sized
+files. It runs as a scheduled Lambda handler (compaction.compaction_handler)
+or from the command line.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+import ocsf_schemas
+from parquet_options import ParquetOptions, load_parquet_options
+from source_assets import SourceAssetCache
+
+# Files below this size are merged
+COMPACTION_SMALL_FILE_BYTES = int(os.environ.get('COMPACTION_SMALL_FILE_BYTES', str(64 * 1024 * 1024)))
+
+# Approximate size of each compacted file
+COMPACTION_TARGET_FILE_BYTES = int(os.environ.get('COMPACTION_TARGET_FILE_BYTES', str(128 * 1024 * 1024)))
+
+# Rows buffered per output row group unless the source sets row_group_size
+COMPACTION_ROW_GROUP_SIZE = 1024 * 1024
+
+# Time kept in reserve to finish the file being compacted before the Lambda timeout
+COMPACTION_DEADLINE_MARGIN_MS = 60000
+
+# Age below which a swap manifest may belong to a run still in progress and is left alone
+COMPACTION_MANIFEST_LEASE_SECONDS = int(os.environ.get('COMPACTION_MANIFEST_LEASE_SECONDS', '3600'))
+
+# Whether the function writes typed files, which compacted files are cast back to
+OUTPUT_SCHEMA = os.environ.get('OUTPUT_SCHEMA', 'inferred').lower()
+
+# Prefix of compacted objects and of the manifests recording a swap in progress.
+# Query engines skip files whose name starts with an underscore.
+COMPACTED_PREFIX = 'compacted-'
+MANIFEST_PREFIX = '_compaction-'
+
+# Configure logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+if os.environ.get('DEBUG', 'false').lower() == 'true':
+    logger.setLevel(logging.DEBUG)
+
+# Load the source configuration for the per-source Parquet settings
+current_dir = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(current_dir, 'sources_config.json')) as f:
+    sources_config = json.load(f)
+
+PARQUET_DEFAULTS = {
+    'compression': os.environ.get('PARQUET_COMPRESSION', 'gzip'),
+    'row_group_size': os.environ.get('PARQUET_ROW_GROUP_SIZE') or None,
+    'sort_by': os.environ.get('PARQUET_SORT_BY', 'time'),
+    'bloom_filter_columns': os.environ.get('PARQUET_BLOOM_FILTER_COLUMNS', ''),
+    'partition_by': os.environ.get('OUTPUT_PARTITIONING', 'source')
+}
+
+parquet_options = load_parquet_options(sources_config, PARQUET_DEFAULTS)
+
+# Typed output schemas of the sources, built on first use
+source_assets = SourceAssetCache(sources_config, current_dir, typed_output=OUTPUT_SCHEMA == 'typed')
+
+# function to list the objects under a prefix
+def list_objects(s3_client, bucket, prefix):
+    """
+    Return the objects under a prefix as dicts with Key, Size and LastModified
+    """
+    objects = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    return objects
+
+# function to list the sub-prefixes one level below a prefix
+def list_prefixes(s3_client, bucket, prefix):
+    """
+    Return the common prefixes directly below a prefix, e.g. 'ext/aws-alb/'
+    """
+    prefixes = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(common['Prefix'] for common in page.get('CommonPrefixes', []))
+    return prefixes
+
+def find_partitions(s3_client, bucket, event_day, sources=None):
+    """
+    Find the eventDay partitions of a day across sources, regions and accounts
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Security Lake bucket
+        event_day (str): Partition day as YYYYMMDD
+        sources (list): Source names to compact, None for every source under ext/
+
+    Returns:
+        list: Partition prefixes ending in '/'
+    """
+    if sources is None:
+        source_prefixes = list_prefixes(s3_client, bucket, 'ext/')
+    else:
+        source_prefixes = [f'ext/{source}/' for source in sources]
+        if any(_options(source).split_by_class for source in sources):
+            # Sources writing each class apart also have ext/{source}-{schema}/ locations
+            for prefix in list_prefixes(s3_client, bucket, 'ext/'):
+                if any(_options(source).split_by_class and prefix.startswith(f'ext/{source}-') for source in sources):
+                    source_prefixes.append(prefix)
+
+    partitions = []
+    for source_prefix in source_prefixes:
+        for region_prefix in list_prefixes(s3_client, bucket, source_prefix):
+            for account_prefix in list_prefixes(s3_client, bucket, region_prefix):
+                partition = f'{account_prefix}eventDay={event_day}/'
+                if partition in list_prefixes(s3_client, bucket, account_prefix):
+                    partitions.append(partition)
+    return partitions
+
+def _file_name(key):
+    """
+    Return the object name after the last '/'
+    """
+    return key.rsplit('/', 1)[-1]
+
+def _delete_keys(s3_client, bucket, keys):
+    """
+    Delete objects in requests of up to 1000 keys
+    """
+    for start in range(0, len(keys), 1000):
+        response = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]], 'Quiet': True}
+        )
+        for error in response.get('Errors', []):
+            logger.error(f"Could not delete {error.get('Key')}: {error.get('Message')}")
+
+def _object_exists(s3_client, bucket, key):
+    """
+    Return True if an object exists
+    """
+    try:
+        s3_client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def recover_swaps(s3_client, bucket, objects, lease_seconds=COMPACTION_MANIFEST_LEASE_SECONDS):
+    """
+    Finish or roll back swaps interrupted by an earlier run
+
+    A manifest whose compacted file was uploaded has its input files deleted,
+    otherwise the inputs are left in place. The manifest is removed either way.
+    Manifests younger than lease_seconds may belong to a run still swapping
+    files in, so they are left alone and their files kept out of this run.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Security Lake bucket
+        objects (list): Objects of the partition
+        lease_seconds (int): Minimum manifest age before it is acted on
+
+    Returns:
+        set: Keys deleted while recovering or held by a swap in progress
+    """
+    deleted = set()
+    lease_start = datetime.now(timezone.utc) - timedelta(seconds=lease_seconds)
+    for manifest in objects:
+        if not _file_name(manifest['Key']).startswith(MANIFEST_PREFIX):
+            continue
+        body = json.loads(s3_client.get_object(Bucket=bucket, Key=manifest['Key'])['Body'].read())
+        if manifest['LastModified'] > lease_start:
+            logger.info(f"Leaving compaction into {body['output']} to the run that started it")
+            deleted.update(body['inputs'])
+            deleted.update((body['output'], manifest['Key']))
+            continue
+        if _object_exists(s3_client, bucket, body['output']):
+            logger.info(f"Completing interrupted compaction into {body['output']}")
+            _delete_keys(s3_client, bucket, body['inputs'])
+            deleted.update(body['inputs'])
+        else:
+            logger.info(f"Rolling back interrupted compaction into {body['output']}")
+        s3_client.delete_object(Bucket=bucket, Key=manifest['Key'])
+        deleted.add(manifest['Key'])
+    return deleted
+
+def plan_bins(objects, small_file_bytes=COMPACTION_SMALL_FILE_BYTES, target_file_bytes=COMPACTION_TARGET_FILE_BYTES):
+    """
+    Group the small Parquet files of a partition into bins of about target size
+
+    Files are taken in write order so each compacted file covers a contiguous
+    stretch of the day; bins with a single file are left alone.
+
+    Args:
+        objects (list): Objects of the partition
+        small_file_bytes (int): Files below this size are merged
+        target_file_bytes (int): Approximate size of each compacted file
+
+    Returns:
+        list: Bins as lists of objects
+    """
+    candidates = sorted(
+        (
+            obj for obj in objects
+            if obj['Key'].endswith('.parquet')
+            and not _file_name(obj['Key']).startswith(('_', '.'))
+            and obj['Size'] < small_file_bytes
+        ),
+        key=lambda obj: (obj['LastModified'], obj['Key'])
+    )
+
+    bins = []
+    current = []
+    current_bytes = 0
+    for obj in candidates:
+        if current and current_bytes + obj['Size'] > target_file_bytes:
+            bins.append(current)
+            current = []
+            current_bytes = 0
+        current.append(obj)
+        current_bytes += obj['Size']
+    bins.append(current)
+    return [group for group in bins if len(group) > 1]
+
+def _fits(actual, target):
+    """
+    Return True if a column of type actual is conformed to target without losing values
+
+    Structs may lack children of the target, which are filled with nulls.
+    """
+    if pa.types.is_dictionary(actual):
+        actual = actual.value_type
+    if pa.types.is_dictionary(target):
+        target = target.value_type
+    if actual == target or pa.types.is_null(actual):
+        return True
+    if pa.types.is_struct(actual) and pa.types.is_struct(target):
+        children = {field.name: field.type for field in target}
+        return all(field.name in children and _fits(field.type, children[field.name]) for field in actual)
+    return False
+
+def _union_type(left, right):
+    """
+    Return a type holding the columns of both types without conversion, None if there is none
+    """
+    if pa.types.is_null(left) or _fits(right, left):
+        return right if pa.types.is_null(left) else left
+    if _fits(left, right):
+        return right
+    if pa.types.is_struct(left) and pa.types.is_struct(right):
+        children = {field.name: field.type for field in left}
+        for field in right:
+            children[field.name] = _union_type(children[field.name], field.type) if field.name in children else field.type
+            if children[field.name] is None:
+                return None
+        return pa.struct(list(children.items()))
+    return None
+
+def compacted_schema(schemas, typed_schema=None):
+    """
+    Return the schema a bin of files is compacted to, None if they can't be reconciled
+
+    Columns of the typed schema keep its types, and the files must hold them
+    with those types, as the function writes them. Other columns must have
+    the same type in every file, apart from struct children missing in some.
+    Types are never widened, so a file written with other types (for
+    example by the inferred writer) leaves its bin uncompacted.
+
+    Args:
+        schemas (list): Arrow schemas of the input files
+        typed_schema (pyarrow.Schema): Typed output schema of the location, None if not typed
+
+    Returns:
+        pyarrow.Schema: Typed schema followed by the other columns, or None
+    """
+    types = {field.name: field.type for field in typed_schema} if typed_schema is not None else {}
+    for schema in schemas:
+        for field in schema:
+            if typed_schema is not None and field.name in typed_schema.names:
+                if not _fits(field.type, types[field.name]):
+                    return None
+            elif field.name in types:
+                types[field.name] = _union_type(types[field.name], field.type)
+                if types[field.name] is None:
+                    return None
+            else:
+                types[field.name] = field.type
+    return pa.schema(list(types.items()))
+
+def merge_files(paths, output_path, options, typed_schema=None):
+    """
+    Merge local Parquet files into one, streaming row groups
+
+    Files are conformed to the schema from compacted_schema, so typed
+    columns keep their types; rows are buffered only up to one output row group.
+
+    Args:
+        paths (list): Local paths of the input files
+        output_path (str): Local path of the compacted file
+        options (ParquetOptions): Parquet settings of the source
+        typed_schema (pyarrow.Schema): Typed output schema of the location, None if not typed
+
+    Returns:
+        int: Rows written
+
+    Raises:
+        ValueError: If the files can't be reconciled with the typed schema or each other
+    """
+    files = [pq.ParquetFile(path) for path in paths]
+    schema = compacted_schema([parquet_file.schema_arrow for parquet_file in files], typed_schema)
+    if schema is None:
+        raise ValueError("Input files have column types that differ from the output schema or each other")
+    row_group_size = options.row_group_size or COMPACTION_ROW_GROUP_SIZE
+
+    kwargs = options.write_table_kwargs(schema.empty_table())
+    # Inputs are each sorted but their union is not
+    kwargs.pop('sorting_columns', None)
+    kwargs.pop('row_group_size', None)
+    if 'bloom_filter_options' in kwargs:
+        total_rows = max(sum(parquet_file.metadata.num_rows for parquet_file in files), 1)
+        kwargs['bloom_filter_options'] = {
+            path: {**filters, 'ndv': total_rows} for path, filters in kwargs['bloom_filter_options'].items()
+        }
+
+    rows = 0
+    pending = []
+    pending_rows = 0
+    with pq.ParquetWriter(output_path, schema, use_dictionary=ocsf_schemas.dictionary_columns(schema), **kwargs) as writer:
+        for parquet_file in files:
+            for index in range(parquet_file.num_row_groups):
+                table = ocsf_schemas.conform_table(parquet_file.read_row_group(index), schema)
+                pending.append(table)
+                pending_rows += table.num_rows
+                if pending_rows >= row_group_size:
+                    writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+                    rows += pending_rows
+                    pending = []
+                    pending_rows = 0
+        if pending:
+            writer.write_table(pa.concat_tables(pending), row_group_size=row_group_size)
+            rows += pending_rows
+    return rows
+
+def compact_bin(s3_client, bucket, partition, group, options, work_dir, typed_schema=None):
+    """
+    Merge one bin of files into a compacted file and swap it in
+
+    Every input of the bin is downloaded to work_dir before merging, so it
+    needs room for the whole bin plus the output, about twice
+    COMPACTION_TARGET_FILE_BYTES.
+
+    The swap writes a manifest listing the inputs, uploads the compacted file
+    and then deletes the inputs and the manifest. S3 has no atomic rename, so
+    between the upload and the deletes readers of the partition see the bin's
+    rows twice, once in the compacted file and once in its inputs. A run
+    interrupted at any point is completed or rolled back by recover_swaps, so
+    no rows are lost and the duplicates don't outlive the next run.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Security Lake bucket
+        partition (str): Partition prefix ending in '/'
+        group (list): Objects to merge
+        options (ParquetOptions): Parquet settings of the source
+        work_dir (str): Local directory for downloads and the output file
+        typed_schema (pyarrow.Schema): Typed output schema of the location, None if not typed
+
+    Returns:
+        str: Key of the compacted file
+
+    Raises:
+        ValueError: If the files can't be reconciled, before anything is uploaded
+    """
+    paths = []
+    for index, obj in enumerate(group):
+        path = os.path.join(work_dir, f'input-{index}.parquet')
+        s3_client.download_file(bucket, obj['Key'], path)
+        paths.append(path)
+
+    output_path = os.path.join(work_dir, 'output.parquet')
+    try:
+        rows = merge_files(paths, output_path, options, typed_schema)
+    finally:
+        for path in paths:
+            os.remove(path)
+
+    compaction_id = uuid.uuid4().hex
+    output_key = f'{partition}{COMPACTED_PREFIX}{compaction_id}{options.file_suffix}'
+    manifest_key = f'{partition}{MANIFEST_PREFIX}{compaction_id}.json'
+    inputs = [obj['Key'] for obj in group]
+
+    s3_client.put_object(
+        Bucket=bucket,
+        Key=manifest_key,
+        Body=json.dumps({'output': output_key, 'inputs': inputs}).encode('utf-8')
+    )
+    s3_client.upload_file(output_path, bucket, output_key)
+    _delete_keys(s3_client, bucket, inputs)
+    s3_client.delete_object(Bucket=bucket, Key=manifest_key)
+
+    os.remove(output_path)
+    logger.info(f"Compacted {len(group)} files with {rows} rows into s3://{bucket}/{output_key}")
+    return output_key
+
+def _source_from_partition(partition):
+    """
+    Return the source name of an ext/{source}/... partition prefix
+    """
+    return partition.split('/')[1]
+
+def _options(source):
+    """
+    Return the Parquet options of a source name or ext/ location name
+
+    Locations of sources writing each class apart are named {source}-{schema}
+    and use the options of their source.
+    """
+    if source in parquet_options:
+        return parquet_options[source]
+    for name, options in parquet_options.items():
+        if options.split_by_class and source.startswith(f'{name}-'):
+            return options
+    return ParquetOptions(**PARQUET_DEFAULTS)
+
+def _typed_schema(location):
+    """
+    Return the typed schema of the files under an ext/ location name, None if they aren't typed
+
+    Locations of sources writing each class apart hold the schema of one class.
+    """
+    if OUTPUT_SCHEMA != 'typed':
+        return None
+    for name in source_assets.sources:
+        options = _options(name)
+        if not options.split_by_class:
+            if name == location:
+                assets = source_assets.get(name)
+                return assets.output_schema if assets is not None else None
+            continue
+        assets = source_assets.get(name)
+        for schema_name, schema in ((assets.class_schemas or {}) if assets is not None else {}).items():
+            if options.object_prefix(name, '', '', '', schema_name).split('/')[1] == location:
+                return schema
+    return None
+
+def compact_partition(s3_client, bucket, partition, deadline=None):
+    """
+    Compact the small files of one partition
+
+    Bins are cast to the location's typed schema; at the first bin whose
+    files can't be reconciled with it the rest of the partition is left
+    uncompacted.
+
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Security Lake bucket
+        partition (str): Partition prefix ending in '/'
+        deadline (function): Returns False once no new bin should be started
+
+    Returns:
+        dict: Number of bins compacted and skipped for the deadline
+    """
+    objects = list_objects(s3_client, bucket, partition)
+    recovered = recover_swaps(s3_client, bucket, objects)
+    objects = [obj for obj in objects if obj['Key'] not in recovered]
+
+    location = _source_from_partition(partition)
+    options = _options(location)
+    typed_schema = _typed_schema(location)
+    bins = plan_bins(objects)
+    logger.info(f"Found {len(bins)} bins to compact in s3://{bucket}/{partition}")
+
+    compacted = 0
+    with tempfile.TemporaryDirectory() as work_dir:
+        for group in bins:
+            if deadline is not None and not deadline():
+                logger.warning(f"Stopping compaction of s3://{bucket}/{partition} before the deadline")
+                break
+            try:
+                compact_bin(s3_client, bucket, partition, group, options, work_dir, typed_schema)
+            except ValueError as e:
+                logger.warning(f"Leaving the rest of s3://{bucket}/{partition} uncompacted: {str(e)}")
+                break
+            compacted += 1
+    return {'compacted': compacted, 'remaining': len(bins) - compacted}
+
+def compaction_handler(event, context):
+    """
+    Scheduled Lambda entry point compacting one day of partitions
+
+    The event can set 'event_day' (YYYYMMDD, default yesterday in UTC),
+    'sources' (default every source under ext/) or an explicit list of
+    'partitions' prefixes.
+    """
+    event = event or {}
+    bucket = event.get('bucket') or os.environ['SEC_LAKE_BUCKET']
+    s3_client = boto3.client('s3')
+
+    partitions = event.get('partitions')
+    if not partitions:
+        event_day = event.get('event_day') or (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y%m%d')
+        partitions = find_partitions(s3_client, bucket, event_day, event.get('sources'))
+
+    def deadline():
+        return context is None or context.get_remaining_time_in_millis() > COMPACTION_DEADLINE_MARGIN_MS
+
+    results = {}
+    for partition in partitions:
+        if not deadline():
+            logger.warning(f"Deadline reached, leaving s3://{bucket}/{partition} for the next run")
+            results[partition] = {'compacted': 0, 'remaining': None}
+            continue
+        results[partition] = compact_partition(s3_client, bucket, partition, deadline)
+
+    logger.info(f"Compaction results: {json.dumps(results)}")
+    return results
+
+def main():
+    """
+    Command line entry point
+    """
+    logging.basicConfig()
+    parser = argparse.ArgumentParser(description='Compact small Parquet files in Security Lake ext/ partitions')
+    parser.add_argument('--bucket', default=os.environ.get('SEC_LAKE_BUCKET'), help='Security Lake bucket')
+    parser.add_argument('--event-day', help='Partition day as YYYYMMDD (default yesterday in UTC)')
+    parser.add_argument('--source', action='append', dest='sources', help='Source to compact, can be repeated')
+    parser.add_argument('--partition', action='append', dest='partitions', help='Partition prefix to compact, can be repeated')
+    args = parser.parse_args()
+    if not args.bucket:
+        parser.error('--bucket or SEC_LAKE_BUCKET is required')
+    compaction_handler({
+        'bucket': args.bucket,
+        'event_day': args.event_day,
+        'sources': args.sources,
+        'partitions': args.partitions
+    }, None)
+
+if __name__ == '__main__':
+    main()
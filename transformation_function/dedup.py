@@ -0,0 +1,389 @@
+"""
+Duplicate suppression module.
+This module drops events that were already written by an earlier delivery
+of the same SQS message or Kinesis record. Every mapped event gets a stable
+fingerprint (the S3 object and its ETag or the Kinesis shard and sequence
+number, plus the event's position in that object or record) which is
+checked against a Bloom filter kept in memory for the life of the execution
+environment. Fingerprints are only added once the events were written, so
+a failed write is retried in full. The filter can be saved to and loaded
+from a persistent store so cold starts and concurrent environments share it.
+
+A false positive drops a new event that was never written, so the filter
+is sized for a low error rate and every drop is logged with the filter's
+estimated false-positive rate.
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger()
+
+# Layout version of the serialized filter
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct('>BIIIQ')
+
+def record_fingerprint(record):
+    """
+    Return the fingerprint prefix of the events of an SQS or Kinesis record
+
+    Args:
+        record (dict): Record from the Lambda event
+
+    Returns:
+        str: Prefix identifying the delivered data, None if the record has none
+    """
+    if record.get('eventSource') == 'aws:kinesis':
+        return f"kinesis:{record.get('eventSourceARN', '')}:{record['eventID']}"
+    try:
+        message = json.loads(record['body'])
+        s3_object = message['Records'][0]['s3']
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+    version = s3_object['object'].get('eTag') or s3_object['object'].get('sequencer')
+    if not version:
+        return None
+    key = urllib.parse.unquote(s3_object['object']['key'])
+    return f"s3:{s3_object['bucket']['name']}/{key}:{version}"
+
+def _digest(key):
+    """
+    Return the two 64-bit hashes a fingerprint's filter positions are derived from
+    """
+    return struct.unpack('>QQ', hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+
+class BloomFilter:
+    """
+    Bloom filter over fingerprints, sized for a capacity and false-positive rate
+
+    Args:
+        capacity (int): Fingerprints held before the false-positive rate is exceeded
+        error_rate (float): False-positive rate at capacity
+        bits (bytearray): Existing bit array, None for an empty filter
+        count (int): Fingerprints added to the existing bit array
+    """
+    __slots__ = ('size', 'hashes', 'bits', 'count')
+
+    def __init__(self, capacity, error_rate, bits=None, count=0):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+        self.count = count
+
+    def _positions(self, digest):
+        """
+        Return the bit positions of a digest, by double hashing
+        """
+        h1, h2 = digest
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, digest):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(digest))
+
+    def add(self, digest):
+        """
+        Add a digest from _digest
+        """
+        bits = self.bits
+        for position in self._positions(digest):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def union(self, other):
+        """
+        Add the fingerprints of a filter with the same size
+        """
+        merged = int.from_bytes(self.bits, 'little') | int.from_bytes(other.bits, 'little')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'little'))
+        # Entries added to both filters are counted once, so estimate from the set bits
+        set_bits = merged.bit_count()
+        if set_bits >= self.size:
+            self.count = max(self.count, other.count)
+        else:
+            self.count = int(-self.size / self.hashes * math.log(1 - set_bits / self.size))
+
+    def false_positive_rate(self):
+        """
+        Return the estimated false-positive rate at the current count
+        """
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+class Deduplicator:
+    """
+    Per-environment duplicate filter over two generations of Bloom filters
+
+    New fingerprints go into the current generation; once it holds capacity
+    fingerprints it becomes the previous generation and a new one is started,
+    so memory and the false-positive rate stay bounded while the last one to
+    two capacities of fingerprints are remembered.
+
+    Args:
+        capacity (int): Fingerprints per generation
+        error_rate (float): False-positive rate of a full generation
+        store: Persistent store with load() and save(data), None to keep the
+            filter in the execution environment only
+        save_interval (float): Minimum seconds between two saves to the store;
+            each save reads and writes the whole serialized filter
+    """
+    def __init__(self, capacity=1000000, error_rate=1e-6, store=None, save_interval=0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.store = store
+        self.save_interval = save_interval
+        self._saved_at = None
+        self.generation = 0
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+        self._loaded = store is None
+        self._dirty = False
+        self._lock = threading.Lock()
+        # A fork taken while another thread holds the lock must not leave it locked in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        """
+        Replace the lock in a forked child process
+        """
+        self._lock = threading.Lock()
+
+    def _seen(self, digest):
+        """
+        Return True if a digest is in either generation
+        """
+        return digest in self.current or (self.previous is not None and digest in self.previous)
+
+    def false_positive_rate(self):
+        """
+        Return the estimated rate at which new fingerprints are taken for written ones
+        """
+        rate = self.current.false_positive_rate()
+        if self.previous is not None:
+            rate = 1 - (1 - rate) * (1 - self.previous.false_positive_rate())
+        return rate
+
+    def filter(self, prefix, mapped_events, pending):
+        """
+        Drop the events of a record whose fingerprints were already written
+
+        Args:
+            prefix (str): Fingerprint prefix from record_fingerprint
+            mapped_events (list): Mapped events of the record in output order
+            pending (set): Digests of this invocation not written yet, updated
+                with the digests of the kept events so a record delivered twice
+                in one batch is only written once
+
+        Returns:
+            tuple: (kept events, digests of the kept events, duplicate events)
+        """
+        self._load()
+        kept = []
+        digests = []
+        duplicates = []
+        for position, mapped_event in enumerate(mapped_events):
+            digest = _digest(f'{prefix}:{position}')
+            if digest in pending or self._seen(digest):
+                duplicates.append(mapped_event)
+                continue
+            pending.add(digest)
+            kept.append(mapped_event)
+            digests.append(digest)
+        return kept, digests, duplicates
+
+    def commit(self, digests):
+        """
+        Remember the digests of events that were written
+        """
+        if not digests:
+            return
+        with self._lock:
+            for digest in digests:
+                if self.current.count >= self.capacity:
+                    self._rotate()
+                self.current.add(digest)
+            self._dirty = True
+
+    def _rotate(self):
+        """
+        Start a new generation, keeping the current one as the previous
+        """
+        self.previous = self.current
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.generation += 1
+
+    def to_bytes(self):
+        """
+        Serialize both generations
+        """
+        previous = self.previous.bits if self.previous is not None else b''
+        header = _HEADER.pack(FORMAT_VERSION, self.current.size, self.current.count,
+                              self.previous.count if self.previous is not None else 0, self.generation)
+        return header + bytes(self.current.bits) + bytes(previous)
+
+    def _from_bytes(self, data):
+        """
+        Parse a serialized filter, returning (generation, current, previous) or None if it doesn't fit
+        """
+        length = len(self.current.bits)
+        if len(data) < _HEADER.size + length:
+            return None
+        version, size, current_count, previous_count, generation = _HEADER.unpack_from(data)
+        if version != FORMAT_VERSION or size != self.current.size:
+            return None
+        body = data[_HEADER.size:]
+        current = BloomFilter(self.capacity, self.error_rate, bytearray(body[:length]), current_count)
+        previous = None
+        if len(body) >= 2 * length:
+            previous = BloomFilter(self.capacity, self.error_rate, bytearray(body[length:2 * length]), previous_count)
+        return generation, current, previous
+
+    def merge(self, data):
+        """
+        Merge a serialized filter written by this or another execution environment
+
+        Generations are lined up by number, so filters that rotated at
+        different times still keep each other's recent fingerprints.
+        """
+        parsed = self._from_bytes(data)
+        if parsed is None:
+            logger.warning("Stored duplicate filter has a different size or format, ignoring it")
+            return
+        generation, current, previous = parsed
+        with self._lock:
+            if generation == self.generation:
+                self.current.union(current)
+                if previous is not None:
+                    if self.previous is None:
+                        self.previous = previous
+                    else:
+                        self.previous.union(previous)
+            elif generation == self.generation + 1:
+                if previous is not None:
+                    previous.union(self.current)
+                else:
+                    previous = self.current
+                self.generation, self.current, self.previous = generation, current, previous
+            elif generation == self.generation - 1:
+                if self.previous is None:
+                    self.previous = current
+                else:
+                    self.previous.union(current)
+            elif generation > self.generation:
+                self.generation, self.current, self.previous = generation, current, previous
+
+    def _load(self):
+        """
+        Load the stored filter on first use
+        """
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        try:
+            data = self.store.load()
+        except Exception as e:
+            logger.warning(f"Could not load the duplicate filter, starting empty: {str(e)}")
+            return
+        if data:
+            self.merge(data)
+            logger.info(f"Loaded duplicate filter generation {self.generation} with about "
+                        f"{self.current.count} fingerprints")
+
+    def save(self):
+        """
+        Merge the stored filter and write back the combined one, if anything was added
+
+        Concurrent environments may overwrite each other's last save, which
+        only lets some duplicates through; it never drops new events. Saves
+        closer than save_interval to the previous one are skipped, and the
+        fingerprints they would have written go out with the next save.
+        """
+        if self.store is None or not self._dirty:
+            return
+        now = time.monotonic()
+        if self._saved_at is not None and now - self._saved_at < self.save_interval:
+            return
+        self._saved_at = now
+        try:
+            data = self.store.load()
+            if data:
+                self.merge(data)
+            with self._lock:
+                data = self.to_bytes()
+                self._dirty = False
+            self.store.save(data)
+        except Exception as e:
+            logger.warning(f"Could not save the duplicate filter: {str(e)}")
+
+class S3Store:
+    """
+    Filter store in an S3 object
+
+    Args:
+        bucket (str): Bucket name
+        key (str): Object key
+        get_client (function): Returns the boto3 S3 client, called on first use
+    """
+    def __init__(self, bucket, key, get_client):
+        self.bucket = bucket
+        self.key = key
+        self.get_client = get_client
+
+    def load(self):
+        client = self.get_client()
+        try:
+            return client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+        except client.exceptions.NoSuchKey:
+            return None
+
+    def save(self, data):
+        self.get_client().put_object(Bucket=self.bucket, Key=self.key, Body=data)
+
+class FileStore:
+    """
+    Filter store in a local file, for local runs and tests
+
+    Args:
+        path (str): File path
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def save(self, data):
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+def store_from_url(url, get_s3_client):
+    """
+    Build the filter store for a DEDUP_STORE setting
+
+    Args:
+        url (str): s3://bucket/key, a local path, or empty for no store
+        get_s3_client (function): Returns the boto3 S3 client
+
+    Returns:
+        S3Store, FileStore or None
+    """
+    if not url:
+        return None
+    if url.startswith('s3://'):
+        bucket, _, key = url[len('s3://'):].partition('/')
+        return S3Store(bucket, key, get_s3_client)
+    return FileStore(url)
@@ -0,0 +1,534 @@
+"""
+Expression module.
+This module compiles the {"expr": "..."} nodes of a schema_mapping, such as
+"class_uid * 100 + activity_id", into functions that compute a derived field
+for a whole Arrow table at once with pyarrow.compute instead of calling
+Python per record. Expressions read other output fields by their dotted
+name (e.g. traffic.bytes_in) and event fields through '$.' locators.
+
+Supported syntax: numbers (with an optional exponent), quoted strings,
++ - * / with parentheses, unary minus and the functions concat, coalesce,
+int, float, str, round, min and max. A '$.' locator ends at the first
+operator, so locators with one of - + * / , ( ) or a space in a key are
+written in braces, e.g. {$.http-request.user-agent}. Strings used in arithmetic are converted to float64, with empty and
+'-' values read as null, and any null operand gives a null result.
+"""
+import ast
+import logging
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from log_limiter import limiter
+
+logger = logging.getLogger()
+
+# Prefix of the hidden top-level columns holding the event fields expressions read
+REF_PREFIX = '__expr_ref_'
+
+# Values sources write for an absent field, read as null in arithmetic
+_PLACEHOLDERS = ['', '-']
+
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<locator>\$\.[^\s()+\-*/,]+)
+  | \{(?P<braced>\$\.[^{}]+)\}
+  | (?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)
+  | (?P<op>[-+*/(),])
+)''', re.VERBOSE)
+
+# A name can't start right after a number, as in 2x or 1e
+_NAME_START = re.compile(r'[A-Za-z_]')
+
+# Minimum and maximum argument count of each function, None for no maximum
+_FUNCTIONS = {
+    'concat': (1, None),
+    'coalesce': (1, None),
+    'int': (1, 1),
+    'float': (1, 1),
+    'str': (1, 1),
+    'round': (1, 2),
+    'min': (2, None),
+    'max': (2, None),
+}
+
+_ARITHMETIC = {'+': pc.add, '-': pc.subtract, '*': pc.multiply, '/': pc.divide}
+
+def is_expression(node):
+    """
+    Return True if a schema_mapping node is an expression node
+    """
+    return type(node) is dict and 'expr' in node and 'enum' not in node
+
+def _tokenize(text):
+    """
+    Split an expression into (kind, value) tokens
+    """
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise ValueError(f"Invalid syntax at position {pos} of expression {text!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            if _NAME_START.match(text, match.end()):
+                raise ValueError(f"Invalid number at position {match.start(kind)} of expression {text!r}")
+            value = float(value) if '.' in value or 'e' in value.lower() else int(value)
+        elif kind == 'braced':
+            kind = 'locator'
+        elif kind == 'string':
+            value = ast.literal_eval(value)
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+class _Parser:
+    """
+    Recursive descent parser building the syntax tree of one expression
+
+    Nodes are tuples: ('literal', value), ('field', path), ('locator', locator),
+    ('neg', operand), ('binary', op, left, right) and ('call', name, args).
+    """
+    def __init__(self, text):
+        self.text = text
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _expect(self, op):
+        if self._peek() != ('op', op):
+            raise ValueError(f"Expected {op!r} in expression {self.text!r}")
+        self.pos += 1
+
+    def parse(self):
+        node = self._sum()
+        if self.pos < len(self.tokens):
+            raise ValueError(f"Unexpected {self.tokens[self.pos][1]!r} in expression {self.text!r}")
+        return node
+
+    def _sum(self):
+        node = self._product()
+        while self._peek() in (('op', '+'), ('op', '-')):
+            op = self.tokens[self.pos][1]
+            self.pos += 1
+            node = ('binary', op, node, self._product())
+        return node
+
+    def _product(self):
+        node = self._unary()
+        while self._peek() in (('op', '*'), ('op', '/')):
+            op = self.tokens[self.pos][1]
+            self.pos += 1
+            node = ('binary', op, node, self._unary())
+        return node
+
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self.pos += 1
+            return ('neg', self._unary())
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind is None:
+            raise ValueError(f"Unexpected end of expression {self.text!r}")
+        self.pos += 1
+        if kind in ('number', 'string'):
+            return ('literal', value)
+        if kind == 'locator':
+            return ('locator', value)
+        if kind == 'name':
+            if self._peek() != ('op', '('):
+                return ('field', tuple(value.split('.')))
+            if value not in _FUNCTIONS:
+                raise ValueError(f"Unknown function {value} in expression {self.text!r}")
+            self.pos += 1
+            args = []
+            if self._peek() != ('op', ')'):
+                args.append(self._sum())
+                while self._peek() == ('op', ','):
+                    self.pos += 1
+                    args.append(self._sum())
+            self._expect(')')
+            minimum, maximum = _FUNCTIONS[value]
+            if len(args) < minimum or (maximum is not None and len(args) > maximum):
+                raise ValueError(f"Wrong number of arguments to {value} in expression {self.text!r}")
+            if value == 'round' and len(args) == 2 and not (args[1][0] == 'literal' and isinstance(args[1][1], int)):
+                raise ValueError(f"round digits must be an integer in expression {self.text!r}")
+            return ('call', value, tuple(args))
+        if value == '(':
+            node = self._sum()
+            self._expect(')')
+            return node
+        raise ValueError(f"Unexpected {value!r} in expression {self.text!r}")
+
+def _locators(node, found):
+    """
+    Add the '$.' locators of a syntax tree to found, in order of appearance
+    """
+    kind = node[0]
+    if kind == 'locator' and node[1] not in found:
+        found.append(node[1])
+    elif kind == 'neg':
+        _locators(node[1], found)
+    elif kind == 'binary':
+        _locators(node[2], found)
+        _locators(node[3], found)
+    elif kind == 'call':
+        for arg in node[2]:
+            _locators(arg, found)
+    return found
+
+def expression_locators(node):
+    """
+    Return the '$.' locators an expression node reads
+
+    Args:
+        node (dict): Expression node from a schema_mapping
+
+    Returns:
+        list: Locator strings, empty if the expression doesn't parse
+    """
+    try:
+        return _locators(_Parser(node['expr']).parse(), [])
+    except (ValueError, SyntaxError, TypeError):
+        return []
+
+def _static_type(node):
+    """
+    Return the Arrow type an expression syntax tree evaluates to, None if unknown
+    """
+    kind = node[0]
+    if kind == 'literal':
+        value = node[1]
+        if isinstance(value, str):
+            return pa.string()
+        return pa.float64() if isinstance(value, float) else pa.int64()
+    if kind == 'locator':
+        return pa.string()
+    if kind == 'field':
+        return None
+    if kind == 'neg':
+        return _numeric_type([_static_type(node[1])])
+    if kind == 'binary':
+        if node[1] == '/':
+            return pa.float64()
+        return _numeric_type([_static_type(node[2]), _static_type(node[3])])
+    name, args = node[1], node[2]
+    if name in ('concat', 'str'):
+        return pa.string()
+    if name in ('float', 'round'):
+        return pa.float64()
+    if name == 'int':
+        return pa.int64()
+    arg_types = [_static_type(arg) for arg in args]
+    if name == 'coalesce' and any(arg_type is not None and pa.types.is_string(arg_type) for arg_type in arg_types):
+        return pa.string()
+    return _numeric_type(arg_types)
+
+def _numeric_type(types):
+    """
+    Return the type of arithmetic over operands of the given static types
+
+    Output fields of unknown type are taken to be integers, like the OCSF
+    ids and counts expressions usually combine.
+    """
+    for value_type in types:
+        if value_type is not None and not pa.types.is_integer(value_type):
+            return pa.float64()
+    return pa.int64()
+
+def expression_type(node):
+    """
+    Return the Arrow type an expression node evaluates to
+
+    Args:
+        node (dict): Expression node from a schema_mapping
+
+    Returns:
+        pyarrow.DataType: Inferred type, string if it can't be inferred
+    """
+    try:
+        value_type = _static_type(_Parser(node['expr']).parse())
+    except (ValueError, SyntaxError, TypeError):
+        return pa.string()
+    return value_type if value_type is not None else pa.string()
+
+def _plain(value):
+    """
+    Return an evaluated operand as a plain array or scalar, decoding dictionaries
+    """
+    if isinstance(value, pa.ChunkedArray):
+        value = value.combine_chunks()
+    if isinstance(value, pa.Array) and pa.types.is_dictionary(value.type):
+        value = value.dictionary_decode()
+    elif isinstance(value, pa.Scalar) and pa.types.is_dictionary(value.type):
+        value = value.value if value.is_valid else pa.scalar(None, type=pa.string())
+    return value
+
+def _strings_to_numbers(column):
+    """
+    Convert a string array to float64, nulling placeholders and values that aren't numbers
+    """
+    column = pc.if_else(pc.is_in(column, value_set=pa.array(_PLACEHOLDERS, type=pa.string())),
+                        pa.scalar(None, type=pa.string()), column)
+    try:
+        return column.cast(pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+    unique = pc.unique(column)
+    converted = []
+    for value in unique.to_pylist():
+        try:
+            converted.append(float(value))
+        except (TypeError, ValueError):
+            converted.append(None)
+    return pa.array(converted, type=pa.float64()).take(pc.index_in(column, value_set=unique))
+
+def _numeric(value):
+    """
+    Return an operand as an int64 or float64 array or scalar
+    """
+    value = _plain(value)
+    value_type = value.type
+    if pa.types.is_integer(value_type) or pa.types.is_boolean(value_type) or pa.types.is_null(value_type):
+        return value.cast(pa.int64())
+    if pa.types.is_floating(value_type) or pa.types.is_decimal(value_type):
+        return value.cast(pa.float64())
+    if pa.types.is_string(value_type) or pa.types.is_large_string(value_type):
+        if isinstance(value, pa.Scalar):
+            return _strings_to_numbers(pa.array([value.as_py()], type=pa.string()))[0]
+        return _strings_to_numbers(value.cast(pa.string()))
+    raise TypeError(f"Can't use a {value_type} value in arithmetic")
+
+def _common_numeric(values):
+    """
+    Convert operands to numbers of one type, float64 if any of them is a float
+    """
+    values = [_numeric(value) for value in values]
+    if any(pa.types.is_floating(value.type) for value in values):
+        values = [value.cast(pa.float64()) for value in values]
+    return values
+
+def _string(value):
+    """
+    Return an operand as a string array or scalar
+    """
+    value = _plain(value)
+    if pa.types.is_string(value.type):
+        return value
+    return value.cast(pa.string())
+
+def _call(name, values):
+    """
+    Evaluate a function over evaluated arguments
+    """
+    if name == 'concat':
+        return pc.binary_join_element_wise(*[_string(value) for value in values], '')
+    if name == 'str':
+        return _string(values[0])
+    if name == 'coalesce':
+        plain = [_plain(value) for value in values]
+        if any(pa.types.is_string(value.type) for value in plain):
+            return pc.coalesce(*[_string(value) for value in plain])
+        return pc.coalesce(*_common_numeric(plain))
+    if name == 'float':
+        return _numeric(values[0]).cast(pa.float64())
+    if name == 'int':
+        value = _numeric(values[0])
+        if pa.types.is_floating(value.type):
+            # NaN and infinity have no integer value
+            value = pc.if_else(pc.is_finite(value), pc.trunc(value), pa.scalar(None, type=pa.float64()))
+        return value.cast(pa.int64())
+    if name == 'round':
+        digits = values[1].as_py() if len(values) > 1 else 0
+        return pc.round(_numeric(values[0]).cast(pa.float64()), ndigits=digits)
+    if name == 'min':
+        return pc.min_element_wise(*_common_numeric(values), skip_nulls=False)
+    return pc.max_element_wise(*_common_numeric(values), skip_nulls=False)
+
+def _column(table, path):
+    """
+    Return the array of a dotted output field, raising KeyError if it doesn't exist
+    """
+    if path[0] not in table.column_names:
+        raise KeyError('.'.join(path))
+    column = table.column(path[0]).combine_chunks()
+    for name in path[1:]:
+        if not pa.types.is_struct(column.type) or column.type.get_field_index(name) < 0:
+            raise KeyError('.'.join(path))
+        column = pc.struct_field(column, name)
+    return column
+
+def _compile(node, refs):
+    """
+    Compile a syntax tree into a function of a table
+    """
+    kind = node[0]
+    if kind == 'literal':
+        scalar = pa.scalar(node[1])
+        return lambda table: scalar
+    if kind == 'field':
+        path = node[1]
+        return lambda table: _column(table, path)
+    if kind == 'locator':
+        path = (refs[node[1]],)
+        return lambda table: _column(table, path)
+    if kind == 'neg':
+        operand = _compile(node[1], refs)
+        return lambda table: pc.negate(_numeric(operand(table)))
+    if kind == 'binary':
+        op = node[1]
+        function = _ARITHMETIC[op]
+        left = _compile(node[2], refs)
+        right = _compile(node[3], refs)
+        if op == '/':
+            # Integer operands still divide exactly
+            return lambda table: function(*[value.cast(pa.float64()) for value in
+                                            _common_numeric([left(table), right(table)])])
+        return lambda table: function(*_common_numeric([left(table), right(table)]))
+    name = node[1]
+    args = [_compile(arg, refs) for arg in node[2]]
+    return lambda table: _call(name, [arg(table) for arg in args])
+
+def compile_expression(text, refs):
+    """
+    Compile an expression into a function computing its column for a table
+
+    Args:
+        text (str): Expression source
+        refs (dict): Hidden column name per '$.' locator the expression reads
+
+    Returns:
+        function: Function taking a pyarrow.Table and returning an array or scalar
+
+    Raises:
+        ValueError: If the expression doesn't parse
+    """
+    return _compile(_Parser(text).parse(), refs)
+
+def _failing(exc):
+    """
+    Build an evaluate function re-raising an error found while compiling
+    """
+    def evaluate(table):
+        raise exc
+    return evaluate
+
+def split_mapping(schema_mapping):
+    """
+    Take the expression nodes out of a schema_mapping
+
+    Expression nodes are replaced with null constants that keep the field's
+    position, and every '$.' locator the expressions read becomes a hidden
+    top-level locator field, so the record and columnar compilers handle
+    the rewritten mapping unchanged and apply_expressions fills the fields in.
+
+    Args:
+        schema_mapping (dict): The schema_mapping of one ocsf_mapping entry
+
+    Returns:
+        tuple: (rewritten schema_mapping, expressions), where expressions is
+        a tuple of (path, text, evaluate) in mapping order, empty if the
+        mapping has no expression nodes
+    """
+    found = []
+
+    def rewrite(node, path):
+        if is_expression(node):
+            found.append((path, node['expr']))
+            return None
+        if type(node) is dict and 'enum' not in node:
+            return {key: rewrite(child, path + (key,)) for key, child in node.items()}
+        return node
+
+    rewritten = rewrite(schema_mapping, ())
+    if not found:
+        return schema_mapping, ()
+
+    refs = {}
+    expressions = []
+    for path, text in found:
+        try:
+            tree = _Parser(text).parse()
+            for locator in _locators(tree, []):
+                if locator not in refs:
+                    refs[locator] = f'{REF_PREFIX}{len(refs)}'
+                    rewritten[refs[locator]] = locator
+            evaluate = _compile(tree, refs)
+        except (ValueError, SyntaxError, TypeError) as e:
+            logger.warning(f"Invalid expression for field {'.'.join(path)}: {str(e)}")
+            evaluate = _failing(e)
+        expressions.append((path, text, evaluate))
+    return rewritten, tuple(expressions)
+
+def _with_child(parent, path, column):
+    """
+    Return a struct array with the field at path set to column
+    """
+    if parent is not None and pa.types.is_struct(parent.type):
+        names = [field.name for field in parent.type]
+        children = [parent.field(i) for i in range(parent.type.num_fields)]
+        mask = parent.is_null() if parent.null_count else None
+    else:
+        names, children, mask = [], [], None
+    name = path[0]
+    index = names.index(name) if name in names else None
+    if len(path) > 1:
+        column = _with_child(children[index] if index is not None else None, path[1:], column)
+    if index is None:
+        names.append(name)
+        children.append(column)
+    else:
+        children[index] = column
+    return pa.StructArray.from_arrays(children, names=names, mask=mask)
+
+def _set_field(table, path, column):
+    """
+    Return a table with the dotted field at path set to column
+    """
+    name = path[0]
+    index = table.schema.get_field_index(name)
+    if len(path) > 1:
+        parent = table.column(name).combine_chunks() if index >= 0 else None
+        column = _with_child(parent, path[1:], column)
+    if index >= 0:
+        return table.set_column(index, name, column)
+    return table.append_column(name, column)
+
+def apply_expressions(table, expressions, source=None):
+    """
+    Evaluate the expressions of one matched value over its table
+
+    Expressions run in mapping order, so one can read a field computed by
+    an earlier one. An expression that fails nulls its field for the whole
+    batch. The hidden locator columns are dropped afterwards.
+
+    Args:
+        table (pyarrow.Table): Records of one matched value, from the rewritten mapping
+        expressions (tuple): Expressions from split_mapping
+        source (str): Source the warnings are rate-limited for
+
+    Returns:
+        pyarrow.Table: Table with the expression fields filled in
+    """
+    for path, text, evaluate in expressions:
+        try:
+            column = _plain(evaluate(table))
+            if isinstance(column, pa.Scalar):
+                column = pa.repeat(column, table.num_rows)
+        except Exception as e:
+            field = '.'.join(path)
+            limiter.warning(source, field, "Error evaluating expression %s for field %s: %s, setting to null",
+                            text, field, e, count=table.num_rows)
+            column = pa.nulls(table.num_rows)
+        table = _set_field(table, path, column)
+    hidden = [name for name in table.column_names if name.startswith(REF_PREFIX)]
+    return table.drop_columns(hidden) if hidden else table
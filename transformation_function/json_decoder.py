@@ -0,0 +1,117 @@
+"""
+JSON line decoder module.
+This module decodes JSON log lines with orjson when it is installed, as it
+is in the deployed function, keeping only the subtrees a source's mapping
+reads; without orjson lines are decoded with the json module unchanged.
+"""
+import json
+import logging
+
+logger = logging.getLogger()
+
+# orjson decodes integers outside the 64-bit range as floats, so documents
+# with runs of 19 or more digits are left to the json module to keep them
+# exact. Runs are found by turning every digit into '0' with bytes.translate,
+# which is several times faster than a regular expression scan.
+_DIGITS_TO_ZERO = bytes.maketrans(b'123456789', b'000000000')
+_LONG_DIGITS = b'0' * 19
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(raw):
+    """
+    Decode a JSON document, using orjson when it is installed
+
+    Documents orjson rejects but the json module accepts, and documents
+    that may hold integers wider than 64 bits, are decoded with the json
+    module so the result is always the same as json.loads.
+
+    Args:
+        raw (str): JSON document
+
+    Returns:
+        The decoded value
+
+    Raises:
+        json.JSONDecodeError: If the document is not valid JSON
+    """
+    if orjson is not None:
+        data = raw.encode('utf-8')
+        if _LONG_DIGITS not in data.translate(_DIGITS_TO_ZERO):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+    return json.loads(raw)
+
+def build_projection(paths):
+    """
+    Build a projection tree from the event paths a mapping reads
+
+    Args:
+        paths (iterable): Paths as tuples of keys
+
+    Returns:
+        dict: Nested dict of keys to keep; None marks a subtree kept whole
+    """
+    projection = {}
+    for path in sorted(paths, key=len):
+        if not path:
+            return None
+        node = projection
+        for key in path[:-1]:
+            child = node.setdefault(key, {})
+            if child is None:
+                break
+            node = child
+        else:
+            node[path[-1]] = None
+    return projection
+
+def project(value, projection):
+    """
+    Drop the parts of a decoded event that a projection doesn't keep
+
+    Values that are not dicts are returned unchanged, so lookups through
+    them fail the same way they would on the full event.
+
+    Args:
+        value: Decoded JSON value
+        projection (dict): Projection tree from build_projection
+
+    Returns:
+        The projected value
+    """
+    if projection is None or type(value) is not dict:
+        return value
+    projected = {}
+    for key, child_projection in projection.items():
+        if key in value:
+            child = value[key]
+            projected[key] = child if child_projection is None else project(child, child_projection)
+    return projected
+
+def make_decoder(projection):
+    """
+    Build a line decoder applying a projection to every decoded event
+
+    Without orjson the json module is used as is: it can't skip fields while
+    parsing, so projecting afterwards would only add a copy of every event.
+
+    Args:
+        projection (dict): Projection tree from build_projection, or None
+
+    Returns:
+        function: Function taking a JSON line and returning the event
+    """
+    if orjson is None:
+        return json.loads
+    if projection is None:
+        return loads
+
+    def decode(raw):
+        return project(loads(raw), projection)
+    return decode
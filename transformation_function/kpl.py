@@ -0,0 +1,129 @@
+"""
+KPL de-aggregation module.
+This module splits Kinesis records written by the Kinesis Producer Library
+with aggregation enabled back into the user records they carry. An
+aggregated record is the 4-byte KPL magic number, an AggregatedRecord
+protobuf message and the MD5 digest of that message. The message is read
+with a minimal protobuf wire-format reader, so no protobuf runtime needs to
+be packaged with the function.
+"""
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+# First bytes of a KPL-aggregated record
+MAGIC = b'\xf3\x89\x9a\xc2'
+
+# Size of the MD5 digest trailing the protobuf message
+DIGEST_SIZE = 16
+
+# Field numbers of AggregatedRecord.records and Record.data
+_RECORDS_FIELD = 3
+_DATA_FIELD = 3
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+def _read_varint(data, pos, end):
+    """
+    Read a base-128 varint, returning (value, position after it)
+    """
+    result = 0
+    shift = 0
+    while True:
+        if pos >= end:
+            raise ValueError('Truncated varint')
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError('Varint longer than 64 bits')
+
+def _fields(data, start, end):
+    """
+    Yield (field number, wire type, value) for the fields of a protobuf message
+
+    Varint values are returned as integers and length-delimited values as
+    (start, end) offsets into data; fixed-size values are skipped.
+
+    Args:
+        data (bytes): Buffer holding the message
+        start (int): Offset of the message in data
+        end (int): Offset after the message
+
+    Raises:
+        ValueError: If the message is malformed
+    """
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(data, pos, end)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == _VARINT:
+            value, pos = _read_varint(data, pos, end)
+        elif wire_type == _LENGTH_DELIMITED:
+            length, pos = _read_varint(data, pos, end)
+            value = (pos, pos + length)
+            pos += length
+        elif wire_type == _FIXED64:
+            value = None
+            pos += 8
+        elif wire_type == _FIXED32:
+            value = None
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+        if pos > end:
+            raise ValueError('Truncated protobuf field')
+        yield field, wire_type, value
+
+def is_aggregated(data):
+    """
+    Return True if Kinesis record data starts with the KPL magic number
+    """
+    return len(data) > len(MAGIC) + DIGEST_SIZE and data[:len(MAGIC)] == MAGIC
+
+def deaggregate(data):
+    """
+    Return the user record payloads carried by the data of a Kinesis record
+
+    Records that aren't aggregated are returned as their only payload. Like
+    the Kinesis Client Library, a record whose digest doesn't match or whose
+    message can't be read is treated as a plain record.
+
+    Args:
+        data (bytes): Decoded data of a Kinesis record
+
+    Returns:
+        list: User record payloads as bytes, in aggregation order
+    """
+    if not is_aggregated(data):
+        return [data]
+    start, end = len(MAGIC), len(data) - DIGEST_SIZE
+    if hashlib.md5(data[start:end], usedforsecurity=False).digest() != data[end:]:
+        logger.warning("KPL record digest does not match, processing it as a plain record")
+        return [data]
+
+    payloads = []
+    try:
+        for field, wire_type, value in _fields(data, start, end):
+            if field != _RECORDS_FIELD or wire_type != _LENGTH_DELIMITED:
+                # Partition and explicit hash key tables aren't needed to process the events
+                continue
+            payload = None
+            for record_field, record_wire_type, record_value in _fields(data, *value):
+                if record_field == _DATA_FIELD and record_wire_type == _LENGTH_DELIMITED:
+                    payload = data[record_value[0]:record_value[1]]
+            if payload is None:
+                raise ValueError('User record without data')
+            payloads.append(payload)
+    except ValueError as e:
+        logger.warning(f"Could not de-aggregate KPL record, processing it as a plain record: {str(e)}")
+        return [data]
+    return payloads
@@ -0,0 +1,108 @@
+"""
+Log limiter module.
+This module keeps per-event log messages from flooding CloudWatch Logs.
+Messages are formatted only when they are actually written, each
+(source, field) pair is written a limited number of times per invocation,
+and the repeats are reported in a single summary line at the end.
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+# Number of times the same (source, field) message is written per invocation
+LOG_REPEAT_LIMIT = max(0, int(os.environ.get('LOG_REPEAT_LIMIT', '5')))
+
+# Number of (source, field) pairs listed in the summary line
+SUMMARY_TOP_KEYS = 10
+
+class LogLimiter:
+    """
+    Deduplicating, rate-limited logging for the per-event path
+
+    Args:
+        target (logging.Logger): Logger the messages are written to
+        limit (int): Times each (source, field) message is written per invocation
+    """
+    def __init__(self, target, limit=LOG_REPEAT_LIMIT):
+        self.target = target
+        self.limit = limit
+        self._lock = threading.Lock()
+        # A fork taken while another thread holds the lock must not leave it locked in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+        self._counts = {}
+        self._written = {}
+
+    def _reset_lock(self):
+        """
+        Replace the lock in a forked child process
+        """
+        self._lock = threading.Lock()
+
+    def log(self, level, source, field, msg, *args, count=1):
+        """
+        Log a message for a (source, field) pair unless it was repeated too often
+
+        Args:
+            level (int): Logging level, e.g. logging.WARNING
+            source (str): Source name, None if not known
+            field (str): Field or locator the message is about
+            msg (str): %-style message, formatted only if written
+            args: Message arguments
+            count (int): Events the message stands for, for messages about a batch
+        """
+        key = (source, field)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + count
+            written = self._written.get(key, 0)
+            if written >= self.limit:
+                return
+            self._written[key] = written + 1
+        if not self.target.isEnabledFor(level):
+            return
+        self.target.log(level, msg, *args)
+        if written + 1 == self.limit:
+            self.target.log(level, "Suppressing further messages for field %s of source %s in this invocation", field, source)
+
+    def warning(self, source, field, msg, *args, count=1):
+        """
+        Log a rate-limited warning, see log
+        """
+        self.log(logging.WARNING, source, field, msg, *args, count=count)
+
+    def info(self, source, field, msg, *args, count=1):
+        """
+        Log a rate-limited info message, see log
+        """
+        self.log(logging.INFO, source, field, msg, *args, count=count)
+
+    def error(self, source, field, msg, *args, count=1):
+        """
+        Log a rate-limited error, see log
+        """
+        self.log(logging.ERROR, source, field, msg, *args, count=count)
+
+    def log_summary(self):
+        """
+        Log one line with the per (source, field) message counts and reset them
+
+        Returns:
+            dict: Message count per (source, field) since the last summary
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = {}
+            self._written = {}
+        if counts:
+            total = sum(counts.values())
+            top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:SUMMARY_TOP_KEYS]
+            self.target.info(
+                "Log summary: %d repeated messages for %d (source, field) pairs, most frequent: %s",
+                total, len(counts),
+                ', '.join(f'{source or "-"} {field}: {count}' for (source, field), count in top)
+            )
+        return counts
+
+# Limiter shared by the function modules
+limiter = LogLimiter(logger)
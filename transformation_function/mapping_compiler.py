@@ -0,0 +1,306 @@
+"""
+Mapping compiler module.
+This module turns the schema_mapping trees from the mapping files into
+prebuilt transform functions once at load time, so the per-record work is
+limited to the locator lookups and enum resolutions the mapping needs.
+"""
+import logging
+
+from timestamps import get_eventday_parser
+from log_limiter import limiter
+from expressions import is_expression, expression_locators, split_mapping
+
+logger = logging.getLogger()
+
+_MISSING = object()
+
+def _raise(exc):
+    """
+    Build a field function that re-raises an error found while compiling
+
+    Args:
+        exc (Exception): Error raised while compiling the mapping node
+
+    Returns:
+        function: Field function raising exc for every record
+    """
+    def field(event):
+        raise exc
+    return field
+
+def compile_locator(dot_locator):
+    """
+    Compile a '$.' locator into a function returning the located value
+
+    The returned function behaves like get_dot_locator_value: nested values
+    are converted to str, missing references return None and
+    '$.UserDefined.<key>' returns the raw top-level value.
+
+    Args:
+        dot_locator (str): Locator string starting with '$.'
+
+    Returns:
+        function: Function taking an event dict and returning the value
+    """
+    json_path = dot_locator.split('.')
+    if json_path[1] == 'UserDefined':
+        if len(json_path) < 3:
+            return _raise(IndexError('list index out of range'))
+        user_key = json_path[2]
+        def locate_user_defined(event):
+            return event[user_key]
+        return locate_user_defined
+
+    path = tuple(json_path[1:])
+    if len(path) == 1:
+        (key,) = path
+        def locate_1(event):
+            result = event.get(key)
+            return str(result) if result is not None else None
+        return locate_1
+    if len(path) == 2:
+        key1, key2 = path
+        def locate_2(event):
+            result = event.get(key1)
+            if result is None:
+                return None
+            result = result.get(key2)
+            return str(result) if result is not None else None
+        return locate_2
+
+    def locate(event):
+        result = event
+        for k in path:
+            result = result.get(k)
+            if result is None:
+                return None
+        return str(result)
+    return locate
+
+def _compile_enum(enum):
+    """
+    Compile an enum node into a field function with a prebuilt lookup table
+
+    Args:
+        enum (dict): The 'enum' definition with evaluate, values and other
+
+    Returns:
+        function: Field function returning the resolved enum value, or None if
+        the node is skipped by the interpreter (non-locator evaluate)
+    """
+    evaluate = enum['evaluate']
+    if not (isinstance(evaluate, str) and evaluate.startswith('$.')):
+        return None
+    locate = compile_locator(evaluate)
+    values = enum['values']
+    other = enum.get('other', _MISSING)
+
+    def resolve_enum(event):
+        value = locate(event)
+        if value in values:
+            return values[value]
+        if other is _MISSING:
+            raise KeyError('other')
+        return other
+    return resolve_enum
+
+def _compile_leaf(dot_locator, source_name=None):
+    """
+    Compile a locator leaf into a field function warning on missing values
+
+    Args:
+        dot_locator (str): Locator string starting with '$.'
+        source_name (str): Source the warnings are rate-limited for
+
+    Returns:
+        function: Field function returning the located value or None
+    """
+    locate = compile_locator(dot_locator)
+
+    def resolve_leaf(event):
+        value = locate(event)
+        if value is None:
+            # Field not found but continue processing
+            limiter.warning(source_name, dot_locator, "Field %s not found in event, setting to null", dot_locator)
+        return value
+    return resolve_leaf
+
+def _is_constant(node):
+    """
+    Return True if a mapping node has no locators or enums below it
+    """
+    if type(node) is dict:
+        if 'enum' in node:
+            return False
+        return all(_is_constant(child) for child in node.values())
+    return not (isinstance(node, str) and node.startswith('$.'))
+
+def _fold_constant(node):
+    """
+    Rebuild a constant mapping subtree the way the interpreter outputs it
+    """
+    if type(node) is dict:
+        return {key: _fold_constant(child) for key, child in node.items()}
+    return node
+
+def compile_schema_mapping(event_mapping, source_name=None):
+    """
+    Compile a schema_mapping tree into a transform function
+
+    Constant subtrees are folded into a template record which is copied for
+    every event, locator paths are split once and enum tables are resolved
+    up front. The returned function produces the same record as
+    perform_transform for the same mapping and event. Folded constant
+    subtrees are shared between records and must be treated as read-only.
+
+    Args:
+        event_mapping (dict): The schema_mapping of one ocsf_mapping entry
+        source_name (str): Source the field warnings are rate-limited for
+
+    Returns:
+        function: Function taking an event dict and returning the OCSF record
+    """
+    template = {}
+    fields = []
+    for key, node in event_mapping.items():
+        try:
+            if type(node) is dict:
+                if 'enum' in node:
+                    field = _compile_enum(node['enum'])
+                    if field is None:
+                        # The interpreter leaves the key out entirely
+                        continue
+                elif _is_constant(node):
+                    template[key] = _fold_constant(node)
+                    continue
+                else:
+                    field = compile_schema_mapping(node, source_name)
+            elif isinstance(node, str) and node.startswith('$.'):
+                field = _compile_leaf(node, source_name)
+            else:
+                template[key] = node
+                continue
+        except Exception as e:
+            field = _raise(e)
+        template[key] = None
+        fields.append((key, field))
+
+    fields = tuple(fields)
+
+    def transform(event):
+        new_record = template.copy()
+        for key, field in fields:
+            try:
+                new_record[key] = field(event)
+            except Exception as e:
+                # Catch any errors during transformation of this field and continue
+                limiter.warning(source_name, key, "Error transforming field %s: %s, setting to null", key, e)
+                new_record[key] = None
+        return new_record
+    return transform
+
+def compile_source_locator(dot_locator, source_name=None):
+    """
+    Compile a source-level locator such as the timestamp or matched field
+
+    Args:
+        dot_locator (str): Locator string from custom_source_events
+        source_name (str): Source the messages are rate-limited for
+
+    Returns:
+        function: Function taking an event dict and returning the value
+    """
+    if isinstance(dot_locator, str) and dot_locator.startswith('$.'):
+        return compile_locator(dot_locator)
+
+    def unprocessable(event):
+        limiter.info(source_name, dot_locator, "Unable to process matched field -%s", dot_locator)
+        return None
+    return unprocessable
+
+def compile_source_mapping(mapping, source_name=None):
+    """
+    Compile a full mapping file into the structures used by process_event
+
+    Args:
+        mapping (dict): Parsed mapping file with custom_source_events
+        source_name (str): Source the per-event messages are rate-limited for
+
+    Returns:
+        dict: Compiled locators for the timestamp and matched field, the
+        eventDay parser, a (schema, transform) pair per matched value in
+        ocsf_mapping and the expressions of the matched values that have
+        expression nodes, which are evaluated per batch once the records
+        are in a table
+    """
+    custom_source_events = mapping['custom_source_events']
+    ocsf_mapping = {}
+    expressions = {}
+    for matched_value, event_mapping in custom_source_events['ocsf_mapping'].items():
+        schema_mapping, matched_expressions = split_mapping(event_mapping['schema_mapping'])
+        ocsf_mapping[matched_value] = (
+            event_mapping['schema'],
+            compile_schema_mapping(schema_mapping, source_name)
+        )
+        if matched_expressions:
+            expressions[matched_value] = matched_expressions
+
+    return {
+        'timestamp_field': custom_source_events['timestamp']['field'],
+        'timestamp_format': custom_source_events['timestamp']['format'],
+        'timestamp_locator': compile_source_locator(custom_source_events['timestamp']['field'], source_name),
+        'eventday_parser': get_eventday_parser(custom_source_events['timestamp']['format']),
+        'matched_field': custom_source_events['matched_field'],
+        'matched_locator': compile_source_locator(custom_source_events['matched_field'], source_name),
+        'ocsf_mapping': ocsf_mapping,
+        'expressions': expressions
+    }
+
+def _locator_path(dot_locator):
+    """
+    Return the event path read by a '$.' locator as a tuple of keys
+    """
+    json_path = dot_locator.split('.')
+    if json_path[1] == 'UserDefined':
+        return tuple(json_path[2:3])
+    return tuple(json_path[1:])
+
+def _collect_paths(node, paths):
+    """
+    Add the event paths read by a schema_mapping node to paths
+    """
+    if type(node) is dict:
+        if 'enum' in node:
+            evaluate = node['enum'].get('evaluate') if type(node['enum']) is dict else None
+            if isinstance(evaluate, str) and evaluate.startswith('$.'):
+                paths.add(_locator_path(evaluate))
+            return
+        if is_expression(node):
+            for locator in expression_locators(node):
+                paths.add(_locator_path(locator))
+            return
+        for child in node.values():
+            _collect_paths(child, paths)
+    elif isinstance(node, str) and node.startswith('$.'):
+        paths.add(_locator_path(node))
+
+def referenced_paths(mapping):
+    """
+    Return every event path a mapping file reads
+
+    Covers the timestamp and matched fields, all locator leaves, enum
+    evaluate fields and locators read by expressions across the ocsf_mapping entries.
+
+    Args:
+        mapping (dict): Parsed mapping file with custom_source_events
+
+    Returns:
+        set: Paths as tuples of keys, e.g. ('event', 'src_ip')
+    """
+    custom_source_events = mapping['custom_source_events']
+    paths = set()
+    _collect_paths(custom_source_events['timestamp']['field'], paths)
+    _collect_paths(custom_source_events['matched_field'], paths)
+    for event_mapping in custom_source_events['ocsf_mapping'].values():
+        _collect_paths(event_mapping['schema_mapping'], paths)
+    return paths
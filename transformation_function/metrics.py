@@ -0,0 +1,285 @@
+"""
+Invocation metrics module.
+This module times the stages of an invocation and counts events per source
+and event type, then emits the totals once per invocation in CloudWatch
+Embedded Metric Format (EMF). A disabled collector hands out no-op timers and
+leaves iterables unwrapped, so instrumented code costs next to nothing.
+"""
+import json
+import os
+import threading
+import time
+
+# EMF metric name of each stage
+STAGE_METRICS = {
+    'route': 'RouteTime',
+    's3_get': 'S3GetTime',
+    'decompress': 'DecompressTime',
+    'decode': 'DecodeTime',
+    'preprocess': 'PreprocessTime',
+    'transform': 'TransformTime',
+    'group': 'GroupTime',
+    'dedup': 'DedupTime',
+    'write': 'WriteTime'
+}
+
+# EMF metric name of each event outcome
+OUTCOME_METRICS = {
+    'mapped': 'MappedEvents',
+    'unmapped': 'UnmappedEvents',
+    'errored': 'ErroredEvents',
+    'duplicate': 'DuplicateEvents'
+}
+
+# Dimension value for events whose source or event type is not known
+UNKNOWN = 'unknown'
+
+class _NullStage:
+    """
+    Stage timer handed out while metrics are disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    """
+    Stage timer measuring the time spent in a with block, excluding nested stages
+    """
+    __slots__ = ('collector', 'stage', 'source', 'start')
+
+    def __init__(self, collector, stage, source):
+        self.collector = collector
+        self.stage = stage
+        self.source = source
+        self.start = 0.0
+
+    def __enter__(self):
+        self.collector._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.collector._exit(self)
+        return False
+
+def count_event(counts, source, event_type, outcome):
+    """
+    Count one event outcome in a local counts dict, doing nothing if counts is None
+
+    Args:
+        counts (dict): Counts from MetricsCollector.new_counts, or None
+        source (str): Source name
+        event_type (str): Matched value of the event
+        outcome (str): 'mapped', 'unmapped', 'errored' or 'duplicate'
+    """
+    if counts is not None:
+        key = (source or UNKNOWN, event_type or UNKNOWN, outcome)
+        counts[key] = counts.get(key, 0) + 1
+
+class MetricsCollector:
+    """
+    Per-invocation stage times and event counts, shared by the fetch threads
+
+    Stage times are exclusive: time spent in a stage nested inside another,
+    such as the S3 reads made while decompressing, only counts for the inner
+    stage. Event counts are gathered in a local dict per S3 object or Kinesis
+    record and merged once, so the hot loops never take the lock.
+
+    Args:
+        enabled (bool): Collect and emit metrics
+        namespace (str): CloudWatch namespace of the emitted metrics
+    """
+    def __init__(self, enabled=False, namespace='OCSFTransformation'):
+        self.enabled = enabled
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        # A fork taken while another thread holds the lock must not leave it locked in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+        self._local = threading.local()
+        self._times = {}
+        self._counts = {}
+        self._values = {}
+
+    def _reset_lock(self):
+        """
+        Replace the lock in a forked child process
+        """
+        self._lock = threading.Lock()
+
+    def stage(self, stage, source=None):
+        """
+        Return a context manager timing a stage for a source
+
+        Args:
+            stage (str): One of STAGE_METRICS
+            source (str): Source name, None for invocation-wide stages
+
+        Returns:
+            Context manager
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, stage, source)
+
+    def timed(self, iterable, stage, source=None):
+        """
+        Time the work of producing each item of an iterable as a stage
+
+        Args:
+            iterable (iterable): Items pulled lazily, e.g. S3 body chunks
+            stage (str): One of STAGE_METRICS
+            source (str): Source name
+
+        Returns:
+            iterable: The same items, or iterable itself if metrics are disabled
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed(iterable, stage, source)
+
+    def _timed(self, iterable, stage, source):
+        """
+        Generator behind timed
+        """
+        iterator = iter(iterable)
+        while True:
+            with _Stage(self, stage, source):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _stack(self):
+        """
+        Return the stages currently open on this thread
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add_time(self, stage, seconds):
+        """
+        Add time to a stage total
+        """
+        key = (stage.source, stage.stage)
+        with self._lock:
+            self._times[key] = self._times.get(key, 0.0) + seconds
+
+    def _enter(self, stage):
+        """
+        Start a stage, pausing the stage it is nested in
+        """
+        now = time.perf_counter()
+        stack = self._stack()
+        if stack:
+            parent = stack[-1]
+            self._add_time(parent, now - parent.start)
+        stage.start = now
+        stack.append(stage)
+
+    def _exit(self, stage):
+        """
+        Stop a stage, resuming the stage it is nested in
+        """
+        now = time.perf_counter()
+        stack = self._stack()
+        stack.pop()
+        self._add_time(stage, now - stage.start)
+        if stack:
+            stack[-1].start = now
+
+    def new_counts(self):
+        """
+        Return a local counts dict for count_event, or None if metrics are disabled
+        """
+        return {} if self.enabled else None
+
+    def add_counts(self, counts):
+        """
+        Merge a local counts dict from count_event into the invocation totals
+        """
+        if not counts:
+            return
+        with self._lock:
+            for key, value in counts.items():
+                self._counts[key] = self._counts.get(key, 0) + value
+
+    def set_value(self, name, value, unit='Count'):
+        """
+        Set an invocation-wide metric such as the number of records received
+        """
+        if self.enabled:
+            with self._lock:
+                self._values[name] = (value, unit)
+
+    def _documents(self, timestamp):
+        """
+        Build the EMF documents for the collected metrics
+        """
+        def document(dimensions, values):
+            return {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(dimensions)],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in values.items()]
+                    }]
+                },
+                **dimensions,
+                **{name: value for name, (value, _) in values.items()}
+            }
+
+        invocation = dict(self._values)
+        sources = {}
+        event_types = {}
+        for (source, stage), seconds in self._times.items():
+            target = invocation if source is None else sources.setdefault(source, {})
+            name = STAGE_METRICS.get(stage, stage)
+            previous = target.get(name, (0.0, 'Milliseconds'))[0]
+            target[name] = (previous + seconds * 1000, 'Milliseconds')
+        for (source, event_type, outcome), value in self._counts.items():
+            name = OUTCOME_METRICS[outcome]
+            source_values = sources.setdefault(source, {})
+            source_values[name] = (source_values.get(name, (0, 'Count'))[0] + value, 'Count')
+            event_types.setdefault((source, event_type), {})[name] = (value, 'Count')
+
+        documents = []
+        if invocation:
+            documents.append(document({}, invocation))
+        for source, values in sources.items():
+            documents.append(document({'Source': source}, values))
+        for (source, event_type), values in event_types.items():
+            documents.append(document({'Source': source, 'EventType': event_type}, values))
+        return documents
+
+    def flush(self):
+        """
+        Emit the collected metrics as EMF log lines and reset the collector
+
+        One document is written for the invocation, one per source and one
+        per (source, event type), since EMF takes dimension values from the
+        document's top-level keys.
+
+        Returns:
+            list: The emitted documents
+        """
+        if not self.enabled:
+            return []
+        with self._lock:
+            documents = self._documents(int(time.time() * 1000))
+            self._times = {}
+            self._counts = {}
+            self._values = {}
+        for document in documents:
+            # EMF documents must be written as bare JSON lines, not through the log formatter
+            print(json.dumps(document), flush=True)
+        return documents
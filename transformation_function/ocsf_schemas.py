@@ -0,0 +1,349 @@
+"""
+OCSF output schema module.
+This module derives an explicit Arrow schema for every OCSF class a mapping
+file writes and conforms transformed tables to it, so Parquet files get
+integer, timestamp and struct types instead of whatever is inferred per batch.
+"""
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from columnar import merge_types
+from expressions import is_expression, expression_type
+
+logger = logging.getLogger()
+
+# OCSF timestamp_t attributes, stored as UTC milliseconds
+TIMESTAMP = pa.timestamp('ms', tz='UTC')
+
+# Low-cardinality strings are stored as dictionaries
+DICTIONARY_STRING = pa.dictionary(pa.int32(), pa.string())
+
+# Attribute types shared by every OCSF class
+BASE_ATTRIBUTE_TYPES = {
+    ('activity_id',): pa.int32(),
+    ('category_uid',): pa.int32(),
+    ('class_uid',): pa.int32(),
+    ('severity_id',): pa.int32(),
+    ('status_id',): pa.int32(),
+    ('type_uid',): pa.int64(),
+    ('count',): pa.int32(),
+    ('time',): TIMESTAMP,
+    ('start_time',): TIMESTAMP,
+    ('end_time',): TIMESTAMP,
+    ('device', 'type_id'): pa.int32(),
+}
+
+# Endpoint and connection attributes of the network classes
+_NETWORK_ATTRIBUTE_TYPES = {
+    ('src_endpoint', 'port'): pa.int32(),
+    ('dst_endpoint', 'port'): pa.int32(),
+    ('dst_endpoint', 'type_id'): pa.int32(),
+    ('connection_info', 'direction_id'): pa.int32(),
+    ('connection_info', 'protocol_num'): pa.int32(),
+    ('connection_info', 'protocol_ver_id'): pa.int32(),
+}
+
+# Attribute types per OCSF class, keyed by the mapping's schema name
+CLASS_ATTRIBUTE_TYPES = {
+    'http_activity': {
+        **_NETWORK_ATTRIBUTE_TYPES,
+        ('http_response', 'code'): pa.int32(),
+        ('traffic', 'bytes_in'): pa.int64(),
+        ('traffic', 'bytes_out'): pa.int64(),
+    },
+    'network_activity': {
+        **_NETWORK_ATTRIBUTE_TYPES,
+        ('traffic', 'bytes'): pa.int64(),
+        ('traffic', 'packets'): pa.int64(),
+    },
+    'process_activity': {
+        ('process', 'pid'): pa.int32(),
+    },
+    'file_activity': {
+        ('file', 'type_uid'): pa.int32(),
+    },
+}
+
+# Attributes with few distinct values per file, dictionary-encoded in Parquet
+LOW_CARDINALITY_ATTRIBUTES = {
+    ('activity_id',), ('activity_name',), ('app_name',), ('category_name',),
+    ('category_uid',), ('class_name',), ('class_uid',), ('severity',),
+    ('severity_id',), ('status_id',), ('type_uid',),
+    ('http_request', 'http_method'), ('http_request', 'url', 'scheme'),
+    ('http_response', 'code'), ('connection_info', 'protocol_name'),
+    ('dst_endpoint', 'hostname'), ('tls', 'cipher'), ('tls', 'version'),
+    ('metadata', 'product', 'uid'), ('unmapped', 'event_type'),
+    ('unmapped', 'app_proto'), ('unmapped', 'availability_zone'),
+    ('unmapped', 'action'),
+}
+
+# Values sources write for an absent field, nulled without a warning. Kept as a
+# list because building Arrow arrays from Python objects makes pyarrow import pandas
+_PLACEHOLDERS = ['', '-']
+
+def _value_type(value):
+    """
+    Return the Arrow type of a constant or enum value from a mapping
+    """
+    if value is None:
+        return pa.null()
+    if isinstance(value, str):
+        return DICTIONARY_STRING
+    try:
+        return pa.scalar(value).type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.string()
+
+def _node_type(path, node, attribute_types):
+    """
+    Return the Arrow type of a schema_mapping node, or None if it is left out
+    """
+    is_leaf = type(node) is not dict or 'enum' in node or is_expression(node)
+    if is_leaf and path in attribute_types:
+        return attribute_types[path]
+
+    if is_expression(node):
+        value_type = expression_type(node)
+        if pa.types.is_string(value_type) and path in LOW_CARDINALITY_ATTRIBUTES:
+            return DICTIONARY_STRING
+        return value_type
+    if type(node) is dict:
+        if 'enum' in node:
+            enum = node['enum']
+            evaluate = enum.get('evaluate') if type(enum) is dict else None
+            if not (isinstance(evaluate, str) and evaluate.startswith('$.')):
+                return None
+            values = list(enum.get('values', {}).values())
+            if 'other' in enum:
+                values.append(enum['other'])
+            value_type = pa.null()
+            for value in values:
+                value_type = merge_types(value_type, _value_type(value))
+            if pa.types.is_string(value_type):
+                value_type = DICTIONARY_STRING
+            return value_type if not pa.types.is_null(value_type) else pa.string()
+        fields = []
+        for key, child in node.items():
+            child_type = _node_type(path + (key,), child, attribute_types)
+            if child_type is not None:
+                fields.append((key, child_type))
+        return pa.struct(fields)
+
+    if isinstance(node, str) and node.startswith('$.'):
+        return DICTIONARY_STRING if path in LOW_CARDINALITY_ATTRIBUTES else pa.string()
+    value_type = _value_type(node)
+    return value_type if not pa.types.is_null(value_type) else pa.string()
+
+def class_schema(schema_name, schema_mapping):
+    """
+    Derive the Arrow schema of one ocsf_mapping entry
+
+    Locator fields are strings unless the OCSF class types the attribute,
+    constants and enums keep the type of their values, expressions take the
+    type they evaluate to and low-cardinality strings are dictionary-encoded.
+
+    Args:
+        schema_name (str): The mapping's schema, e.g. 'http_activity'
+        schema_mapping (dict): The schema_mapping tree of the entry
+
+    Returns:
+        pyarrow.Schema: One field per top-level mapping key
+    """
+    attribute_types = {**BASE_ATTRIBUTE_TYPES, **CLASS_ATTRIBUTE_TYPES.get(schema_name, {})}
+    return pa.schema(list(_node_type((), schema_mapping, attribute_types)))
+
+def merge_schemas(schemas):
+    """
+    Merge schemas into one holding every field, widening shared structs
+
+    Args:
+        schemas (iterable): pyarrow.Schema objects
+
+    Returns:
+        pyarrow.Schema: Union of the fields in first-seen order
+    """
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            types[field.name] = merge_types(types[field.name], field.type) if field.name in types else field.type
+    return pa.schema(list(types.items()))
+
+def build_class_schemas(mapping):
+    """
+    Derive the Arrow schema of every OCSF class written by a mapping file
+
+    Args:
+        mapping (dict): Parsed mapping file with custom_source_events
+
+    Returns:
+        dict: pyarrow.Schema per schema name, merged across matched values
+    """
+    schemas = {}
+    for event_mapping in mapping['custom_source_events']['ocsf_mapping'].values():
+        schemas.setdefault(event_mapping['schema'], []).append(
+            class_schema(event_mapping['schema'], event_mapping['schema_mapping'])
+        )
+    return {schema_name: merge_schemas(class_schemas) for schema_name, class_schemas in schemas.items()}
+
+def build_source_schema(mapping):
+    """
+    Derive the Arrow schema of the files written for a mapping file
+
+    Args:
+        mapping (dict): Parsed mapping file with custom_source_events
+
+    Returns:
+        pyarrow.Schema: Union of the schemas of the classes the source writes
+    """
+    return merge_schemas(build_class_schemas(mapping).values())
+
+def _null_placeholders(column):
+    """
+    Replace empty and '-' strings with nulls
+    """
+    return pc.if_else(pc.is_in(column, value_set=pa.array(_PLACEHOLDERS, type=pa.string())), pa.scalar(None, type=pa.string()), column)
+
+def _convert_timestamp(value, target):
+    """
+    Convert one timestamp string, returning None if it can't be parsed
+    """
+    for parse_type in (pa.timestamp('ns', tz='UTC'), pa.timestamp('ns')):
+        try:
+            # Zone-less strings are read as UTC
+            parsed = pa.array([value]).cast(parse_type).cast(pa.timestamp('ns', tz='UTC'))
+            return parsed.cast(target, safe=False)[0].as_py()
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            pass
+    try:
+        return pa.scalar(int(float(value) * 1000), type=pa.int64()).cast(target).as_py()
+    except (ValueError, OverflowError, pa.ArrowInvalid):
+        return None
+
+def _convert_scalar(value, target):
+    """
+    Convert one value to the target type, returning None if it doesn't fit
+    """
+    if pa.types.is_timestamp(target) and isinstance(value, str):
+        return _convert_timestamp(value, target)
+    try:
+        if pa.types.is_integer(target) and isinstance(value, str):
+            value = int(value)
+        return pa.array([value]).cast(target)[0].as_py()
+    except (ValueError, TypeError, pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return None
+
+def _convert_values(column, target):
+    """
+    Convert the distinct values of a column one by one, nulling the ones that fail
+    """
+    unique = pc.unique(column)
+    lookup = pa.array([_convert_scalar(value, target) for value in unique.to_pylist()], type=target)
+    return lookup.take(pc.index_in(column, value_set=unique))
+
+def _cast_leaf(column, target):
+    """
+    Cast a leaf column, converting values that don't cast as a whole one by one
+    """
+    if pa.types.is_timestamp(target) and pa.types.is_string(column.type):
+        for parse_type in (pa.timestamp('ns', tz='UTC'), pa.timestamp('ns')):
+            try:
+                parsed = column.cast(parse_type).cast(pa.timestamp('ns', tz='UTC'))
+                return parsed.cast(target, safe=False)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                pass
+        return _convert_values(column, target)
+    try:
+        return column.cast(target)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        return _convert_values(column, target)
+
+def _conform_column(name, column, target):
+    """
+    Conform a column to its schema type, nulling values that can't be converted
+    """
+    if column.type == target:
+        return column
+    if pa.types.is_null(column.type):
+        return pa.nulls(len(column), type=target)
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+
+    if pa.types.is_struct(target):
+        if not pa.types.is_struct(column.type):
+            logger.warning(f"Field {name} is not an object, setting to null")
+            return pa.nulls(len(column), type=target)
+        names = {field.name for field in column.type}
+        children = [
+            _conform_column(f'{name}.{field.name}', column.field(field.name), field.type) if field.name in names
+            else pa.nulls(len(column), type=field.type)
+            for field in target
+        ]
+        mask = column.is_null() if column.null_count else None
+        return pa.StructArray.from_arrays(children, fields=list(target), mask=mask)
+
+    value_type = target.value_type if pa.types.is_dictionary(target) else target
+    if pa.types.is_string(column.type) and not pa.types.is_string(value_type):
+        column = _null_placeholders(column)
+    converted = _cast_leaf(column, value_type) if column.type != value_type else column
+    failed = converted.null_count - column.null_count
+    if failed:
+        logger.warning(f"{failed} values of field {name} could not be converted to {value_type}, setting to null")
+    if pa.types.is_dictionary(target):
+        converted = converted.dictionary_encode().cast(target)
+    return converted
+
+def conform_table(table, schema):
+    """
+    Conform a transformed table to an output schema
+
+    Columns are reordered to the schema, missing fields are added as nulls,
+    strings are converted to the typed attributes (values that can't be
+    converted become null) and columns the schema doesn't know are kept.
+
+    Args:
+        table (pyarrow.Table): Transformed OCSF records
+        schema (pyarrow.Schema): Schema from build_source_schema
+
+    Returns:
+        pyarrow.Table: Table with the schema's fields first
+    """
+    arrays = []
+    names = []
+    for field in schema:
+        if field.name in table.column_names:
+            arrays.append(_conform_column(field.name, table.column(field.name).combine_chunks(), field.type))
+        else:
+            arrays.append(pa.nulls(table.num_rows, type=field.type))
+        names.append(field.name)
+    for name in table.column_names:
+        if name not in schema.names:
+            logger.debug(f"Field {name} is not in the output schema, keeping inferred type")
+            arrays.append(table.column(name))
+            names.append(name)
+    return pa.Table.from_arrays(arrays, names=names)
+
+def _dictionary_paths(field_type, path, attributes, paths):
+    """
+    Add the dotted paths of dictionary and low-cardinality leaves to paths
+    """
+    if pa.types.is_struct(field_type):
+        for child in field_type:
+            _dictionary_paths(child.type, path + (child.name,), attributes, paths)
+    elif pa.types.is_dictionary(field_type) or path in attributes:
+        paths.append('.'.join(path))
+
+def dictionary_columns(schema):
+    """
+    Return the Parquet column paths to write with dictionary encoding
+
+    Args:
+        schema (pyarrow.Schema): Schema of the table being written
+
+    Returns:
+        list: Dotted column paths, e.g. 'http_request.http_method'
+    """
+    paths = []
+    for field in schema:
+        _dictionary_paths(field.type, (field.name,), LOW_CARDINALITY_ATTRIBUTES, paths)
+    return paths
@@ -0,0 +1,236 @@
+"""
+Parquet write options module.
+This module resolves the Parquet settings of each source (codec, row group
+size, sort order and Bloom filter columns) and turns them into writer
+arguments, so files can be pruned by time range and IP at query time. It
+also resolves where the files of a source go, either one location per
+source or one per OCSF class.
+"""
+import inspect
+import logging
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger()
+
+# Parquet codecs a source can select, with the suffix of the written objects
+FILE_SUFFIXES = {
+    'gzip': '.gz.parquet',
+    'snappy': '.snappy.parquet',
+    'zstd': '.zstd.parquet',
+    'none': '.parquet'
+}
+
+# Object prefix of the files of a source when all its classes are written together
+SOURCE_PATH = 'ext/{source}/region={region}/accountId={account_id}/eventDay={eventday}'
+
+# Default object prefix of the files of one class when classes are written apart
+CLASS_PATH = 'ext/{source}-{schema}/region={region}/accountId={account_id}/eventDay={eventday}'
+
+# How the events of a source are split into files
+PARTITION_MODES = ('source', 'class')
+
+# False-positive probability of the Bloom filters written per column
+BLOOM_FILTER_FPP = 0.05
+
+# Bloom filters need a pyarrow release with bloom_filter_options
+BLOOM_FILTERS_SUPPORTED = 'bloom_filter_options' in inspect.signature(pq.write_table).parameters
+
+# Sort order metadata needs a pyarrow release with SortingColumn (13 and later);
+# older releases still get sorted rows, just without the metadata
+SORTING_COLUMNS_SUPPORTED = (
+    hasattr(getattr(pq, 'SortingColumn', None), 'from_ordering')
+    and 'sorting_columns' in inspect.signature(pq.write_table).parameters
+)
+
+def _split_list(value):
+    """
+    Split a comma-separated setting into a list, accepting lists as-is
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip() and item.strip().lower() != 'none']
+    return list(value)
+
+def _column(table, path):
+    """
+    Return the column at a dotted path of a table, or None if it doesn't exist
+    """
+    names = path.split('.')
+    if names[0] not in table.column_names:
+        return None
+    column = table.column(names[0]).combine_chunks()
+    for name in names[1:]:
+        if not pa.types.is_struct(column.type) or column.type.get_field_index(name) == -1:
+            return None
+        column = pc.struct_field(column, name)
+    if pa.types.is_dictionary(column.type):
+        column = column.dictionary_decode()
+    return column
+
+class ParquetOptions:
+    """
+    Parquet settings of one source
+
+    Args:
+        compression (str): Codec, one of FILE_SUFFIXES
+        row_group_size (int): Maximum rows per row group, None for the pyarrow default
+        sort_by (list): Column paths each file is sorted by, e.g. ['time', 'class_uid']
+        bloom_filter_columns (list): Column paths to write Bloom filters for
+        partition_by (str): 'source' writes all classes of a source to one file per
+            eventDay, 'class' writes one file per OCSF class with its own schema
+        class_paths (dict): Object prefix template per schema name used with
+            partition_by 'class', CLASS_PATH for classes without one
+    """
+    def __init__(self, compression='gzip', row_group_size=None, sort_by=None, bloom_filter_columns=None,
+                 partition_by='source', class_paths=None):
+        compression = str(compression).lower()
+        if compression not in FILE_SUFFIXES:
+            logger.warning(f"Unsupported Parquet compression {compression}, using gzip")
+            compression = 'gzip'
+        self.compression = compression
+        self.row_group_size = int(row_group_size) if row_group_size else None
+        self.sort_by = _split_list(sort_by)
+        self.bloom_filter_columns = _split_list(bloom_filter_columns)
+        if self.bloom_filter_columns and not BLOOM_FILTERS_SUPPORTED:
+            logger.warning("Installed pyarrow cannot write Bloom filters, skipping bloom_filter_columns")
+            self.bloom_filter_columns = []
+        partition_by = str(partition_by).lower()
+        if partition_by not in PARTITION_MODES:
+            logger.warning(f"Unsupported output partitioning {partition_by}, using source")
+            partition_by = 'source'
+        self.partition_by = partition_by
+        self.class_paths = {}
+        for schema, template in (class_paths or {}).items():
+            try:
+                template.format(source='', schema='', region='', account_id='', eventday='')
+            except (KeyError, IndexError, ValueError, AttributeError) as e:
+                logger.warning(f"Invalid output path template for class {schema}: {str(e)}, using {CLASS_PATH}")
+                continue
+            self.class_paths[schema] = template.strip('/')
+
+    @property
+    def file_suffix(self):
+        """
+        Suffix of the objects written with this codec
+        """
+        return FILE_SUFFIXES[self.compression]
+
+    @property
+    def split_by_class(self):
+        """
+        True if each OCSF class of the source is written to its own files
+        """
+        return self.partition_by == 'class'
+
+    def object_prefix(self, source, eventday, region, account_id, schema=None):
+        """
+        Return the object prefix of the files written for a group of events
+
+        Args:
+            source (str): Source name
+            eventday (str): Partition day as YYYYMMDD
+            region (str): Region of the partition
+            account_id (str): Account of the partition
+            schema (str): Schema name of the group when classes are written apart
+
+        Returns:
+            str: Prefix ending in '/'
+        """
+        template = SOURCE_PATH if schema is None else self.class_paths.get(schema, CLASS_PATH)
+        return template.format(source=source, schema=schema, region=region, account_id=account_id,
+                               eventday=eventday) + '/'
+
+    def sort_table(self, table):
+        """
+        Sort a table by the sort_by columns it has, keeping arrival order for ties
+
+        Args:
+            table (pyarrow.Table): Table about to be written
+
+        Returns:
+            pyarrow.Table: Sorted table
+        """
+        keys = [(path, _column(table, path)) for path in self.sort_by]
+        keys = [(path, column) for path, column in keys if column is not None]
+        if not keys or table.num_rows < 2:
+            return table
+        sort_table = pa.Table.from_arrays([column for _, column in keys], names=[str(i) for i in range(len(keys))])
+        indices = pc.sort_indices(sort_table, sort_keys=[(str(i), 'ascending') for i in range(len(keys))])
+        return table.take(indices)
+
+    def sort_frame(self, df):
+        """
+        Sort a DataFrame by the top-level sort_by columns it has
+
+        Args:
+            df (pandas.DataFrame): Frame about to be written
+
+        Returns:
+            pandas.DataFrame: Sorted frame
+        """
+        keys = [path for path in self.sort_by if path in df.columns]
+        if not keys:
+            return df
+        try:
+            return df.sort_values(keys, kind='stable', na_position='last')
+        except TypeError as e:
+            logger.warning(f"Could not sort output by {keys}: {str(e)}")
+            return df
+
+    def write_table_kwargs(self, table):
+        """
+        Build the pyarrow.parquet.write_table arguments for a sorted table
+
+        Args:
+            table (pyarrow.Table): Table returned by sort_table
+
+        Returns:
+            dict: Keyword arguments for write_table
+        """
+        kwargs = {
+            'compression': self.compression,
+            'write_statistics': True
+        }
+        if self.row_group_size:
+            kwargs['row_group_size'] = self.row_group_size
+
+        # Record the sort order of top-level leaf columns in the row group metadata
+        sorting = []
+        for path in self.sort_by if SORTING_COLUMNS_SUPPORTED else ():
+            if path not in table.column_names or pa.types.is_nested(table.schema.field(path).type):
+                break
+            sorting.append((path, 'ascending'))
+        if sorting:
+            kwargs['sorting_columns'] = pq.SortingColumn.from_ordering(table.schema, sorting)
+
+        bloom_filters = {
+            path: {'ndv': max(table.num_rows, 1), 'fpp': BLOOM_FILTER_FPP}
+            for path in self.bloom_filter_columns if _column(table, path) is not None
+        }
+        if bloom_filters:
+            kwargs['bloom_filter_options'] = bloom_filters
+        return kwargs
+
+def load_parquet_options(sources_config, defaults):
+    """
+    Resolve the Parquet options of every source
+
+    Each source can override the defaults with an 'output' block in
+    sources_config.json holding compression, row_group_size, sort_by,
+    bloom_filter_columns, partition_by and class_paths.
+
+    Args:
+        sources_config (dict): Parsed sources_config.json
+        defaults (dict): Settings used where a source has no override
+
+    Returns:
+        dict: ParquetOptions per source name
+    """
+    options = {}
+    for source in sources_config['sources']:
+        settings = {**defaults, **source.get('output', {})}
+        options[source['name']] = ParquetOptions(**settings)
+    return options
@@ -5,115 +5,279 @@ This module handles the preprocessing of ALB logs into structured format.
 import logging
 import re
 import json
+from functools import lru_cache
+
+from log_limiter import limiter
 
 logger = logging.getLogger()
 
-def preprocess_event(raw_log):
+# Source name in sources_config.json, so warnings are counted with the source's others
+SOURCE_NAME = 'aws-alb'
+
+ALB_FIELDS = [
+    "type", "time", "elb", "client:port", "target:port",
+    "request_processing_time", "target_processing_time",
+    "response_processing_time", "elb_status_code", "target_status_code",
+    "received_bytes", "sent_bytes", "request", "user_agent", "ssl_cipher",
+    "ssl_protocol", "target_group_arn", "trace_id", "domain_name",
+    "chosen_cert_arn", "matched_rule_priority", "request_creation_time",
+    "actions_executed", "redirect_url", "error_reason", "target:port_list",
+    "target_status_code_list", "classification", "classification_reason",
+    "conn_trace_id"
+]
+
+# Splits a log entry on whitespace, preserving quoted strings
+ALB_TOKEN_PATTERN = re.compile(r'(?:[^\s"]+|"[^"]*")+')
+
+# Fields copied as-is, grouped by the positions between the fields that get split
+_PLAIN_FIELDS = (
+    (0, ALB_FIELDS[0:3]),
+    (5, ALB_FIELDS[5:12]),
+    (13, ALB_FIELDS[13:25]),
+    (26, ALB_FIELDS[26:30])
+)
+
+# Fields produced by splitting the value at each position
+_SPLIT_FIELDS = {
+    3: ("client_ip", "client_port"),
+    4: ("target_ip", "target_port"),
+    12: ("request", "request_method", "request_url", "request_protocol"),
+    25: ("target_ip_list", "target_port_list")
+}
+
+@lru_cache(maxsize=64)
+def _field_plan(fields):
+    """
+    Return the (position, name) plain fields and split positions a mapping reads
+
+    'time' is always kept for the missing time warning.
+
+    Args:
+        fields (frozenset): Paths the mapping reads, as tuples of keys
+
+    Returns:
+        tuple: Plain fields and split positions, or None if every field is read
+    """
+    if fields is None or () in fields:
+        return None
+    names = {path[0] for path in fields}
+    names.add("time")
+    plain = tuple(
+        (start + offset, name)
+        for start, group in _PLAIN_FIELDS
+        for offset, name in enumerate(group)
+        if name in names
+    )
+    splits = tuple(position for position, split_names in _SPLIT_FIELDS.items() if names.intersection(split_names))
+    return plain, splits
+
+def preprocess_event(raw_log, fields=None):
     """
     Preprocess a raw ALB log string
     
     Args:
         raw_log (str): Raw ALB log entry string
+        fields (frozenset): Paths the source's mapping reads, as tuples of
+            keys; when given only those fields are built
         
     Returns:
         dict: Structured data extracted from the log
     """
-    return preprocess_alb_log_entry(raw_log)
+    return preprocess_alb_log_entry(raw_log, fields)
 
-def preprocess_alb_log_entry(log_entry):
+def preprocess_batch(raw_logs, fields=None):
     """
-    Preprocess a single ALB log entry string into structured data
-    
+    Preprocess a batch of raw ALB log strings in one pass
+
+    Produces the same structured data as preprocess_event for every line,
+    using the precompiled tokenizer and a positional fast path for complete
+    entries.
+
+    Args:
+        raw_logs (list): Raw ALB log entry strings
+        fields (frozenset): Paths the source's mapping reads, as in preprocess_event
+
+    Returns:
+        list: Structured data extracted from each log, in input order
+    """
+    plan = _field_plan(fields)
+    return [_parse_values(_tokenize(raw_log), plan) for raw_log in raw_logs]
+
+def _tokenize(log_entry):
+    """
+    Split a log entry into unquoted values
+
+    Entries whose quoted strings are all delimited by whitespace are split
+    with str.split; anything else goes through ALB_TOKEN_PATTERN so the
+    result always matches the regex tokenizer.
+
     Args:
         log_entry (str): Raw ALB log entry string
-        
+
+    Returns:
+        list: Values with surrounding quotes removed
+    """
+    parts = log_entry.split('"')
+    last = len(parts) - 1
+    if last % 2 == 0:
+        values = []
+        for i, part in enumerate(parts):
+            if i % 2:
+                values.append(part)
+                continue
+            # Quotes must be separated from neighbouring values by whitespace
+            if (i > 0 and not part[:1].isspace()) or (i < last and not part[-1:].isspace()):
+                break
+            values.extend(part.split())
+        else:
+            return values
+    return [value.strip('"') for value in ALB_TOKEN_PATTERN.findall(log_entry)]
+
+def _split_ip_port(result, prefix, value):
+    """
+    Split an 'ip:port' value into <prefix>_ip and <prefix>_port
+    """
+    if value == '-':
+        result[prefix + "_ip"] = '-'
+        result[prefix + "_port"] = '-'
+    else:
+        try:
+            ip, port = value.rsplit(':', 1)
+            result[prefix + "_ip"] = ip
+            result[prefix + "_port"] = port
+        except ValueError:
+            result[prefix + "_ip"] = '-'
+            result[prefix + "_port"] = '-'
+
+def _split_target_port_list(result, value):
+    """
+    Split a space separated 'ip:port' list into target_ip_list and target_port_list
+    """
+    if value == '-':
+        result["target_ip_list"] = '-'
+        result["target_port_list"] = '-'
+    else:
+        try:
+            ip_port_list = value.split(' ')
+            result["target_ip_list"] = ' '.join([ip_port.rsplit(':', 1)[0] for ip_port in ip_port_list])
+            result["target_port_list"] = ' '.join([ip_port.rsplit(':', 1)[1] for ip_port in ip_port_list])
+        except (ValueError, IndexError):
+            result["target_ip_list"] = '-'
+            result["target_port_list"] = '-'
+
+def _split_request(result, value):
+    """
+    Split the request field into request_method, request_url and request_protocol
+    """
+    if value != '-':
+        request_parts = value.split(' ')
+        if len(request_parts) == 3:
+            result["request_method"] = request_parts[0]
+            result["request_url"] = request_parts[1]
+            result["request_protocol"] = request_parts[2]
+        else:
+            # If the request doesn't have the expected format, keep it as is
+            result["request"] = value
+    else:
+        result["request_method"] = '-'
+        result["request_url"] = '-'
+        result["request_protocol"] = '-'
+
+def _parse_values(values, plan=None):
+    """
+    Build the structured ALB fields from the values of one log entry
+
+    Args:
+        values (list): Values returned by _tokenize
+        plan (tuple): Result of _field_plan, None to build every field
+
     Returns:
         dict: Parsed fields from the ALB log
     """
-    logger.debug(f"Preprocessing ALB log entry type: {type(log_entry)}")
-    fields = [
-        "type", "time", "elb", "client:port", "target:port",
-        "request_processing_time", "target_processing_time",
-        "response_processing_time", "elb_status_code", "target_status_code",
-        "received_bytes", "sent_bytes", "request", "user_agent", "ssl_cipher",
-        "ssl_protocol", "target_group_arn", "trace_id", "domain_name",
-        "chosen_cert_arn", "matched_rule_priority", "request_creation_time",
-        "actions_executed", "redirect_url", "error_reason", "target:port_list",
-        "target_status_code_list", "classification", "classification_reason",
-        "conn_trace_id"
-    ]
-    
-    # Use regex to split the log entry, preserving quoted strings
-    values = re.findall(r'(?:[^\s"]+|"[^"]*")+', log_entry)
-    
-    # Debug log for parsing results
-    logger.debug(f"Parsed {len(values)} values from ALB log")
-    
+    if len(values) < len(ALB_FIELDS):
+        return _parse_partial_values(values)
+
+    result = {}
+    if plan is not None:
+        plain, splits = plan
+        for position, name in plain:
+            result[name] = values[position]
+        for position in splits:
+            _SPLITTERS[position](result, values[position])
+        return result
+
+    for start, names in _PLAIN_FIELDS:
+        result.update(zip(names, values[start:start + len(names)]))
+    _split_ip_port(result, "client", values[3])
+    _split_ip_port(result, "target", values[4])
+    _split_request(result, values[12])
+    _split_target_port_list(result, values[25])
+    return result
+
+# Splitters of the values at each split position
+_SPLITTERS = {
+    3: lambda result, value: _split_ip_port(result, "client", value),
+    4: lambda result, value: _split_ip_port(result, "target", value),
+    12: _split_request,
+    25: _split_target_port_list
+}
+
+def _parse_partial_values(values):
+    """
+    Build the structured ALB fields for an entry with fewer tokens than fields
+
+    Fields without a token are set to '-' under their raw field name.
+    """
     result = {}
     
-    for i, field in enumerate(fields):
+    for i, field in enumerate(ALB_FIELDS):
         if i < len(values):
-            value = values[i].strip('"')
-            
-            # Special debug for time field
-            if field == "time":
-                logger.debug(f"Extracted time value: {value}")
+            value = values[i]
             
             if field in ["client:port", "target:port"]:
-                if value == '-':
-                    result[field.replace(":port", "_ip")] = '-'
-                    result[field.replace(":port", "_port")] = '-'
-                else:
-                    try:
-                        ip, port = value.rsplit(':', 1)
-                        result[field.replace(":port", "_ip")] = ip
-                        result[field.replace(":port", "_port")] = port
-                    except ValueError:
-                        result[field.replace(":port", "_ip")] = '-'
-                        result[field.replace(":port", "_port")] = '-'
-            
+                _split_ip_port(result, field.replace(":port", ""), value)
             elif field == "target:port_list":
-                if value == '-':
-                    result["target_ip_list"] = '-'
-                    result["target_port_list"] = '-'
-                else:
-                    try:
-                        ip_port_list = value.split(' ')
-                        result["target_ip_list"] = ' '.join([ip_port.rsplit(':', 1)[0] for ip_port in ip_port_list])
-                        result["target_port_list"] = ' '.join([ip_port.rsplit(':', 1)[1] for ip_port in ip_port_list])
-                    except (ValueError, IndexError):
-                        result["target_ip_list"] = '-'
-                        result["target_port_list"] = '-'
-            
+                _split_target_port_list(result, value)
             elif field == "request":
-                if value != '-':
-                    request_parts = value.split(' ')
-                    if len(request_parts) == 3:
-                        result["request_method"] = request_parts[0]
-                        result["request_url"] = request_parts[1]
-                        result["request_protocol"] = request_parts[2]
-                    else:
-                        # If the request doesn't have the expected format, keep it as is
-                        result["request"] = value
-                else:
-                    result["request_method"] = '-'
-                    result["request_url"] = '-'
-                    result["request_protocol"] = '-'
-            
+                _split_request(result, value)
             else:
-                result[field] = value if value != '-' else '-'
+                result[field] = value
         else:
             result[field] = '-'
     
     # Remove the original "request" field if it was successfully split
     if "request_method" in result:
         result.pop("request", None)
+
+    return result
+
+def preprocess_alb_log_entry(log_entry, fields=None):
+    """
+    Preprocess a single ALB log entry string into structured data
+    
+    Args:
+        log_entry (str): Raw ALB log entry string
+        fields (frozenset): Paths the source's mapping reads, None for every field
+        
+    Returns:
+        dict: Parsed fields from the ALB log
+    """
+    logger.debug("Preprocessing ALB log entry type: %s", type(log_entry))
+    
+    # Split the log entry, preserving quoted strings
+    values = _tokenize(log_entry)
+    
+    # Debug log for parsing results
+    logger.debug("Parsed %d values from ALB log", len(values))
+    
+    result = _parse_values(values, _field_plan(fields))
     
     # Debug log for extracted fields
-    logger.debug(f"Extracted fields: {list(result.keys())}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Extracted fields: %s", list(result.keys()))
     if 'time' in result:
-        logger.debug(f"Time field value: {result['time']}")
+        logger.debug("Time field value: %s", result['time'])
     else:
-        logger.warning("No time field extracted from ALB log")
+        limiter.warning(SOURCE_NAME, 'time', "No time field extracted from ALB log")
     
-    return result
\ No newline at end of file
+    return result
@@ -3,10 +3,26 @@ Windows Sysmon event preprocessor module.
 This module handles the preprocessing of Windows Sysmon events.
 """
 import logging
+from functools import lru_cache
 
 logger = logging.getLogger()
 
-def preprocess_event(payload_json):
+@lru_cache(maxsize=64)
+def _description_keys(fields):
+    """
+    Return the Description keys read by a mapping, or None if every line has to be parsed
+
+    Lines without a ': ' delimiter are numbered by their position among the
+    parsed keys, so a mapping reading any LineN key gets the full parse.
+    """
+    if fields is None or ('Description',) in fields:
+        return None
+    keys = frozenset(path[1] for path in fields if len(path) > 1 and path[0] == 'Description')
+    if any(key.startswith('Line') for key in keys):
+        return None
+    return keys
+
+def preprocess_event(payload_json, fields=None):
     """
     Preprocess Windows Sysmon events
     
@@ -14,26 +30,37 @@ def preprocess_event(payload_json):
     
     Args:
         payload_json (dict): The raw Sysmon event JSON
+        fields (frozenset): Paths the source's mapping reads, as tuples of keys;
+            when given only the Description keys it reads are extracted
         
     Returns:
         dict: The processed Sysmon event with Description field parsed
     """
     if 'Description' in payload_json and isinstance(payload_json['Description'], str):
+        description = payload_json['Description']
+        keys = _description_keys(fields)
         data = {}
-        for line in payload_json['Description'].split('\r\n'):
-            parts = line.split(': ', 1)  # Splitting by ': '
-            if len(parts) > 1:
-                key = parts[0]
-                value = parts[1]
-                data[key] = value
-            elif len(parts) == 1 and parts[0]:
-                # Handle lines without delimiter but with content
-                data[f"Line{len(data)+1}"] = parts[0]
+        if keys is not None:
+            # Only keep the lines whose key the mapping reads
+            for line in description.split('\r\n'):
+                key, delimiter, value = line.partition(': ')
+                if delimiter and key in keys:
+                    data[key] = value
+        else:
+            for line in description.split('\r\n'):
+                parts = line.split(': ', 1)  # Splitting by ': '
+                if len(parts) > 1:
+                    key = parts[0]
+                    value = parts[1]
+                    data[key] = value
+                elif len(parts) == 1 and parts[0]:
+                    # Handle lines without delimiter but with content
+                    data[f"Line{len(data)+1}"] = parts[0]
         
         # Replace the original Description string with the structured data
         payload_json['Description'] = data
         logger.debug("Preprocessed Sysmon Description field successfully")
     else:
         logger.debug("No Description field to preprocess or already in structured format")
-        
-    return payload_json
\ No newline at end of file
+
+    return payload_json
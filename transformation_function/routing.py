@@ -0,0 +1,188 @@
+"""
+Source routing module.
+This module builds lookup structures from sources_config.json once so that
+S3 objects, Kinesis records and CloudWatch Logs log groups are routed to a
+source in constant time, however many sources and buckets are configured.
+"""
+import logging
+import re
+from functools import lru_cache
+
+logger = logging.getLogger()
+
+# Number of recent (bucket, key directory) routing decisions kept
+ROUTE_CACHE_SIZE = 1024
+
+# Number of recent log group routing decisions kept
+LOG_GROUP_CACHE_SIZE = 256
+
+# Characters with a regex meaning in a prefix other than the '*' wildcard
+_REGEX_METACHARACTERS = set('.^$+?{}[]\\|()')
+
+# function to convert S3 prefix pattern to regex pattern
+def create_regex_from_prefix(prefix: str) -> str:
+    # Escape any forward slashes first
+    prefix = prefix.replace('/', '\\/')
+    # Replace /* with regex pattern that matches anything
+    regex_pattern = prefix.replace('*', '.*')
+    return f"^{regex_pattern}$"
+
+def _directory_prefix(prefix):
+    """
+    Return the literal part of a 'some/path/*' prefix, or None
+
+    Routing for such prefixes only depends on the directory part of the key,
+    which makes the decision cacheable.
+    """
+    literal = prefix[:-1]
+    if not prefix.endswith('/*') or '*' in literal or _REGEX_METACHARACTERS.intersection(literal):
+        return None
+    return literal
+
+class SourceRouter:
+    """
+    Routes S3 objects, Kinesis records and CloudWatch Logs log groups to the configured source name
+
+    Sources are matched in configuration order, so the first matching source
+    wins exactly as in a linear scan of sources_config.json.
+    """
+
+    def __init__(self, sources_config):
+        s3_rules = {}
+        self._kinesis_fields = {}
+        self._kinesis_order = {}
+        log_group_rules = []
+        for source in sources_config['sources']:
+            s3_config = source['input_paths'].get('s3', {})
+            if s3_config.get('enabled', False):
+                for source_bucket in s3_config.get('source_buckets', []):
+                    prefix = source_bucket.get('prefix')
+                    if prefix:
+                        s3_rules.setdefault(source_bucket.get('bucket_name'), []).append((prefix, source['name']))
+
+            kinesis_config = source['input_paths'].get('kinesis', {})
+            if kinesis_config.get('enabled', False):
+                metadata_field = kinesis_config.get('metadata_field', 'source')
+                self._kinesis_fields.setdefault(metadata_field, set()).add(source['name'])
+                self._kinesis_order.setdefault(source['name'], len(self._kinesis_order))
+                for log_group in kinesis_config.get('log_groups', []):
+                    log_group_rules.append((log_group, source['name']))
+
+        self._s3_buckets = {
+            bucket_name: self._compile_bucket(rules)
+            for bucket_name, rules in s3_rules.items()
+        }
+        self._log_groups = self._compile_bucket(log_group_rules)[:3] if log_group_rules else None
+        self._route_directory = lru_cache(maxsize=ROUTE_CACHE_SIZE)(self._route_directory)
+        self.route_log_group = lru_cache(maxsize=LOG_GROUP_CACHE_SIZE)(self.route_log_group)
+
+    @staticmethod
+    def _compile_bucket(rules):
+        """
+        Compile the (prefix, source) rules of one bucket
+
+        Returns:
+            tuple: Combined pattern, source per group name, and the literal
+            directory prefixes if every rule is a cacheable 'dir/*' prefix
+        """
+        alternatives = []
+        group_sources = {}
+        for index, (prefix, source_name) in enumerate(rules):
+            alternatives.append(f"(?P<r{index}>{create_regex_from_prefix(prefix)})")
+            group_sources[f"r{index}"] = source_name
+        try:
+            pattern = re.compile('|'.join(alternatives))
+        except re.error:
+            # Prefixes that can't be combined are matched one by one
+            pattern = None
+        literals = [(_directory_prefix(prefix), source_name) for prefix, source_name in rules]
+        if any(literal is None for literal, _ in literals):
+            literals = None
+        return pattern, group_sources, rules, literals
+
+    def _route_directory(self, bucket_name, directory):
+        """
+        Route a key directory using the literal prefixes of its bucket
+        """
+        for literal, source_name in self._s3_buckets[bucket_name][3]:
+            if directory.startswith(literal):
+                return source_name
+        return None
+
+    def route_s3(self, bucket_name, object_key):
+        """
+        Return the source for an S3 object, or None if no prefix matches
+
+        Args:
+            bucket_name (str): Name of the bucket holding the object
+            object_key (str): URL decoded object key
+
+        Returns:
+            str: Source name, or None
+        """
+        bucket_route = self._s3_buckets.get(bucket_name)
+        if bucket_route is None:
+            return None
+        pattern, group_sources, rules, literals = bucket_route
+
+        if literals is not None and '\n' not in object_key:
+            return self._route_directory(bucket_name, object_key[:object_key.rfind('/') + 1])
+        if pattern is not None:
+            match = pattern.match(object_key)
+            return group_sources[match.lastgroup] if match else None
+        for prefix, source_name in rules:
+            if re.match(create_regex_from_prefix(prefix), object_key):
+                return source_name
+        return None
+
+    def route_kinesis(self, payload_json):
+        """
+        Return the source for a Kinesis payload, or None
+
+        The source name is read from each configured metadata field, at the
+        top level of the payload or under 'metadata'.
+
+        Args:
+            payload_json (dict): Decoded Kinesis payload
+
+        Returns:
+            str: Source name, or None
+        """
+        if type(payload_json) is not dict:
+            return None
+        metadata = payload_json.get('metadata')
+        if type(metadata) is not dict:
+            metadata = {}
+
+        best = None
+        for metadata_field, source_names in self._kinesis_fields.items():
+            for container in (payload_json, metadata):
+                value = container.get(metadata_field)
+                if type(value) is str and value in source_names:
+                    if best is None or self._kinesis_order[value] < self._kinesis_order[best]:
+                        best = value
+        return best
+
+    def route_log_group(self, log_group):
+        """
+        Return the source for a CloudWatch Logs log group, or None
+
+        Log group patterns come from the 'log_groups' list of a source's
+        kinesis input and may use '*' wildcards like S3 prefixes.
+
+        Args:
+            log_group (str): Log group name from a subscription payload
+
+        Returns:
+            str: Source name, or None
+        """
+        if self._log_groups is None or type(log_group) is not str:
+            return None
+        pattern, group_sources, rules = self._log_groups
+        if pattern is not None:
+            match = pattern.match(log_group)
+            return group_sources[match.lastgroup] if match else None
+        for log_group_pattern, source_name in rules:
+            if re.match(create_regex_from_prefix(log_group_pattern), log_group):
+                return source_name
+        return None
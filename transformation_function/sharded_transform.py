@@ -0,0 +1,158 @@
+"""
+Sharded transform module.
+This module spreads the lines of a large S3 object over worker processes.
+The calling thread keeps decompressing and hands out shards of lines over
+pipes, each worker preprocesses and maps its shards, and the results come
+back in shard order. Workers are forked so they share the compiled mappings
+and preprocessors the function already loaded, and talk over Pipe rather
+than Queue or a Pool because Lambda has no /dev/shm.
+
+A fork copies the locks of every thread in their current state, so a lock
+held by another thread (logging, the S3 client's connection pool) stays
+held forever in the child. Workers are therefore all forked up front, by
+the caller, before it starts any other thread.
+"""
+import logging
+import multiprocessing
+import threading
+from multiprocessing.connection import wait
+
+logger = logging.getLogger()
+
+def _worker(conn, transform):
+    """
+    Worker loop: transform tasks received on conn until the None sentinel
+    """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        try:
+            conn.send((transform(task), None))
+        except Exception as e:
+            # Exceptions aren't always picklable, so only their description is sent back
+            conn.send((None, f"{type(e).__name__}: {str(e)}"))
+    conn.close()
+
+class WorkerPool:
+    """
+    Forked worker processes running one transform function
+
+    All workers are forked when the pool is created, so create it while
+    the calling thread is the only one running. Only one object is sharded
+    at a time, so concurrent large objects don't oversubscribe the vCPUs.
+
+    Args:
+        transform (function): Maps one task to a picklable result, runs in the workers
+        workers (int): Number of worker processes
+    """
+    def __init__(self, transform, workers):
+        context = multiprocessing.get_context('fork')
+        self._lock = threading.Lock()
+        self._closed = False
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, args=(child_conn, transform), daemon=True)
+            process.start()
+            child_conn.close()
+            self.connections.append(parent_conn)
+            self.processes.append(process)
+        logger.debug("Started %d transform workers", workers)
+
+    def try_acquire(self):
+        """
+        Claim the workers for one object without waiting
+
+        Returns:
+            bool: True if the caller may shard, and must call release afterwards
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        if self._closed:
+            self._lock.release()
+            return False
+        return True
+
+    def release(self):
+        """
+        Release the workers claimed with try_acquire
+        """
+        self._lock.release()
+
+    def map(self, tasks):
+        """
+        Run the transform over tasks in the workers, yielding results in task order
+
+        At most one task is in flight per worker, so memory stays bounded by
+        the number of workers and a worker blocked sending its result can't
+        deadlock against the parent sending it the next task. If the run
+        stops early the pool is closed, since workers may still be busy.
+
+        Args:
+            tasks (iterable): Picklable tasks, produced lazily by the caller
+
+        Returns:
+            generator: transform results in task order
+
+        Raises:
+            RuntimeError: If a worker fails or exits unexpectedly
+        """
+        idle = list(self.connections)
+        busy = {}
+        results = {}
+        next_index = 0
+
+        def collect(timeout=None):
+            for conn in wait(list(busy), timeout):
+                index = busy.pop(conn)
+                idle.append(conn)
+                try:
+                    result, error = conn.recv()
+                except EOFError:
+                    raise RuntimeError(f"Transform worker exited while processing shard {index}")
+                if error is not None:
+                    raise RuntimeError(f"Transform worker failed on shard {index}: {error}")
+                results[index] = result
+
+        try:
+            for index, task in enumerate(tasks):
+                if not idle:
+                    collect()
+                conn = idle.pop()
+                conn.send(task)
+                busy[conn] = index
+
+                # Hand back finished shards while the rest are still being read
+                collect(0)
+                while next_index in results:
+                    yield results.pop(next_index)
+                    next_index += 1
+
+            while busy:
+                collect()
+            while next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+        finally:
+            if busy:
+                self.close()
+
+    def close(self):
+        """
+        Stop the workers, terminating any that don't exit within a second
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for conn in self.connections:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,322 @@
+"""
+Source assets module.
+This module loads what the function needs for a source (parsed mapping,
+compiled transforms, JSON line decoder, column plans, typed output schema
+and preprocessor functions) the first time an event of that source is
+seen, so startup work doesn't grow with the number of configured sources.
+Preprocessors that take a fields argument are bound to the paths the
+source's mapping reads, so they can skip building fields nobody uses.
+The parsed configuration can also be read from a prebuilt artifact shipped
+next to the function, skipping the JSON parsing and schema derivation.
+"""
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import threading
+
+import pyarrow as pa
+
+import columnar
+import json_decoder
+import ocsf_schemas
+from mapping_compiler import compile_source_mapping, referenced_paths
+
+logger = logging.getLogger()
+
+# Prebuilt configuration artifact, written by running this module
+ARTIFACT_FILE = 'compiled_config.pickle'
+
+# Bumped whenever the artifact layout changes
+ARTIFACT_VERSION = 2
+
+# Modules deriving the artifact's mappings, projections and schemas
+ARTIFACT_MODULES = ('ocsf_schemas.py', 'json_decoder.py', 'expressions.py', 'mapping_compiler.py')
+
+class SourceAssets:
+    """
+    Everything the function uses to process the events of one source
+
+    Args:
+        name (str): Source name
+        mapping (dict): Parsed mapping file, None if the source has none
+        compiled (dict): Result of compile_source_mapping, None without a mapping
+        decoder (function): JSON line decoder keeping the mapped fields
+        column_plans (dict): Columnar plans per matched value, None in record mode
+        output_schema (pyarrow.Schema): Typed output schema, None when inferred
+        class_schemas (dict): Typed schema per OCSF class the source writes, None when inferred
+        preprocess_event (function): Per-event preprocessor, None if the source has none
+        preprocess_batch (function): Batch preprocessor, None if the module has none
+    """
+    __slots__ = ('name', 'mapping', 'compiled', 'decoder', 'column_plans', 'output_schema',
+                 'class_schemas', 'preprocess_event', 'preprocess_batch')
+
+    def __init__(self, name, mapping=None, compiled=None, decoder=None, column_plans=None,
+                 output_schema=None, class_schemas=None, preprocess_event=None, preprocess_batch=None):
+        self.name = name
+        self.mapping = mapping
+        self.compiled = compiled
+        self.decoder = decoder
+        self.column_plans = column_plans
+        self.output_schema = output_schema
+        self.class_schemas = class_schemas
+        self.preprocess_event = preprocess_event
+        self.preprocess_batch = preprocess_batch
+
+def config_fingerprint(base_dir, sources_config):
+    """
+    Hash sources_config.json, the mapping files it references, the modules
+    deriving the artifact and the pyarrow version its schemas are pickled with
+
+    Args:
+        base_dir (str): Function directory
+        sources_config (dict): Parsed sources_config.json
+
+    Returns:
+        str: Hex digest identifying the configuration
+    """
+    digest = hashlib.sha256()
+    digest.update(pa.__version__.encode('utf-8'))
+    for module_file in ARTIFACT_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module_file), 'rb') as f:
+            digest.update(f.read())
+    with open(os.path.join(base_dir, 'sources_config.json'), 'rb') as f:
+        digest.update(f.read())
+    for source in sources_config['sources']:
+        mapping_path = os.path.join(base_dir, 'mappings', source['mapping_file'])
+        digest.update(source['mapping_file'].encode('utf-8'))
+        if os.path.exists(mapping_path):
+            with open(mapping_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+def load_artifact(base_dir, sources_config):
+    """
+    Load the prebuilt artifact if it exists and matches the shipped configuration
+
+    Returns:
+        dict: Artifact contents, or None to load everything from the source files
+    """
+    path = os.path.join(base_dir, ARTIFACT_FILE)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            artifact = pickle.load(f)
+    except Exception as e:
+        logger.warning(f"Could not read {ARTIFACT_FILE}, loading sources from their files: {str(e)}")
+        return None
+    if artifact.get('version') != ARTIFACT_VERSION or artifact.get('fingerprint') != config_fingerprint(base_dir, sources_config):
+        logger.warning(f"{ARTIFACT_FILE} does not match the shipped configuration, loading sources from their files")
+        return None
+    logger.info(f"Loaded prebuilt configuration for {len(artifact['mappings'])} sources")
+    return artifact
+
+def bind_fields(preprocessor, fields):
+    """
+    Pass the fields a mapping reads to a preprocessor that accepts them
+
+    Args:
+        preprocessor (function): preprocess_event or preprocess_batch of a preprocessor module, or None
+        fields (frozenset): Paths the mapping reads, as tuples of keys
+
+    Returns:
+        function: The preprocessor with fields bound, or unchanged if it has no fields parameter
+    """
+    if preprocessor is None:
+        return None
+    try:
+        parameters = inspect.signature(preprocessor).parameters
+    except (TypeError, ValueError):
+        return preprocessor
+    if 'fields' not in parameters:
+        return preprocessor
+    return functools.partial(preprocessor, fields=fields)
+
+class SourceAssetCache:
+    """
+    Per-source assets built on first use and kept for the life of the process
+
+    Args:
+        sources_config (dict): Parsed sources_config.json
+        base_dir (str): Function directory holding mappings/ and preprocessors/
+        transform_mode (str): 'record' or 'columnar', columnar also compiles column plans
+        typed_output (bool): Build the typed output schema of each source
+        artifact (dict): Result of load_artifact, or None
+    """
+    def __init__(self, sources_config, base_dir, transform_mode='record', typed_output=True, artifact=None):
+        self.sources = {source['name']: source for source in sources_config['sources']}
+        self.base_dir = base_dir
+        self.transform_mode = transform_mode
+        self.typed_output = typed_output
+        self.artifact = artifact or {}
+        self._assets = {}
+        self._lock = threading.Lock()
+        # A fork taken while another thread builds assets must not leave the lock held in the child
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        """
+        Replace the lock in a forked child process
+        """
+        self._lock = threading.Lock()
+
+    def get(self, source_name):
+        """
+        Return the assets of a source, building them on first use
+
+        Args:
+            source_name (str): Source name from sources_config.json
+
+        Returns:
+            SourceAssets: Assets of the source, None if it isn't configured
+        """
+        assets = self._assets.get(source_name)
+        if assets is not None:
+            return assets
+        if source_name not in self.sources:
+            return None
+        with self._lock:
+            assets = self._assets.get(source_name)
+            if assets is None:
+                assets = self._build(self.sources[source_name])
+                self._assets[source_name] = assets
+        return assets
+
+    def _load_mapping(self, source):
+        """
+        Return the parsed mapping of a source, from the artifact or its file
+        """
+        mappings = self.artifact.get('mappings', {})
+        if source['name'] in mappings:
+            return mappings[source['name']]
+        mapping_path = os.path.join(self.base_dir, 'mappings', source['mapping_file'])
+        if not os.path.exists(mapping_path):
+            logger.warning(f"Mapping file not found for source: {source['name']}")
+            return None
+        with open(mapping_path) as f:
+            mapping = json.load(f)
+        logger.info(f"Loaded mapping for source: {source['name']}")
+        return mapping
+
+    def _load_preprocessors(self, source):
+        """
+        Return the (preprocess_event, preprocess_batch) functions of a source
+        """
+        # Check if preprocessor_module exists and is not empty
+        module_name = source.get('preprocessor_module')
+        if not module_name:  # handles None, empty string, or key not existing
+            logger.info(f"No preprocessor defined for source: {source['name']}, skipping")
+            return None, None
+        try:
+            # Import the specific module mentioned in the config
+            module = importlib.import_module(f'preprocessors.{module_name}')
+        except ImportError as e:
+            logger.warning(f"Could not import preprocessor for {source['name']}: {e}")
+            return None, None
+
+        preprocess_event = getattr(module, 'preprocess_event', None)
+        if preprocess_event is not None:
+            logger.info(f"Loaded preprocessor for source: {source['name']}")
+        else:
+            logger.warning(f"Preprocessor module {module_name} does not have preprocess_event function")
+        preprocess_batch = getattr(module, 'preprocess_batch', None)
+        if preprocess_batch is not None:
+            logger.info(f"Loaded batch preprocessor for source: {source['name']}")
+        return preprocess_event, preprocess_batch
+
+    def _build(self, source):
+        """
+        Load and compile everything one source needs
+        """
+        name = source['name']
+        assets = SourceAssets(name)
+        assets.preprocess_event, assets.preprocess_batch = self._load_preprocessors(source)
+
+        mapping = self._load_mapping(source)
+        if mapping is None:
+            return assets
+        assets.mapping = mapping
+
+        # Let preprocessors skip the fields the mapping doesn't read
+        fields = frozenset(referenced_paths(mapping))
+        assets.preprocess_event = bind_fields(assets.preprocess_event, fields)
+        assets.preprocess_batch = bind_fields(assets.preprocess_batch, fields)
+
+        # Compile mappings into transform functions once per process
+        assets.compiled = compile_source_mapping(mapping, name)
+        logger.info(f"Compiled mapping for source: {name}")
+
+        # Build a JSON line decoder that only keeps the fields the mapping reads
+        projection = self.artifact.get('projections', {}).get(name)
+        if projection is None:
+            projection = json_decoder.build_projection(referenced_paths(mapping))
+        assets.decoder = json_decoder.make_decoder(projection)
+
+        if self.transform_mode == 'columnar':
+            assets.column_plans = columnar.compile_source_plans(mapping)
+            logger.info(f"Compiled column plans for source: {name}")
+
+        if self.typed_output:
+            # Derive the typed Parquet schemas of the source from its OCSF classes
+            assets.class_schemas = self.artifact.get('class_schemas', {}).get(name)
+            if assets.class_schemas is None:
+                assets.class_schemas = ocsf_schemas.build_class_schemas(mapping)
+            assets.output_schema = self.artifact.get('output_schemas', {}).get(name)
+            if assets.output_schema is None:
+                assets.output_schema = ocsf_schemas.merge_schemas(assets.class_schemas.values())
+                logger.info(f"Built output schema for source: {name}")
+        return assets
+
+def build_artifact(base_dir, path=None):
+    """
+    Write the prebuilt configuration artifact for the function directory
+
+    The artifact holds the parsed mappings, JSON decoder projections and
+    typed output and class schemas of every source. Compiled transforms are closures
+    and are still built on first use. The artifact records a hash of the
+    configuration files and is ignored once they change.
+
+    Args:
+        base_dir (str): Function directory
+        path (str): Output path, ARTIFACT_FILE in base_dir by default
+
+    Returns:
+        str: Path of the written artifact
+    """
+    with open(os.path.join(base_dir, 'sources_config.json')) as f:
+        sources_config = json.load(f)
+    cache = SourceAssetCache(sources_config, base_dir, typed_output=False)
+    mappings = {}
+    for source in sources_config['sources']:
+        mapping = cache._load_mapping(source)
+        if mapping is not None:
+            mappings[source['name']] = mapping
+
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'fingerprint': config_fingerprint(base_dir, sources_config),
+        'mappings': mappings,
+        'projections': {
+            name: json_decoder.build_projection(referenced_paths(mapping)) for name, mapping in mappings.items()
+        },
+        'class_schemas': {
+            name: ocsf_schemas.build_class_schemas(mapping) for name, mapping in mappings.items()
+        }
+    }
+    artifact['output_schemas'] = {
+        name: ocsf_schemas.merge_schemas(class_schemas.values())
+        for name, class_schemas in artifact['class_schemas'].items()
+    }
+    path = path or os.path.join(base_dir, ARTIFACT_FILE)
+    with open(path, 'wb') as f:
+        pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    print(build_artifact(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,122 @@
+"""
+Streaming S3 object reader module.
+This module decompresses gzip S3 objects chunk by chunk and yields their
+lines as they arrive, so memory use does not grow with the object size.
+"""
+import logging
+import zlib
+from itertools import islice
+
+logger = logging.getLogger()
+
+# Compressed bytes requested from the S3 stream per read
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Upper bound on decompressed bytes produced from one read
+MAX_DECOMPRESSED_CHUNK_SIZE = 16 * READ_CHUNK_SIZE
+
+# zlib window bits value accepting a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def iter_decompressed(chunks, max_length=MAX_DECOMPRESSED_CHUNK_SIZE):
+    """
+    Decompress a stream of gzip chunks, including multi-member files
+
+    Args:
+        chunks (iterable): Compressed byte chunks in stream order
+        max_length (int): Maximum decompressed bytes produced per step
+
+    Returns:
+        generator: Decompressed byte chunks
+
+    Raises:
+        EOFError: If the stream ends in the middle of a gzip member
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    started = False
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                # Members can be followed by zero padding, as GzipFile allows
+                chunk = chunk.lstrip(b'\x00')
+                if not chunk:
+                    break
+                # Start of the next gzip member
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+            started = True
+            data = decompressor.decompress(chunk, max_length)
+            if data:
+                yield data
+            chunk = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+
+    if started and not decompressor.eof:
+        raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def iter_lines(chunks):
+    """
+    Split a stream of decoded byte chunks into UTF-8 text lines
+
+    Lines keep their trailing newline, matching iteration over a GzipFile,
+    and lines spanning chunk boundaries are joined before decoding.
+
+    Args:
+        chunks (iterable): Decompressed byte chunks in stream order
+
+    Returns:
+        generator: Lines as str
+    """
+    pending = []
+    for data in chunks:
+        end = data.rfind(b'\n')
+        if end == -1:
+            pending.append(data)
+            continue
+        if pending:
+            pending.append(data[:end + 1])
+            block = b''.join(pending).decode('utf-8')
+        else:
+            block = data[:end + 1].decode('utf-8')
+        pending = [data[end + 1:]]
+
+        lines = block.split('\n')
+        lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+    tail = b''.join(pending)
+    if tail:
+        yield tail.decode('utf-8')
+
+def iter_gzip_lines(body, chunk_size=READ_CHUNK_SIZE):
+    """
+    Stream the lines of a gzip S3 object body
+
+    Args:
+        body (botocore.response.StreamingBody): Body of a GetObject response
+        chunk_size (int): Compressed bytes requested per read
+
+    Returns:
+        generator: Lines as str
+    """
+    return iter_lines(iter_decompressed(body.iter_chunks(chunk_size)))
+
+def iter_batches(lines, batch_size):
+    """
+    Group a stream of lines into lists of at most batch_size lines
+
+    Args:
+        lines (iterable): Lines in stream order
+        batch_size (int): Maximum lines per batch
+
+    Returns:
+        generator: Lists of lines
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,151 @@
+"""
+Timestamp parsing module.
+This module turns event timestamps into Security Lake eventDay values
+(YYYYMMDD) with a parser specialized for each mapping timestamp format.
+"""
+import logging
+import re
+import time
+from datetime import date, datetime
+
+logger = logging.getLogger()
+
+# Strict, fixed-width patterns for the strptime directives with a fast path.
+# Every string they match is also accepted by strptime for the same directive.
+_FAST_DIRECTIVES = {
+    'Y': r'(?P<Y>\d{4})',
+    'm': r'(?P<m>0[1-9]|1[0-2])',
+    'd': r'(?P<d>0[1-9]|[12]\d|3[01])',
+    'H': r'(?:[01]\d|2[0-3])',
+    'M': r'[0-5]\d',
+    'S': r'[0-5]\d',
+    'f': r'\d{1,6}',
+    '%': '%'
+}
+
+_DIRECTIVE = re.compile(r'%(.)')
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# fromtimestamp converts to local time, which is UTC in Lambda
+_LOCAL_TIME_IS_UTC = time.timezone == 0 and (not time.daylight or time.altzone == 0)
+
+def _format_eventday(dt_event):
+    return str(dt_event.year)+f'{dt_event.month:02d}'+f'{dt_event.day:02d}'
+
+def _compile_fast_pattern(timestamp_format):
+    """
+    Translate a strptime format into a strict regex, or None if unsupported
+    """
+    pattern = []
+    position = 0
+    seen = set()
+    for match in _DIRECTIVE.finditer(timestamp_format):
+        directive = match.group(1)
+        if directive not in _FAST_DIRECTIVES or (directive in seen and directive in 'Ymd'):
+            return None
+        seen.add(directive)
+        pattern.append(re.escape(timestamp_format[position:match.start()]))
+        pattern.append(_FAST_DIRECTIVES[directive])
+        position = match.end()
+    pattern.append(re.escape(timestamp_format[position:]))
+    if not {'Y', 'm', 'd'} <= seen:
+        return None
+    return re.compile(''.join(pattern) + r'\Z')
+
+class EventDayParser:
+    """
+    Parses timestamps of one mapping timestamp format into eventDay strings
+
+    'epoch' timestamps use integer arithmetic and strptime formats built
+    from %Y %m %d %H %M %S %f and literals use a strict precompiled pattern.
+    Both memoize the eventDay per day, and anything outside the fast paths
+    goes through datetime exactly as before, so results and errors match
+    datetime.fromtimestamp/datetime.strptime.
+    """
+
+    def __init__(self, timestamp_format):
+        self.timestamp_format = timestamp_format
+        self._days = {}
+        if timestamp_format == 'epoch':
+            self.parse = self._parse_epoch if _LOCAL_TIME_IS_UTC else self._parse_epoch_local
+            self._pattern = None
+        else:
+            self._pattern = _compile_fast_pattern(timestamp_format)
+            self.parse = self._parse_fast if self._pattern is not None else self._parse_strptime
+
+    def _parse_epoch_local(self, timestamp):
+        return _format_eventday(datetime.fromtimestamp(int(timestamp)))
+
+    def _parse_epoch(self, timestamp):
+        seconds = int(timestamp)
+        days = seconds // 86400
+        eventday = self._days.get(days)
+        if eventday is None:
+            try:
+                eventday = _format_eventday(date.fromordinal(_EPOCH_ORDINAL + days))
+            except (ValueError, OverflowError):
+                return self._parse_epoch_local(timestamp)
+            self._days[days] = eventday
+        return eventday
+
+    def _parse_strptime(self, timestamp):
+        return _format_eventday(datetime.strptime(timestamp, self.timestamp_format))
+
+    def _parse_fast(self, timestamp):
+        match = self._pattern.match(timestamp) if type(timestamp) is str else None
+        if match is None:
+            return self._parse_strptime(timestamp)
+        key = match.group('Y', 'm', 'd')
+        eventday = self._days.get(key)
+        if eventday is None:
+            try:
+                eventday = _format_eventday(date(int(key[0]), int(key[1]), int(key[2])))
+            except ValueError:
+                return self._parse_strptime(timestamp)
+            self._days[key] = eventday
+        return eventday
+
+    def parse_batch(self, timestamps):
+        """
+        Return the eventDay of every timestamp in a batch
+
+        None entries are passed through; an invalid timestamp raises the same
+        error parse would.
+
+        Args:
+            timestamps (list): Timestamp strings, or None
+
+        Returns:
+            list: eventDay strings, or None, in input order
+        """
+        if self.parse == self._parse_epoch:
+            days = self._days
+            eventdays = []
+            for timestamp in timestamps:
+                if timestamp is None:
+                    eventdays.append(None)
+                    continue
+                eventday = days.get(int(timestamp) // 86400)
+                eventdays.append(eventday if eventday is not None else self._parse_epoch(timestamp))
+            return eventdays
+        parse = self.parse
+        return [parse(timestamp) if timestamp is not None else None for timestamp in timestamps]
+
+# Parsers shared per timestamp format
+_parsers = {}
+
+def get_eventday_parser(timestamp_format):
+    """
+    Return the shared EventDayParser for a mapping timestamp format
+
+    Args:
+        timestamp_format (str): 'epoch' or a strptime format
+
+    Returns:
+        EventDayParser: Parser for the format
+    """
+    parser = _parsers.get(timestamp_format)
+    if parser is None:
+        parser = _parsers[timestamp_format] = EventDayParser(timestamp_format)
+    return parser